@@ -0,0 +1,231 @@
+"""
+Analyses sur les logs: durees de sortie des cles, agregats par salle, histogrammes
+
+Calculs en SQL sur les logs bruts de la periode (index timestamp/room):
+    - sessions de sortie: les evenements de chaque salle (hors ALERT, dans
+      l'ordre des ids) sont groupes par IN/SWAP (somme de fenetre); un groupe
+      contenant des OUT est une session, refermee par le IN/SWAP qui ouvre le
+      groupe suivant (ouverte s'il n'y en a pas), la cle sortie est celle du
+      IN/SWAP du groupe. Comme pour la retention, des OUT repetes sans retour
+      ne comptent qu'une session, depuis le dernier OUT
+    - agregats par salle (IN/OUT/SWAP/ALERT, tries par nombre de SWAP)
+    - histogrammes par heure, par jour ou en grille jour de semaine x heure:
+      nombre d'evenements et secondes de sortie de cle (occupation) par case
+
+Periode par defaut: les ANALYTICS_DEFAULT_DAYS derniers jours (depuis minuit).
+Les logs deja traites par la retention ne sont plus que dans room_daily_stats
+(voir /api/stats/daily). Les resultats sont mis en cache ANALYTICS_CACHE_TTL_S
+secondes (AnalyticsCache).
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import database as db
+
+ANALYTICS_DEFAULT_DAYS = 7
+ANALYTICS_CACHE_TTL_S = 30
+ANALYTICS_CACHE_SIZE = 256
+BUCKETS = {
+    'hour': "substr(timestamp, 1, 13) || ':00'",
+    'day': 'substr(timestamp, 1, 10)',
+    'weekday_hour': "strftime('%w', timestamp) || ' ' || substr(timestamp, 12, 2)",
+}
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+END_OF_TIME = '9999-12-31 23:59:59'
+
+SESSIONS_CTE = '''
+    WITH ordered AS (
+        SELECT room, state, timestamp, key_uid, key_name,
+               SUM(state IN ('IN', 'SWAP')) OVER (PARTITION BY room ORDER BY id) AS grp
+        FROM logs INDEXED BY idx_logs_timestamp
+        WHERE timestamp >= :since AND state != 'ALERT' {room_clause}
+    ),
+    groups AS (
+        SELECT room, grp,
+               MAX(CASE WHEN state != 'OUT' THEN key_uid END) AS key_uid,
+               MAX(CASE WHEN state != 'OUT' THEN key_name END) AS key_name,
+               MAX(CASE WHEN state != 'OUT' THEN timestamp END) AS in_at,
+               MAX(CASE WHEN state = 'OUT' THEN timestamp END) AS out_at
+        FROM ordered
+        GROUP BY room, grp
+    ),
+    sessions AS (
+        SELECT g.room, g.key_uid, g.key_name, g.out_at, n.in_at,
+               n.in_at IS NULL AS open,
+               (julianday(n.in_at) - julianday(g.out_at)) * 86400 AS seconds
+        FROM groups g LEFT JOIN groups n ON n.room = g.room AND n.grp = g.grp + 1
+        WHERE g.out_at IS NOT NULL AND g.out_at < :until
+    )
+'''
+SESSION_AGGREGATES = '''
+    COUNT(*) AS sessions, COUNT(in_at) AS returned, SUM(open) AS open,
+    ROUND(AVG(seconds)) AS avg_seconds, ROUND(MAX(seconds)) AS max_seconds,
+    ROUND(TOTAL(seconds)) AS total_seconds
+'''
+# Les requetes lisent la periode par l'index timestamp (sinon SQLite prefere parcourir
+# idx_logs_room en entier pour eviter un tri); voir benchmarks/check_query_plans.py
+SQL_ROOM_SUMMARY = '''
+    SELECT room,
+           SUM(state = 'IN' AND is_swap = 0) AS count_in,
+           SUM(state = 'OUT') AS count_out,
+           SUM(is_swap = 1) AS count_swap,
+           SUM(is_multi = 1) AS count_alert,
+           SUM(key_valid = 0 AND state IN ('IN', 'SWAP')) AS count_invalid,
+           MAX(timestamp) AS last_event
+    FROM logs INDEXED BY idx_logs_timestamp
+    WHERE timestamp >= :since AND timestamp < :until
+    GROUP BY room
+    ORDER BY count_swap DESC, count_alert DESC, room
+'''
+SQL_BUCKET_COUNTS = '''
+    SELECT {bucket} AS bucket,
+           SUM(state = 'IN' AND is_swap = 0) AS count_in,
+           SUM(state = 'OUT') AS count_out,
+           SUM(is_swap = 1) AS count_swap,
+           SUM(is_multi = 1) AS count_alert
+    FROM logs INDEXED BY idx_logs_timestamp
+    WHERE timestamp >= :since AND timestamp < :until {room_clause}
+    GROUP BY bucket
+'''
+
+
+def period(since=None, until=None):
+    """Normalise (since, until) en horodatages complets; une date seule pour until est incluse"""
+    if since:
+        since = _parse(since).strftime(TIMESTAMP_FORMAT)
+    else:
+        start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        since = (start - timedelta(days=ANALYTICS_DEFAULT_DAYS)).strftime(TIMESTAMP_FORMAT)
+    if until:
+        end = _parse(until)
+        if len(until.strip()) == 10:
+            end += timedelta(days=1)
+        until = end.strftime(TIMESTAMP_FORMAT)
+    return since, until
+
+
+def _parse(value):
+    value = value.strip()
+    return datetime.strptime(value, '%Y-%m-%d' if len(value) == 10 else TIMESTAMP_FORMAT)
+
+
+def _params(since, until, room):
+    return {'since': since, 'until': until or END_OF_TIME, 'room': room}
+
+
+def key_out_durations(since, until=None, room=None):
+    """Sessions de sortie agregees par salle et par cle (secondes)"""
+    cte = SESSIONS_CTE.format(room_clause='AND room = :room' if room else '')
+    params = _params(since, until, room)
+    with db.connection() as conn:
+        rooms = conn.execute(f'''{cte}
+            SELECT room, {SESSION_AGGREGATES} FROM sessions
+            GROUP BY room ORDER BY total_seconds DESC, room
+        ''', params).fetchall()
+        keys = conn.execute(f'''{cte}
+            SELECT key_uid, MAX(key_name) AS key_name, room, {SESSION_AGGREGATES} FROM sessions
+            WHERE key_uid IS NOT NULL
+            GROUP BY key_uid, room ORDER BY total_seconds DESC, key_uid
+        ''', params).fetchall()
+    return {'since': since, 'until': until,
+            'rooms': [dict(r) for r in rooms], 'keys': [dict(r) for r in keys]}
+
+
+def room_summary(since, until=None):
+    """Compteurs par salle sur la periode, salles avec le plus de SWAP en premier"""
+    with db.connection() as conn:
+        rows = conn.execute(SQL_ROOM_SUMMARY, _params(since, until, None)).fetchall()
+    return {'since': since, 'until': until, 'rooms': [dict(r) for r in rows]}
+
+
+def histogram(since, until=None, room=None, bucket='hour'):
+    """Evenements et occupation (secondes de sortie de cle) par case de temps"""
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket doit etre parmi {', '.join(BUCKETS)}")
+    params = _params(since, until, room)
+    room_clause = 'AND room = :room' if room else ''
+    with db.connection() as conn:
+        counts = conn.execute(SQL_BUCKET_COUNTS.format(bucket=BUCKETS[bucket], room_clause=room_clause),
+                              params).fetchall()
+        sessions = conn.execute(SESSIONS_CTE.format(room_clause=room_clause) +
+                                'SELECT out_at, in_at, open FROM sessions', params).fetchall()
+
+    cells = {row['bucket']: dict(row, out_seconds=0) for row in counts}
+    now = datetime.now()
+    end_of_period = min(_parse(until), now) if until else now
+    for out_at, in_at, still_out in sessions:
+        if in_at is None and not still_out:
+            continue
+        end = min(_parse(in_at), end_of_period) if in_at else end_of_period
+        for label, seconds in _split(_parse(out_at), end, bucket):
+            cell = cells.setdefault(label, {'bucket': label, 'count_in': 0, 'count_out': 0,
+                                            'count_swap': 0, 'count_alert': 0, 'out_seconds': 0})
+            cell['out_seconds'] += seconds
+
+    rows = sorted(cells.values(), key=lambda c: c['bucket'])
+    for cell in rows:
+        cell['out_seconds'] = round(cell['out_seconds'])
+        if bucket == 'weekday_hour':
+            # %w de SQLite: 0 = dimanche
+            weekday, hour = cell.pop('bucket').split(' ')
+            cell.update(weekday=int(weekday), hour=int(hour))
+    return {'since': since, 'until': until, 'room': room, 'bucket': bucket, 'rows': rows}
+
+
+def _split(start, end, bucket):
+    """Decoupe l'intervalle [start, end[ selon les cases: [(libelle, secondes)]"""
+    step = timedelta(days=1) if bucket == 'day' else timedelta(hours=1)
+    parts = []
+    while start < end:
+        if bucket == 'day':
+            cell_start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+            label = cell_start.strftime('%Y-%m-%d')
+        else:
+            cell_start = start.replace(minute=0, second=0, microsecond=0)
+            label = (cell_start.strftime('%Y-%m-%d %H:00') if bucket == 'hour'
+                     else f"{cell_start.isoweekday() % 7} {cell_start:%H}")
+        cell_end = min(cell_start + step, end)
+        parts.append((label, (cell_end - start).total_seconds()))
+        start = cell_end
+    return parts
+
+
+class AnalyticsCache:
+    """Cache TTL des resultats: cle = (fonction, arguments normalises)"""
+
+    def __init__(self, ttl=ANALYTICS_CACHE_TTL_S, max_entries=ANALYTICS_CACHE_SIZE, call=None):
+        """call(fn, *args): execution d'un calcul manquant (app.py passe db_call)"""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.call = call or (lambda fn, *args: fn(*args))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def get(self, fn, *args):
+        key = (fn.__name__,) + args
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+        value = self.call(fn, *args)
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
@@ -1,23 +1,60 @@
-import json
 import os
+from dotenv import load_dotenv
+
+# Charger .env (avant le choix du mode async: le monkey patching doit preceder les autres imports)
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+import async_support
+ASYNC_MODE = async_support.setup()
+
+import atexit
+import logging
+import sys
+import time
+import csv
+import io
+import json
 import secrets
 import hashlib
-from datetime import datetime, timedelta
-from dotenv import load_dotenv
+import zlib
+from datetime import datetime
+from functools import wraps
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
-import database as db
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import telemetry
 
-# Charger .env
-load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+# Journalisation non bloquante (file + thread d'ecriture), avant les modules qui journalisent a l'import
+log_listener = telemetry.setup_logging(os.getenv('LOG_LEVEL', 'INFO'), os.getenv('LOG_FORMAT', 'text'))
+
+import database as db
+from ingest import SiteIngestQueues, WriteBehindQueue
+import retention
+import room_projection
+import analytics
+from room_cache import RoomStateCache
+from dedup import RecentEventIds
+from log_tail import LogTail
+from liveness import NodeLiveness
+from broadcaster import ADMIN_ROOM, Broadcaster, site_room
+import key_registry as keys
+from async_support import iter_blocking, run_blocking
+
+# Decodeur d'evenements commun avec la gateway (shared/events.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+import events  # noqa: E402
+import topics  # noqa: E402
+
+log = logging.getLogger('MQTT')
+admin_log = logging.getLogger('ADMIN')
+health_log = logging.getLogger('HEALTH')
 
 app = Flask(__name__,
             template_folder="../frontend/templates",
             static_folder="../frontend/static")
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(32))
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
 
 # --- CONFIG ---
 MQTT_BROKER = os.getenv('MQTT_BROKER', 'localhost')
@@ -28,65 +65,156 @@ MQTT_PASSWORD = os.getenv('MQTT_PASSWORD', 'cesi123')
 MQTT_CA_CERT = os.path.join(os.path.dirname(__file__), '..', os.getenv('MQTT_CA_CERT', 'mqtt_certs/ca.crt'))
 MQTT_CLIENT_CERT = os.path.join(os.path.dirname(__file__), '..', os.getenv('MQTT_CLIENT_CERT', 'mqtt_certs/client.crt'))
 MQTT_CLIENT_KEY = os.path.join(os.path.dirname(__file__), '..', os.getenv('MQTT_CLIENT_KEY', 'mqtt_certs/client.key'))
-MQTT_TOPIC = "ecole/salles/+/status"
 mqtt_connected = False
 
+# Sites traites par ce backend (topics par site, voir shared/topics.py); vide = tous
+KEYBOX_SITES = [events.check_site(s.strip()) for s in os.getenv('KEYBOX_SITES', '').split(',') if s.strip()]
+
+# Mode multi-workers: abonnement MQTT partage (chaque evenement traite par un seul
+# worker) et relais des trames Socket.IO entre workers via FANOUT_TOPIC
+MQTT_SHARED_GROUP = os.getenv('MQTT_SHARED_GROUP', '')
+WORKER_ID = os.getenv('KEYBOX_WORKER_ID', '0')
+MULTI_WORKER = bool(MQTT_SHARED_GROUP)
+MQTT_SUBSCRIPTIONS = [f"$share/{MQTT_SHARED_GROUP}/{t}" if MULTI_WORKER else t
+                      for t in topics.subscriptions(KEYBOX_SITES)]
+# Rapports de sante des gateways: jamais partages, chaque worker tient sa table de vivacite
+MQTT_HEALTH_SUBSCRIPTIONS = topics.health_subscriptions(KEYBOX_SITES)
+MQTT_CLIENT_ID = f"Web_Backend_{WORKER_ID}" if MULTI_WORKER else "Web_Backend"
+FANOUT_TOPIC = "keybox/backend/fanout"
+
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 FLASK_PORT = int(os.getenv('FLASK_PORT', 5001))
 
-# Sessions
+# Retention des logs (0 = conservation illimitee)
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 0))
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', 6))
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH') or None
+RETENTION_ALLOW_FULL_VACUUM = os.getenv('RETENTION_ALLOW_FULL_VACUUM', 'false').lower() == 'true'
+
+# Checkpoint de l'etat des salles derive des logs (0 = seulement a l'arret)
+ROOM_CHECKPOINT_INTERVAL_S = float(os.getenv('ROOM_CHECKPOINT_INTERVAL_S', 300))
+
+# Analyses (durees de sortie, agregats par salle, histogrammes)
+ANALYTICS_CACHE_TTL_S = float(os.getenv('ANALYTICS_CACHE_TTL_S', 30))
+
+# Pagination des logs
+ADMIN_LOGS_LIMIT = 500
+ADMIN_PAGE_SIZE = 200
+ADMIN_TAIL_BUFFER = int(os.getenv('ADMIN_TAIL_BUFFER', 5000))
+API_LOGS_LIMIT = 1000
+LOGS_MAX_LIMIT = 10000
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ('id', 'timestamp', 'room', 'state', 'key_uid', 'key_name', 'key_valid',
+                  'message', 'is_swap', 'is_multi')
+
+# Ecriture differee des evenements MQTT
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 10000))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 200))
+INGEST_FLUSH_MS = int(os.getenv('INGEST_FLUSH_MS', 50))
+# Nouveaux essais d'un lot dont l'ecriture echoue (base verrouillee...) avant de le compter perdu
+INGEST_WRITE_RETRIES = int(os.getenv('INGEST_WRITE_RETRIES', 3))
+# Une file et un thread d'ecriture par site: un site bruyant ne retarde pas les autres.
+# Le thread MQTT est commun: contre-pression courte par site, puis abandon compte
+INGEST_PARTITION_BY_SITE = os.getenv('INGEST_PARTITION_BY_SITE', 'true').lower() == 'true'
+INGEST_SITE_PUT_TIMEOUT_MS = int(os.getenv('INGEST_SITE_PUT_TIMEOUT_MS', 100))
+INGEST_MAX_SITES = int(os.getenv('INGEST_MAX_SITES', 32))
+
+# Payloads rejetes par le decodeur: file d'ecriture de la table dead_letters
+DEAD_LETTER_QUEUE_SIZE = 1000
+
+# Retransmissions ignorees: eid deja recus (cache memoire), puis index unique en base
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', 100000))
+DEDUP_TTL_S = float(os.getenv('DEDUP_TTL_S', 3600))
+
+# Fenetre de regroupement des mises a jour envoyees aux dashboards
+BROADCAST_WINDOW_MS = int(os.getenv('BROADCAST_WINDOW_MS', 250))
+
+# Vivacite: boitier signale silencieux sans trame depuis NODE_SILENT_AFTER_S (le firmware
+# n'emet qu'au badge: a regler selon l'usage des salles); gateway en retard apres
+# GATEWAY_STALE_FACTOR intervalles de rapport sans nouvelle
+NODE_SILENT_AFTER_S = float(os.getenv('NODE_SILENT_AFTER_S', 21600))
+GATEWAY_STALE_FACTOR = float(os.getenv('GATEWAY_STALE_FACTOR', 3))
+
+# Sessions: sid -> session pour les sockets de ce worker; jetons et blocages
+# d'IP en base (partages entre workers)
 authenticated_sessions = {}
-login_attempts = {}
 MAX_ATTEMPTS = 5
 BLOCK_DURATION = 15
+ADMIN_SESSION_HOURS = float(os.getenv('ADMIN_SESSION_HOURS', 12))
 
 def hash_password(password):
     salt = os.getenv('FLASK_SECRET_KEY', 'CESI_KeyBox')
     return hashlib.sha256(f"{salt}{password}".encode()).hexdigest()
 
-def is_ip_blocked(ip):
-    if ip not in login_attempts:
-        return False
-    data = login_attempts[ip]
-    if 'blocked_until' in data and datetime.now() < data['blocked_until']:
-        return True
-    if 'blocked_until' in data:
-        del login_attempts[ip]
-    return False
-
-def record_attempt(ip, success):
-    if success:
-        login_attempts.pop(ip, None)
-        return
-    if ip not in login_attempts:
-        login_attempts[ip] = {'count': 0}
-    login_attempts[ip]['count'] += 1
-    if login_attempts[ip]['count'] >= MAX_ATTEMPTS:
-        login_attempts[ip]['blocked_until'] = datetime.now() + timedelta(minutes=BLOCK_DURATION)
-
-# Table correspondance
+def db_call(fn, *args, **kwargs):
+    """Appel base de donnees hors boucle evenementielle, chronometre (keybox_db_query_seconds)"""
+    with telemetry.DB_QUERY.labels(fn.__name__).time():
+        return run_blocking(fn, *args, **kwargs)
+
+def admin_required(view):
+    """Route reservee aux admins: jeton de session admin (admin_login) en 'Authorization: Bearer <jeton>'"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token or not db_call(db.get_admin_token, token.strip()):
+            return jsonify({'error': 'jeton admin requis'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def analytics_query(kind, source):
+    """Resultat (en cache) d'une analyse depuis une query string ou un event socket
+
+    kind: sessions | rooms | histogram; ValueError si un parametre est invalide.
+    """
+    since, until = analytics.period(source.get('since'), source.get('until'))
+    room = source.get('room') or None
+    if kind == 'sessions':
+        return analytics_cache.get(analytics.key_out_durations, since, until, room)
+    if kind == 'rooms':
+        return analytics_cache.get(analytics.room_summary, since, until)
+    if kind == 'histogram':
+        return analytics_cache.get(analytics.histogram, since, until, room, source.get('bucket') or 'hour')
+    raise ValueError(f"Analyse inconnue: {kind}")
+
+def current_stats():
+    # En multi-workers, les autres workers ecrivent aussi: relire log_stats (1 ligne)
+    if MULTI_WORKER:
+        db_call(db.reload_stats)
+    return db.get_stats()
+
+def log_query_args(source, default_limit):
+    """Parametres de get_logs depuis un event socket ou une query string"""
+    try:
+        limit = int(source.get('limit') or default_limit)
+    except (TypeError, ValueError):
+        limit = default_limit
+    return {
+        'limit': max(1, min(limit, LOGS_MAX_LIMIT)),
+        'filter_type': source.get('filter'),
+        'before_id': int(source['before_id']) if source.get('before_id') else None,
+        'room': source.get('room') or None,
+        'key_uid': source.get('key') or None,
+        'since': source.get('since') or None,
+        'until': source.get('until') or None,
+    }
+
+# Registre des cles (SQLite + cache LRU), initialise depuis corresponding_table.json
 CORRESPONDING_TABLE_PATH = os.path.join(os.path.dirname(__file__), 'corresponding_table.json')
-with open(CORRESPONDING_TABLE_PATH, 'r', encoding='utf-8') as f:
-    corresponding_table = json.load(f)
-
-def verify_key(room, key):
-    if key == 'N/A':
-        return {'valid': False, 'message': f"Aucune cle salle {room}", 'key_name': None}
-    if key not in corresponding_table:
-        return {'valid': False, 'message': f"Cle inconnue '{key}'", 'key_name': None}
-    info = corresponding_table[key]
-    if info['salle'] == room:
-        return {'valid': True, 'message': f"OK - {info['nom_cle']}", 'key_name': info['nom_cle']}
-    return {'valid': False, 'message': f"ERREUR - {info['nom_cle']} (salle {info['salle']})", 'key_name': info['nom_cle']}
+key_registry = keys.KeyRegistry().init(seed_path=CORRESPONDING_TABLE_PATH)
+
+recent_event_ids = RecentEventIds(DEDUP_CACHE_SIZE, DEDUP_TTL_S)
 
 # --- MQTT ---
 def on_connect(client, userdata, flags, rc, properties):
     global mqtt_connected
     if rc == 0:
         mqtt_connected = True
-        print(f"[MQTT] Connecte")
-        client.subscribe(MQTT_TOPIC)
+        log.info("Connecte")
+        client.subscribe([(topic, 1) for topic in MQTT_SUBSCRIPTIONS])
+        client.subscribe([(topic, 0) for topic in MQTT_HEALTH_SUBSCRIPTIONS])
+        if MULTI_WORKER:
+            client.subscribe(FANOUT_TOPIC)
     else:
         mqtt_connected = False
 
@@ -94,45 +222,294 @@ def on_disconnect(client, userdata, flags, rc, properties):
     global mqtt_connected
     mqtt_connected = False
 
+def on_fanout(msg):
+    """Trame diffusee par un worker: mise a jour du cache local puis emission aux clients locaux"""
+    frame = json.loads(msg.payload)
+    if frame['event'] == 'update_rooms':
+        for entry in frame['data']['rooms']:
+            room_cache.apply(entry)
+    emit_local(frame['event'], frame['data'], frame.get('to'))
+
+def decode_batch(payload, encoding):
+    """Lot de la gateway (format colonnes, voir gateway/batcher.py) -> liste de trames (dict)"""
+    if encoding == 'msgpack':
+        import msgpack
+        batch = msgpack.unpackb(payload)
+    else:
+        batch = json.loads(payload)
+    fields = batch['fields']
+    return [{f: v for f, v in zip(fields, frame) if v is not None} for frame in batch['frames']]
+
 def on_message(client, userdata, msg):
+    if msg.topic == FANOUT_TOPIC:
+        telemetry.MQTT_MESSAGES.labels('fanout').inc()
+        try:
+            on_fanout(msg)
+        except Exception as e:
+            logging.getLogger('FANOUT').error("Erreur: %s", e)
+        return
+    received_at = time.time()
+    # Le site vient du topic (la gateway publie sous ecole/sites/<site>/...), pas du payload
+    kind, site = topics.parse(msg.topic)
+    if kind == 'health':
+        telemetry.MQTT_MESSAGES.labels('health').inc()
+        try:
+            liveness.report(site, json.loads(msg.payload), received_at)
+        except (ValueError, TypeError, AttributeError) as e:
+            health_log.warning("Rapport de sante illisible sur %s: %s", msg.topic, e)
+        return
+    if kind == 'batch':
+        telemetry.MQTT_MESSAGES.labels('batch').inc()
+        try:
+            frames = decode_batch(msg.payload, msg.topic.rsplit('/', 1)[-1])
+        except Exception as e:
+            log.error("Lot illisible sur %s: %s", msg.topic, e)
+            return
+        log.debug("Lot de %d trames", len(frames))
+        for frame in frames:
+            try:
+                event = events.from_dict(frame)
+            except events.DecodeError as e:
+                reject(msg.topic, frame, e, received_at)
+                continue
+            event.site = site
+            handle_event(event, received_at)
+        return
+    if kind is None:
+        log.warning("Topic inattendu: %s", msg.topic)
+        return
+    telemetry.MQTT_MESSAGES.labels('event').inc()
     try:
-        payload = json.loads(msg.payload.decode())
-        room, key, state = payload.get('room'), payload.get('key'), payload.get('state')
-        print(f"[MQTT] Salle {room}: {state} - {key}")
-
-        is_swap, is_multi = False, False
-
-        if state == "ALERT" and key.startswith("MULTI:"):
-            uids = key.replace("MULTI:", "").split(",")
-            is_multi = True
-            payload.update({
-                'key_valid': False, 'key_name': f"{len(uids)} badges",
-                'verification_message': f"ALERTE: {len(uids)} badges!", 'multi_badge': True
-            })
-        elif state == "SWAP":
-            is_swap = True
-            v = verify_key(room, key)
-            payload.update({
-                'key_valid': v['valid'], 'key_name': v['key_name'],
-                'verification_message': f"SWAP! {v['message']}", 'swap_detected': True
-            })
+        event = events.from_payload(msg.payload)
+    except events.DecodeError as e:
+        reject(msg.topic, msg.payload, e, received_at, msg.retain)
+        return
+    event.site = site
+    # retain: etat retenu renvoye par le broker a l'abonnement (connexion, reconnexion)
+    handle_event(event, received_at, msg.retain)
+
+def reject(topic, payload, error, received_at, retained=False):
+    """Payload invalide (bytes ou trame d'un lot): compte et range dans dead_letters"""
+    telemetry.REJECTED.labels(error.reason).inc()
+    if isinstance(payload, bytes):
+        text = payload.decode('utf-8', errors='replace')
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+    else:
+        data, text = payload, json.dumps(payload, default=str)
+    event_id = data.get('eid') if isinstance(data, dict) and isinstance(data.get('eid'), str) else None
+    if retained and not event_id:
+        # Payload retenu sans eid: deja range a sa premiere reception
+        return
+    log.warning("Payload rejete sur %s (%s): %s", topic, error.reason, error)
+    dead_letter_queue.put({
+        'received_at': datetime.fromtimestamp(received_at).strftime('%Y-%m-%d %H:%M:%S'), 'topic': topic,
+        'reason': error.reason, 'error': str(error), 'payload': text, 'event_id': event_id
+    })
+
+def is_duplicate(event, retained):
+    """Retransmission deja traitee (les doublons qui passent ce filtre sont arretes par la base)"""
+    event_id = event.eid
+    if not event_id:
+        if retained:
+            # Ancienne gateway sans eid: l'etat retenu a ete journalise a sa reception
+            telemetry.DUPLICATES.labels('retained').inc()
+        return retained
+    if recent_event_ids.seen(event_id):
+        telemetry.DUPLICATES.labels('cache').inc()
+        return True
+    return False
+
+def handle_event(event, received_at, retained=False):
+    """Evenement decode (events.Event): verification de la cle puis ecriture differee"""
+    try:
+        if is_duplicate(event, retained):
+            return
+        # Cle de salle: "206" (site par defaut) ou "<site>/206", en base comme dans les caches
+        room, key, state = event.room_key, event.key, event.state
+        log.info("Salle %s: %s - %s", room, state, key,
+                 extra={'fields': {'room': room, 'site': event.site, 'state': state, 'key': key}})
+        telemetry.EVENTS.labels(state).inc()
+        if event.rx_ts:
+            telemetry.observe_since('xbee_to_backend', event.rx_ts)
+
+        if event.uids is not None:
+            event.key_name = f"{len(event.uids)} badges"
+            event.message = f"ALERTE: {len(event.uids)} badges!"
         else:
-            v = verify_key(room, key)
-            payload.update({
-                'key_valid': v['valid'], 'key_name': v['key_name'],
-                'verification_message': v['message']
-            })
-
-        # Sauvegarder en DB
-        db.add_log(room, state, key, payload.get('key_name'), payload.get('key_valid'),
-                   payload.get('verification_message'), is_swap, is_multi)
-        db.update_room_state(room, state, key, payload.get('key_name'), payload.get('key_valid'))
-
-        socketio.emit('update_room', payload)
+            # Resultat precalcule par couple (salle, cle), voir KeyRegistry.verify
+            event.key_valid, event.key_name, event.message = key_registry.verify(room, key)
+            if state == 'SWAP':
+                event.message = f"SWAP! {event.message}"
+
+        # Sauvegarde differee en DB (thread d'ecriture)
+        queued = ingest_queue.put({
+            'timestamp': db.now(), 'room': room, 'site': event.site, 'state': state, 'key_uid': key,
+            'key_name': event.key_name, 'key_valid': event.key_valid, 'message': event.message,
+            'is_swap': event.is_swap, 'is_multi': event.is_multi, 'event_id': event.eid, 'retained': retained,
+            'event': event, 'received_at': received_at
+        })
     except Exception as e:
-        print(f"[MQTT] Erreur: {e}")
+        queued = False
+        log.error("Erreur: %s", e)
+    if not queued and event.eid:
+        # Jamais ecrit: une retransmission de cet eid doit etre acceptee
+        recent_event_ids.forget(event.eid)
+
+# Etat des salles en memoire (source des snapshots envoyes a la connexion):
+# projection des logs, chargee depuis le dernier checkpoint + rejeu des logs suivants
+room_cache = RoomStateCache()
+room_cache.load(db.get_room_states())
+checkpoint_job = room_projection.CheckpointJob(ROOM_CHECKPOINT_INTERVAL_S).start()
+
+# Logs recents en memoire et flux filtres des admins (live tail)
+log_tail = LogTail(ADMIN_TAIL_BUFFER)
+log_tail.load(db.get_logs(limit=ADMIN_TAIL_BUFFER))
+
+def fanout_emit(event, data, to=None):
+    if MULTI_WORKER:
+        # Chaque worker (y compris celui-ci) recoit la trame et l'emet a ses clients
+        mqtt_client.publish(FANOUT_TOPIC, json.dumps({'event': event, 'data': data, 'to': to}), qos=0)
+    else:
+        emit_local(event, data, to)
 
-mqtt_client = mqtt.Client(CallbackAPIVersion.VERSION2, "Web_Backend")
+def emit_local(event, data, to=None):
+    """Emission aux clients de ce worker; les logs passent par le tampon et les flux filtres"""
+    if event == 'admin_new_logs':
+        log_tail.dispatch(log_tail.push(data['logs']), socketio.emit)
+        return
+    if event == 'admin_logs_cleared':
+        log_tail.clear()
+    socketio.emit(event, data, to=to)
+
+def admin_logs_page(limit, filter_type=None, before_id=None, room=None):
+    """Page de logs (id decroissant): tampon memoire d'abord, SQLite pour la partie plus ancienne"""
+    logs, complete, before = log_tail.page(limit, filter_type, before_id, room)
+    if not complete:
+        logs = logs + db_call(db.get_logs, limit=limit - len(logs), filter_type=filter_type,
+                              before_id=before, room=room)
+    return logs
+
+def subscribe_tail(sid, source):
+    """Abonne l'admin au flux filtre (filter, room) et retourne la page initiale
+
+    Avec since_id (reconnexion), seuls les logs manques sont renvoyes s'ils sont
+    encore dans le tampon (resumed); sinon la premiere page du flux.
+    """
+    filter_type = source.get('filter') if source.get('filter') in db.LOG_FILTERS else None
+    room = source.get('room') or None
+    previous, stream = log_tail.subscribe(sid, filter_type, room)
+    if previous and previous != stream:
+        leave_room(previous)
+    join_room(stream)
+    tail = {'filter': filter_type, 'room': room, 'resumed': False}
+    try:
+        since_id = int(source['since_id']) if source.get('since_id') else None
+    except (TypeError, ValueError):
+        since_id = None
+    missed = log_tail.since(since_id, filter_type, room) if since_id else None
+    if missed is not None:
+        tail.update(resumed=True, logs=missed, next_cursor=None)
+    else:
+        logs = admin_logs_page(ADMIN_PAGE_SIZE, filter_type, room=room)
+        tail.update(logs=logs, next_cursor=db.next_cursor(logs, ADMIN_PAGE_SIZE))
+    tail['last_id'] = log_tail.last_id
+    return tail
+
+analytics_cache = analytics.AnalyticsCache(ANALYTICS_CACHE_TTL_S, call=db_call)
+
+def on_liveness_change(update):
+    """Rapport recu ou echeance passee: journalise les changements d'etat, pousse aux admins de ce worker"""
+    for change in update['changes']:
+        if change['from'] is None and change['to'] in ('online', 'ok'):
+            continue
+        level = logging.INFO if change['to'] in ('online', 'ok') else logging.WARNING
+        what = f"Boitier {change['key']} (salle {change['room']})" if change['kind'] == 'node' else f"Gateway {change['key']}"
+        health_log.log(level, "%s, site %s: %s -> %s", what, change['site'], change['from'], change['to'],
+                       extra={'fields': change})
+    emit_local('admin_liveness', update, to=ADMIN_ROOM)
+
+liveness = NodeLiveness(NODE_SILENT_AFTER_S, GATEWAY_STALE_FACTOR, on_change=on_liveness_change).start()
+
+broadcaster = Broadcaster(fanout_emit, BROADCAST_WINDOW_MS / 1000,
+                          on_emit=telemetry.STAGE_LATENCY.labels('emit').observe).start()
+
+def on_batch_committed(batch):
+    for event in batch:
+        if event.get('duplicate'):
+            continue
+        telemetry.observe_since('ingest_commit', event['received_at'])
+        event['event'].version = room_cache.update(event['event'], event['id'])
+        broadcaster.publish(event)
+
+def on_batch_lost(batch):
+    """Lot abandonne apres ses nouveaux essais: ses eid ne sont plus consideres comme recus"""
+    for event in batch:
+        if event.get('event_id'):
+            recent_event_ids.forget(event['event_id'])
+
+def write_batch(batch):
+    if db_call(db.add_events, batch):
+        # Doublons arretes par l'index unique (autre worker, redemarrage, etat retenu deja journalise)
+        for event in batch:
+            if event.get('duplicate'):
+                telemetry.DUPLICATES.labels('retained' if event['retained'] else 'db').inc()
+
+ingest_queue = SiteIngestQueues(write_batch, on_commit=on_batch_committed, on_lost=on_batch_lost,
+                                maxsize=INGEST_QUEUE_SIZE, batch_size=INGEST_BATCH_SIZE,
+                                flush_interval=INGEST_FLUSH_MS / 1000,
+                                put_timeout=INGEST_SITE_PUT_TIMEOUT_MS / 1000 if INGEST_PARTITION_BY_SITE else 2.0,
+                                write_retries=INGEST_WRITE_RETRIES,
+                                max_sites=INGEST_MAX_SITES, partitioned=INGEST_PARTITION_BY_SITE).start()
+# Payloads rejetes: sans contre-pression (abandonnes si la file est pleine)
+dead_letter_queue = WriteBehindQueue(db.add_dead_letters, maxsize=DEAD_LETTER_QUEUE_SIZE, batch_size=100,
+                                     flush_interval=0.5, put_timeout=0, name='dead-letter-writer').start()
+
+# Compteurs des composants exposes sur /metrics
+telemetry.register(telemetry.StatsCollector(
+    'keybox_ingest', ingest_queue.stats,
+    counters=('enqueued', 'written', 'dropped', 'errors', 'retries', 'lost', 'batches'),
+    gauges=('queue_depth', 'queue_capacity', 'max_batch_ms')))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_dead_letters', dead_letter_queue.stats, counters=('enqueued', 'written', 'dropped', 'errors', 'lost'),
+    gauges=('queue_depth',)))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_broadcast', broadcaster.stats, counters=('published', 'coalesced', 'frames', 'admin_frames')))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_admin_tail', log_tail.stats, counters=('pushed', 'frames', 'buffer_pages', 'db_pages', 'resumed'),
+    gauges=('buffered', 'subscribers', 'streams')))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_dedup_cache', recent_event_ids.stats, counters=('hits', 'evicted'), gauges=('size',)))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_key_cache', key_registry.stats, counters=('hits', 'misses', 'reloads')))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_analytics_cache', analytics_cache.stats, counters=('hits', 'misses'), gauges=('entries',)))
+telemetry.register(telemetry.StatsCollector(
+    'keybox_liveness', liveness.stats, counters=('reports', 'transitions'),
+    gauges=('gateways_online', 'gateways_stale', 'gateways_offline', 'nodes_ok', 'nodes_silent', 'nodes_unknown')))
+telemetry.register(telemetry.StatsCollector(
+    'keybox', lambda: {'admin_sessions': len(authenticated_sessions), 'mqtt_connected': mqtt_connected},
+    gauges=('admin_sessions', 'mqtt_connected')))
+
+retention_job = retention.RetentionJob(LOG_RETENTION_DAYS, RETENTION_INTERVAL_HOURS, ARCHIVE_DB_PATH,
+                                       RETENTION_ALLOW_FULL_VACUUM).start()
+
+def shutdown():
+    mqtt_client.loop_stop()
+    ingest_queue.stop()
+    dead_letter_queue.stop()
+    broadcaster.stop()
+    liveness.stop()
+    retention_job.stop()
+    checkpoint_job.stop()
+    db.close()
+    log_listener.stop()
+
+atexit.register(shutdown)
+
+mqtt_client = mqtt.Client(CallbackAPIVersion.VERSION2, MQTT_CLIENT_ID)
 mqtt_client.on_connect = on_connect
 mqtt_client.on_disconnect = on_disconnect
 mqtt_client.on_message = on_message
@@ -140,7 +517,7 @@ mqtt_client.on_message = on_message
 # Configure MQTT authentication
 if MQTT_USERNAME and MQTT_PASSWORD:
     mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    print(f"[MQTT] Authentification configuree pour l'utilisateur: {MQTT_USERNAME}")
+    log.info("Authentification configuree pour l'utilisateur: %s", MQTT_USERNAME)
 
 # Configure TLS if enabled
 if MQTT_USE_TLS:
@@ -156,80 +533,95 @@ if MQTT_USE_TLS:
             )
             # Disable hostname verification for localhost
             mqtt_client.tls_insecure_set(True)
-            print(f"[MQTT] TLS active (Port {MQTT_PORT})")
+            log.info("TLS active (Port %s)", MQTT_PORT)
         else:
-            print(f"[MQTT] Avertissement: Certificat CA non trouve: {MQTT_CA_CERT}")
-            print(f"[MQTT] Connexion sans TLS sur le port {MQTT_PORT}")
+            log.warning("Certificat CA non trouve: %s", MQTT_CA_CERT)
+            log.warning("Connexion sans TLS sur le port %s", MQTT_PORT)
     except Exception as e:
-        print(f"[MQTT] Erreur configuration TLS: {e}")
+        log.error("Erreur configuration TLS: %s", e)
 else:
-    print(f"[MQTT] Connexion sans TLS sur le port {MQTT_PORT}")
+    log.info("Connexion sans TLS sur le port %s", MQTT_PORT)
 
 try:
     mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
     mqtt_client.loop_start()
 except Exception as e:
-    print(f"[MQTT] Erreur: {e}")
+    log.error("Erreur: %s", e)
 
 # --- SOCKET EVENTS ---
 @socketio.on('connect')
 def handle_connect(auth=None):
+    telemetry.SOCKET_CLIENTS.inc()
     emit('mqtt_status', {'connected': mqtt_connected})
-    # Envoyer l'etat actuel des salles
-    states = db.get_room_states()
-    for room, data in states.items():
-        emit('update_room', {
-            'room': room, 'state': data['state'], 'key': data['key_uid'],
-            'key_valid': bool(data['key_valid']), 'key_name': data['key_name']
-        })
+    # Un seul message: etat complet, ou deltas depuis since_version en cas de reconnexion
+    auth = auth if isinstance(auth, dict) else {}
+    try:
+        since_version = int(auth['since_version']) if auth.get('since_version') is not None else None
+    except (TypeError, ValueError):
+        since_version = None
+    # Dashboard d'un site (?site=...): salles et mises a jour de ce site seulement
+    try:
+        site = events.check_site(auth.get('site') or events.DEFAULT_SITE)
+    except events.DecodeError:
+        site = events.DEFAULT_SITE
+    join_room(site_room(site))
+    emit('rooms_snapshot', room_cache.snapshot(auth.get('epoch'), since_version, site))
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    telemetry.SOCKET_CLIENTS.dec()
     authenticated_sessions.pop(request.sid, None)
+    log_tail.unsubscribe(request.sid)
 
 @socketio.on('admin_login')
 def handle_login(data):
     sid, ip = request.sid, request.remote_addr or 'unknown'
 
-    if is_ip_blocked(ip):
+    if db_call(db.is_ip_blocked, ip):
         emit('admin_login_response', {'success': False, 'message': 'IP bloquee', 'blocked': True})
         return
 
     username, password = data.get('username', '').strip(), data.get('password', '')
 
     if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
-        record_attempt(ip, True)
+        db_call(db.record_login_attempt, ip, True, MAX_ATTEMPTS, BLOCK_DURATION)
         token = secrets.token_hex(16)
+        db_call(db.save_admin_token, token, username, ADMIN_SESSION_HOURS)
         authenticated_sessions[sid] = {'username': username, 'token': token}
-        print(f"[ADMIN] Login: {username}")
-
-        # Envoyer logs et stats
-        logs = db.get_logs(limit=200)
-        stats = db.get_stats()
+        join_room(ADMIN_ROOM)
+        admin_log.info("Login: %s", username)
 
+        # Flux des logs (sans filtre par defaut) et stats
         emit('admin_login_response', {
-            'success': True, 'token': token, 'username': username,
-            'logs': logs, 'stats': stats
+            'success': True, 'token': token, 'username': username, 'stats': current_stats(),
+            **subscribe_tail(sid, data)
         })
     else:
-        record_attempt(ip, False)
-        left = MAX_ATTEMPTS - login_attempts.get(ip, {}).get('count', 0)
+        left = db_call(db.record_login_attempt, ip, False, MAX_ATTEMPTS, BLOCK_DURATION)
         emit('admin_login_response', {'success': False, 'message': f'Erreur ({left} essais)'})
 
 @socketio.on('admin_logout')
 def handle_logout():
-    authenticated_sessions.pop(request.sid, None)
+    session = authenticated_sessions.pop(request.sid, None)
+    if session:
+        db_call(db.delete_admin_token, session['token'])
+    leave_room(ADMIN_ROOM)
+    stream = log_tail.unsubscribe(request.sid)
+    if stream:
+        leave_room(stream)
     emit('admin_logout_response', {'success': True})
 
 @socketio.on('admin_verify')
 def handle_verify(data):
+    # Le jeton est valide sur tous les workers (reconnexion, rechargement de page)
     sid, token = request.sid, data.get('token')
-    if sid in authenticated_sessions and authenticated_sessions[sid]['token'] == token:
-        logs = db.get_logs(limit=200)
-        stats = db.get_stats()
+    username = db_call(db.get_admin_token, token) if token else None
+    if username:
+        authenticated_sessions[sid] = {'username': username, 'token': token}
+        join_room(ADMIN_ROOM)
+        # Reconnexion: filter/room/since_id du flux en cours (logs manques seulement)
         emit('admin_verify_response', {
-            'valid': True, 'username': authenticated_sessions[sid]['username'],
-            'logs': logs, 'stats': stats
+            'valid': True, 'username': username, 'stats': current_stats(), **subscribe_tail(sid, data)
         })
     else:
         emit('admin_verify_response', {'valid': False})
@@ -238,17 +630,75 @@ def handle_verify(data):
 def handle_get_logs(data):
     if request.sid not in authenticated_sessions:
         return
-    filter_type = data.get('filter')
-    logs = db.get_logs(limit=500, filter_type=filter_type)
-    stats = db.get_stats()
-    emit('admin_logs_response', {'logs': logs, 'stats': stats})
+    data = data if isinstance(data, dict) else {}
+    try:
+        query = log_query_args(data, ADMIN_LOGS_LIMIT)
+    except (TypeError, ValueError):
+        # Reponse emise quand meme: le client attend admin_logs_response
+        emit('admin_logs_response', {'error': 'limit ou before_id invalide', 'logs': [],
+                                     'before_id': data.get('before_id')})
+        return
+    if query['key_uid'] or query['since'] or query['until']:
+        logs = db_call(db.get_logs, **query)
+    else:
+        logs = admin_logs_page(query['limit'], query['filter_type'], query['before_id'], query['room'])
+    stats = current_stats()
+    emit('admin_logs_response', {
+        'logs': logs, 'stats': stats, 'before_id': query['before_id'],
+        'next_cursor': db.next_cursor(logs, query['limit'])
+    })
 
 @socketio.on('admin_clear_logs')
 def handle_clear_logs():
     if request.sid not in authenticated_sessions:
         return
-    db.clear_logs()
-    emit('admin_logs_response', {'logs': [], 'stats': {'in': 0, 'out': 0, 'alert': 0, 'total': 0}})
+    db_call(db.clear_logs)
+    analytics_cache.clear()
+    # Tampons de tous les workers et pages des autres admins
+    fanout_emit('admin_logs_cleared', {'stats': current_stats()}, to=ADMIN_ROOM)
+
+@socketio.on('admin_tail_subscribe')
+def handle_tail_subscribe(data):
+    """Change le filtre du flux en direct: {filter, room, since_id}"""
+    if request.sid not in authenticated_sessions:
+        return
+    emit('admin_tail', {'stats': current_stats(), **subscribe_tail(request.sid, data or {})})
+
+@socketio.on('admin_get_liveness')
+def handle_get_liveness():
+    """Table de vivacite complete (les changements suivants arrivent par 'admin_liveness')"""
+    if request.sid not in authenticated_sessions:
+        return
+    emit('admin_liveness', {'full': True, **liveness.snapshot()})
+
+@socketio.on('admin_import_keys')
+def handle_import_keys(data):
+    """Remplace le registre des cles (format json|csv), sans redemarrage"""
+    if request.sid not in authenticated_sessions:
+        return
+    data = data if isinstance(data, dict) else {}
+    try:
+        entries = keys.parse(data.get('content') or '', data.get('format', 'json'))
+        count = run_blocking(key_registry.import_keys, entries)
+    except (ValueError, KeyError, TypeError) as e:
+        emit('admin_import_keys_response', {'success': False, 'message': f"Import invalide: {e}"})
+        return
+    admin_log.info("%d cles importees par %s", count, authenticated_sessions[request.sid]['username'])
+    emit('admin_import_keys_response', {'success': True, 'count': count})
+
+@socketio.on('admin_analytics')
+def handle_analytics(data):
+    """Analyse demandee par le dashboard admin: {kind, since, until, room, bucket}"""
+    if request.sid not in authenticated_sessions:
+        return
+    data = data if isinstance(data, dict) else {}
+    kind = data.get('kind')
+    try:
+        result = analytics_query(kind, data)
+    except ValueError as e:
+        emit('admin_analytics_response', {'kind': kind, 'error': str(e)})
+        return
+    emit('admin_analytics_response', {'kind': kind, **result})
 
 # --- ROUTES ---
 @app.route('/')
@@ -261,9 +711,127 @@ def admin():
 
 @app.route('/api/logs')
 def api_logs():
-    """API pour exporter les logs"""
-    logs = db.get_logs(limit=10000)
-    return jsonify(logs)
+    """API des logs (filtres + curseur before_id, voir X-Next-Cursor)"""
+    try:
+        query = log_query_args(request.args, API_LOGS_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'before_id invalide'}), 400
+    logs = db_call(db.get_logs, **query)
+    response = jsonify(logs)
+    cursor = db.next_cursor(logs, query['limit'])
+    if cursor is not None:
+        response.headers['X-Next-Cursor'] = str(cursor)
+    return response
+
+def export_lines(fmt, filters):
+    """Genere l'export paquet par paquet (CSV ou NDJSON)"""
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buf.getvalue()
+    for rows in iter_blocking(db.iter_logs(EXPORT_CHUNK_SIZE, **filters)):
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerows(tuple(row[c] for c in EXPORT_COLUMNS) for row in rows)
+            yield buf.getvalue()
+        else:
+            yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+
+def gzip_stream(chunks):
+    """Compresse un flux texte a la volee"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/api/logs/export')
+def api_logs_export():
+    """Export complet des logs en flux (format=csv|ndjson, since, until, room, gzip=1)"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format doit etre csv ou ndjson'}), 400
+    filters = {
+        'filter_type': request.args.get('filter'),
+        'room': request.args.get('room') or None,
+        'key_uid': request.args.get('key') or None,
+        'since': request.args.get('since') or None,
+        'until': request.args.get('until') or None,
+    }
+
+    chunks = export_lines(fmt, filters)
+    filename = f"keybox_logs_{datetime.now().strftime('%Y-%m-%d')}.{fmt}"
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+@app.route('/api/stats/daily')
+def api_daily_stats():
+    """Agregats journaliers par salle issus de la retention (room, since, until)"""
+    return jsonify(run_blocking(retention.get_daily_stats, request.args.get('room'),
+                                request.args.get('since'), request.args.get('until')))
+
+@app.route('/api/analytics/<kind>')
+@admin_required
+def api_analytics(kind):
+    """Analyses sur les logs: sessions (durees de sortie), rooms (agregats), histogram (bucket)"""
+    try:
+        return jsonify(analytics_query(kind, request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/keys')
+@admin_required
+def api_keys():
+    """Registre des cles, ou cles attendues dans une salle (room)"""
+    room = request.args.get('room')
+    if room:
+        return jsonify(list(key_registry.keys_for_room(room)))
+    return jsonify(run_blocking(key_registry.all_keys))
+
+@app.route('/api/dead_letters')
+@admin_required
+def api_dead_letters():
+    """Derniers payloads rejetes a l'ingestion (reason, limit, before_id)"""
+    try:
+        limit = max(1, min(int(request.args.get('limit') or 100), LOGS_MAX_LIMIT))
+        before_id = int(request.args['before_id']) if request.args.get('before_id') else None
+    except ValueError:
+        return jsonify({'error': 'limit ou before_id invalide'}), 400
+    return jsonify(db_call(db.get_dead_letters, limit, request.args.get('reason'), before_id))
+
+@app.route('/api/sites')
+def api_sites():
+    """Sites connus (salles en memoire) et file d'ecriture de chaque site"""
+    queues = ingest_queue.stats()['sites']
+    return jsonify({'default': events.DEFAULT_SITE, 'partitioned': INGEST_PARTITION_BY_SITE,
+                    'sites': [{'site': site, 'rooms': count, 'ingest': queues.get(site)}
+                              for site, count in sorted(room_cache.sites().items())]})
+
+@app.route('/api/liveness')
+@admin_required
+def api_liveness():
+    """Gateways et boitiers: etat (online/stale/offline, ok/silent/unknown), derniers rapports"""
+    return jsonify(liveness.snapshot())
+
+@app.route('/api/ingest/stats')
+def api_ingest_stats():
+    """Compteurs de la file d'ecriture (profondeur, latence des lots) et de la diffusion"""
+    return jsonify({**ingest_queue.stats(), 'broadcast': broadcaster.stats(), 'keys': key_registry.stats(),
+                    'dedup': recent_event_ids.stats(), 'admin_tail': log_tail.stats(),
+                    'dead_letters': dead_letter_queue.stats()})
+
+@app.route('/metrics')
+def metrics():
+    """Metriques au format texte Prometheus (compteurs, latences par etape, base)"""
+    body, content_type = telemetry.render()
+    return Response(body, content_type=content_type)
 
 if __name__ == '__main__':
     print("=" * 50)
@@ -271,5 +839,9 @@ if __name__ == '__main__':
     print("=" * 50)
     print(f"  Dashboard: http://localhost:{FLASK_PORT}")
     print(f"  Admin: http://localhost:{FLASK_PORT}/admin")
+    print(f"  Mode: {ASYNC_MODE}")
     print("=" * 50)
-    socketio.run(app, host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False, allow_unsafe_werkzeug=True)
+    if ASYNC_MODE == 'threading':
+        socketio.run(app, host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, host='0.0.0.0', port=FLASK_PORT, debug=False, use_reloader=False)
@@ -0,0 +1,60 @@
+"""
+Mode de service du backend: 'threading' (defaut, Werkzeug) ou 'eventlet'
+
+En mode eventlet, setup() doit etre appele avant tout autre import
+(monkey patching). Les appels bloquants (SQLite) passent alors par
+run_blocking(), qui les execute dans le pool de threads natifs d'eventlet
+pour ne pas geler la boucle d'evenements. Les modules qui partagent des
+verrous avec ces threads natifs utilisent native_threading / native_queue.
+"""
+import os
+import queue as _queue
+import threading as _threading
+
+ASYNC_MODES = ('threading', 'eventlet')
+ASYNC_MODE = os.getenv('KEYBOX_ASYNC_MODE', 'threading').lower()
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"KEYBOX_ASYNC_MODE doit etre l'un de {ASYNC_MODES}, pas '{ASYNC_MODE}'")
+
+# Primitives natives (non patchees), sures depuis les threads du pool eventlet
+if ASYNC_MODE == 'eventlet':
+    from eventlet.patcher import original
+    native_threading = original('threading')
+    native_queue = original('queue')
+else:
+    native_threading = _threading
+    native_queue = _queue
+
+_patched = False
+
+
+def setup():
+    """Active le monkey patching si le mode eventlet est demande"""
+    global _patched
+    if ASYNC_MODE == 'eventlet' and not _patched:
+        import eventlet
+        eventlet.monkey_patch()
+        _patched = True
+    return ASYNC_MODE
+
+
+def run_blocking(fn, *args, **kwargs):
+    """Execute un appel bloquant sans bloquer la boucle d'evenements
+
+    Depuis un thread natif (ex: ecriture differee), l'appel est direct: tpool
+    n'est utilisable que depuis le thread du hub eventlet.
+    """
+    if ASYNC_MODE == 'eventlet' and native_threading.current_thread() is native_threading.main_thread():
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+def iter_blocking(iterator):
+    """Parcourt un iterateur bloquant (ex: db.iter_logs) element par element via run_blocking"""
+    done = object()
+    while True:
+        item = run_blocking(next, iterator, done)
+        if item is done:
+            return
+        yield item
@@ -0,0 +1,108 @@
+"""
+Diffusion groupee des mises a jour vers les dashboards
+
+Les evenements sont accumules pendant une fenetre (BROADCAST_WINDOW_MS) puis
+envoyes en une seule trame:
+    - 'update_rooms' aux dashboards de chaque site (room Socket.IO site_room):
+      derniere mise a jour par salle (les SWAP/ALERT ne sont jamais ecrases),
+      payload compact; une trame par site present dans la fenetre
+    - 'admin_new_logs' aux seuls admins (room Socket.IO): tous les logs
+"""
+import logging
+import threading
+import time
+
+ADMIN_ROOM = 'admins'
+SITE_ROOM_PREFIX = 'site:'
+log = logging.getLogger('BROADCAST')
+LOG_FIELDS = ('id', 'timestamp', 'room', 'state', 'key_uid', 'key_name', 'key_valid', 'message', 'is_swap', 'is_multi')
+
+
+def site_room(site):
+    """Room Socket.IO des dashboards d'un site"""
+    return SITE_ROOM_PREFIX + site
+
+
+def compact(event):
+    """Payload public minimal d'un events.Event (sans message de verification ni xbee_id)"""
+    return {
+        'room': event.room_key, 'site': event.site, 'state': event.state, 'key': event.key,
+        'key_valid': bool(event.key_valid), 'key_name': event.key_name,
+        'version': event.version,
+        'alert': event.is_swap or event.is_multi
+    }
+
+
+class Broadcaster:
+    def __init__(self, emit, window=0.25, admin_room=ADMIN_ROOM, on_emit=None):
+        """emit(event, data, to=None): socketio.emit, ou relais entre workers;
+        on_emit(secondes): appele pour chaque evenement emis avec son delai d'attente"""
+        self.emit = emit
+        self.on_emit = on_emit
+        self.window = window
+        self.admin_room = admin_room
+        self._rooms = {}
+        self._logs = []
+        self._published_at = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='broadcaster', daemon=True)
+        self.counters = {'published': 0, 'coalesced': 0, 'frames': 0, 'admin_frames': 0}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(self.window * 4)
+        self.flush()
+
+    def publish(self, event):
+        """Ajoute un evenement ecrit en base (dict de l'ingestion, avec 'event')"""
+        entry = compact(event['event'])
+        log = {f: event.get(f) for f in LOG_FIELDS}
+        with self._lock:
+            self.counters['published'] += 1
+            entries = self._rooms.setdefault(entry['room'], [])
+            # Dernier etat gagnant, sauf si l'entree precedente est une alerte
+            if entries and not entries[-1]['alert']:
+                entries[-1] = entry
+                self.counters['coalesced'] += 1
+            else:
+                entries.append(entry)
+            self._logs.append(log)
+            self._published_at.append(time.time())
+
+    def flush(self):
+        with self._lock:
+            rooms, self._rooms = self._rooms, {}
+            logs, self._logs = self._logs, []
+            published_at, self._published_at = self._published_at, []
+            if rooms:
+                self.counters['frames'] += 1
+            if logs:
+                self.counters['admin_frames'] += 1
+        if rooms:
+            by_site = {}
+            for entries in rooms.values():
+                by_site.setdefault(entries[0]['site'], []).extend(entries)
+            for site, entries in by_site.items():
+                self.emit('update_rooms', {'rooms': entries}, to=site_room(site))
+        if logs:
+            self.emit('admin_new_logs', {'logs': logs}, to=self.admin_room)
+        if self.on_emit:
+            now = time.time()
+            for t in published_at:
+                self.on_emit(now - t)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def _run(self):
+        while not self._stop.wait(self.window):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Erreur: %s", e)
@@ -1,144 +1,581 @@
+import logging
 import sqlite3
 import os
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-DB_PATH = os.path.join(os.path.dirname(__file__), 'keybox.db')
+# Verrous natifs: en mode eventlet, les requetes s'executent dans des threads natifs
+from async_support import native_queue as queue, native_threading as threading
+
+DB_PATH = os.getenv('KEYBOX_DB_PATH', os.path.join(os.path.dirname(__file__), 'keybox.db'))
+log = logging.getLogger('DB')
+
+# Pool de connexions persistantes (WAL: lecteurs et ecrivain en parallele)
+POOL_SIZE = int(os.getenv('KEYBOX_DB_POOL_SIZE', 4))
+BUSY_TIMEOUT = 5.0
+CACHED_STATEMENTS = 128
+
+PRAGMAS = (
+    # Avant journal_mode: sans effet sur une base existante (VACUUM requis, voir retention.py)
+    'PRAGMA auto_vacuum=INCREMENTAL',
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA foreign_keys=ON',
+)
+
+# Requetes constantes: sqlite3 reutilise les statements prepares par texte SQL
+SQL_INSERT_LOG = '''
+    INSERT INTO logs (timestamp, room, state, key_uid, key_name, key_valid, message, is_swap, is_multi, event_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# Limite de parametres par requete (SQLITE_MAX_VARIABLE_NUMBER des anciennes versions)
+MAX_SQL_PARAMS = 500
+
+# Payloads rejetes par le decodeur (events.DecodeError); les plus anciens sont effaces
+# au-dela de DEAD_LETTERS_MAX lignes, une retransmission (meme event_id) n'est gardee qu'une fois
+DEAD_LETTERS_MAX = int(os.getenv('DEAD_LETTERS_MAX', 10000))
+DEAD_LETTER_PAYLOAD_MAX = 4096
+SQL_INSERT_DEAD_LETTER = '''
+    INSERT OR IGNORE INTO dead_letters (received_at, topic, reason, error, payload, event_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Etat des salles derive des logs: dernier log de chaque salle d'id > ?
+# (version = id du log, last_update = son horodatage)
+SQL_ROOM_STATES_SINCE = '''
+    SELECT room, state, key_uid, key_name, key_valid, timestamp AS last_update, id AS version
+    FROM logs
+    WHERE id IN (SELECT MAX(id) FROM logs WHERE id > ? GROUP BY room)
+'''
+# Checkpoint: room_states couvre tous les logs d'id <= room_checkpoint.last_log_id
+SQL_CHECKPOINT_ROOMS = '''
+    INSERT OR REPLACE INTO room_states (room, state, key_uid, key_name, key_valid, last_update, version)
+''' + SQL_ROOM_STATES_SINCE.replace('?', '(SELECT last_log_id FROM room_checkpoint WHERE id = 1)')
+
+# Filtres de get_logs (chacun a son index, voir init_db)
+LOG_FILTERS = {
+    'in': "(state = 'IN' AND is_swap = 0)",
+    'out': "state = 'OUT'",
+    'swap': 'is_swap = 1',
+    'alert': '(is_swap | is_multi) = 1',
+}
+
+
+def open_connection(path=None):
+    """Ouvre une connexion configuree hors pool (taches de fond, ATTACH)"""
+    conn = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Pool borne de connexions SQLite longue duree"""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        return open_connection(self.path)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # Pool plein: on attend qu'une connexion soit rendue
+        return self._idle.get()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Ferme les connexions inactives (a appeler a l'arret)"""
+        with self._lock:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._created -= 1
+
+
+_pool = ConnectionPool(DB_PATH)
+
+# Statistiques en memoire: amorcees depuis log_stats, mises a jour a chaque ecriture
+STATS_KEYS = ('in', 'out', 'alert', 'total')
+_stats = dict.fromkeys(STATS_KEYS, 0)
+_stats_lock = threading.Lock()
+# Serialise commit + mise a jour des compteurs face a reload_stats (pas de double comptage)
+_stats_sync = threading.RLock()
+
+def connection():
+    """Emprunte une connexion du pool (context manager)"""
+    return _pool.connection()
+
+def close():
+    """Ferme les connexions du pool"""
+    _pool.close()
 
 def init_db():
     """Initialise la base de donnees"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-
-    # Table des logs
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            room TEXT NOT NULL,
-            state TEXT NOT NULL,
-            key_uid TEXT,
-            key_name TEXT,
-            key_valid INTEGER,
-            message TEXT,
-            is_swap INTEGER DEFAULT 0,
-            is_multi INTEGER DEFAULT 0
-        )
-    ''')
-
-    # Table des etats actuels des salles
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS room_states (
-            room TEXT PRIMARY KEY,
-            state TEXT NOT NULL,
-            key_uid TEXT,
-            key_name TEXT,
-            key_valid INTEGER,
-            last_update TEXT
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-    print("[DB] Base de donnees initialisee")
+    with connection() as conn, conn:
+        c = conn.cursor()
+
+        # Table des logs
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                room TEXT NOT NULL,
+                state TEXT NOT NULL,
+                key_uid TEXT,
+                key_name TEXT,
+                key_valid INTEGER,
+                message TEXT,
+                is_swap INTEGER DEFAULT 0,
+                is_multi INTEGER DEFAULT 0,
+                event_id TEXT
+            )
+        ''')
+        # Migration: identifiant d'evenement de la gateway (eid), unique quand il est fourni
+        if 'event_id' not in [row['name'] for row in c.execute('PRAGMA table_info(logs)')]:
+            c.execute('ALTER TABLE logs ADD COLUMN event_id TEXT')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_logs_event_id ON logs(event_id) WHERE event_id IS NOT NULL')
+
+        # Checkpoint de l'etat des salles (derive des logs, voir checkpoint_room_states)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS room_states (
+                room TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                key_uid TEXT,
+                key_name TEXT,
+                key_valid INTEGER,
+                last_update TEXT,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # Migration: version = id du dernier log de la salle (monotone, partage entre workers)
+        columns = [row['name'] for row in c.execute('PRAGMA table_info(room_states)')]
+        if 'version' not in columns:
+            c.execute('ALTER TABLE room_states ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS room_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_log_id INTEGER NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        ''')
+        # Migration: room_states etait mis a jour a chaque evenement, il couvre deja ses versions
+        c.execute('''
+            INSERT OR IGNORE INTO room_checkpoint (id, last_log_id, created_at)
+            SELECT 1, COALESCE(MAX(version), 0), ? FROM room_states
+        ''', (now(),))
+
+        # Payloads rejetes a l'ingestion (add_dead_letters)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                received_at TEXT NOT NULL,
+                topic TEXT,
+                reason TEXT NOT NULL,
+                error TEXT,
+                payload TEXT,
+                event_id TEXT
+            )
+        ''')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_dead_letters_event_id ON dead_letters(event_id) '
+                  'WHERE event_id IS NOT NULL')
+
+        # Sessions admin et tentatives de connexion (partagees entre workers)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS admin_tokens (
+                token TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires_at TEXT NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS login_attempts (
+                ip TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0,
+                blocked_until TEXT
+            )
+        ''')
+
+        # Index des filtres de get_logs (le rowid suit chaque cle: tri par id sans sort)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_logs_state ON logs(state)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_logs_swap ON logs(is_swap) WHERE is_swap = 1')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_logs_alert ON logs((is_swap | is_multi))')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_logs_room ON logs(room)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_logs_key ON logs(key_uid)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp)')
+
+        # Compteurs des statistiques, tenus a jour par triggers sur logs
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS log_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                count_in INTEGER NOT NULL,
+                count_out INTEGER NOT NULL,
+                count_alert INTEGER NOT NULL,
+                total INTEGER NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS log_stats_insert AFTER INSERT ON logs
+            BEGIN
+                UPDATE log_stats SET
+                    count_in = count_in + (NEW.state = 'IN' AND NEW.is_swap = 0),
+                    count_out = count_out + (NEW.state = 'OUT'),
+                    count_alert = count_alert + (NEW.is_swap = 1 OR NEW.is_multi = 1),
+                    total = total + 1
+                WHERE id = 1;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS log_stats_delete AFTER DELETE ON logs
+            BEGIN
+                UPDATE log_stats SET
+                    count_in = count_in - (OLD.state = 'IN' AND OLD.is_swap = 0),
+                    count_out = count_out - (OLD.state = 'OUT'),
+                    count_alert = count_alert - (OLD.is_swap = 1 OR OLD.is_multi = 1),
+                    total = total - 1
+                WHERE id = 1;
+            END
+        ''')
+
+        # Amorcage unique a partir des logs existants (base creee avant log_stats)
+        c.execute('''
+            INSERT OR IGNORE INTO log_stats (id, count_in, count_out, count_alert, total)
+            SELECT 1,
+                   COALESCE(SUM(state = 'IN' AND is_swap = 0), 0),
+                   COALESCE(SUM(state = 'OUT'), 0),
+                   COALESCE(SUM(is_swap = 1 OR is_multi = 1), 0),
+                   COUNT(*)
+            FROM logs
+        ''')
+
+    reload_stats()
+    log.info("Base de donnees initialisee")
+
+def reload_stats():
+    """Recharge les compteurs en memoire depuis la table log_stats"""
+    with _stats_sync, connection() as conn:
+        row = conn.execute('SELECT count_in, count_out, count_alert, total FROM log_stats WHERE id = 1').fetchone()
+        with _stats_lock:
+            _stats.update(zip(STATS_KEYS, tuple(row) if row else (0, 0, 0, 0)))
+
+def _count_stats(events):
+    """Met a jour les compteurs en memoire apres commit: events = [(state, is_swap, is_multi)]"""
+    count_in = count_out = count_alert = 0
+    for state, is_swap, is_multi in events:
+        if state == 'IN' and not is_swap:
+            count_in += 1
+        elif state == 'OUT':
+            count_out += 1
+        if is_swap or is_multi:
+            count_alert += 1
+    with _stats_lock:
+        _stats['in'] += count_in
+        _stats['out'] += count_out
+        _stats['alert'] += count_alert
+        _stats['total'] += len(events)
+
+def now():
+    """Horodatage au format stocke en base"""
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 def add_log(room, state, key_uid, key_name, key_valid, message, is_swap=False, is_multi=False):
     """Ajoute un log"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    timestamp = now()
 
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with _stats_sync:
+        with connection() as conn, conn:
+            conn.execute(SQL_INSERT_LOG, (timestamp, room, state, key_uid, key_name, 1 if key_valid else 0,
+                                          message, 1 if is_swap else 0, 1 if is_multi else 0, None))
+        _count_stats([(state, is_swap, is_multi)])
 
-    c.execute('''
-        INSERT INTO logs (timestamp, room, state, key_uid, key_name, key_valid, message, is_swap, is_multi)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (timestamp, room, state, key_uid, key_name, 1 if key_valid else 0, message, 1 if is_swap else 0, 1 if is_multi else 0))
+def add_events(events):
+    """Ecrit un lot d'evenements en une seule transaction
 
-    conn.commit()
-    conn.close()
+    Seuls les logs sont ecrits: l'etat des salles en est derive (checkpoint_room_states).
+    Chaque evenement est un dict avec room, state, key_uid, key_name, key_valid,
+    message, is_swap, is_multi, timestamp et event_id (optionnel). L'id du log
+    insere est ajoute a chaque evenement (cle 'id'); un evenement dont l'event_id
+    est deja en base (ou deja dans le lot) n'est pas ecrit et recoit 'duplicate'.
+    Retourne le nombre de doublons ignores.
+    """
+    for e in events:
+        e['timestamp'] = e.get('timestamp') or now()
 
-def update_room_state(room, state, key_uid, key_name, key_valid):
-    """Met a jour l'etat d'une salle"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    with _stats_sync:
+        with connection() as conn, conn:
+            # Verrou d'ecriture des la lecture des event_id: aucun autre worker ne peut
+            # inserer le meme evenement entre la verification et l'insertion
+            conn.execute('BEGIN IMMEDIATE')
+            seen = _existing_event_ids(conn, [e['event_id'] for e in events if e.get('event_id')])
+            fresh = []
+            for e in events:
+                # Lot reessaye apres un echec (transaction annulee): rien n'a ete ecrit
+                e.pop('duplicate', None)
+                event_id = e.get('event_id')
+                if event_id and event_id in seen:
+                    e['duplicate'] = True
+                    continue
+                if event_id:
+                    seen.add(event_id)
+                fresh.append(e)
+            if fresh:
+                conn.executemany(SQL_INSERT_LOG, [
+                    (e['timestamp'], e['room'], e['state'], e.get('key_uid'), e.get('key_name'),
+                     1 if e.get('key_valid') else 0, e.get('message'),
+                     1 if e.get('is_swap') else 0, 1 if e.get('is_multi') else 0, e.get('event_id'))
+                    for e in fresh])
+                # Ids consecutifs: le verrou d'ecriture est tenu pendant toute la transaction
+                first_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0] - len(fresh) + 1
+                for i, e in enumerate(fresh):
+                    e['id'] = first_id + i
+        _count_stats([(e['state'], e.get('is_swap'), e.get('is_multi')) for e in fresh])
+    return len(events) - len(fresh)
 
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def _existing_event_ids(conn, event_ids):
+    """Sous-ensemble des event_id deja presents dans logs (index unique)"""
+    found = set()
+    for i in range(0, len(event_ids), MAX_SQL_PARAMS):
+        chunk = event_ids[i:i + MAX_SQL_PARAMS]
+        found.update(row[0] for row in conn.execute(
+            f"SELECT event_id FROM logs WHERE event_id IN ({','.join('?' * len(chunk))})", chunk))
+    return found
 
-    c.execute('''
-        INSERT OR REPLACE INTO room_states (room, state, key_uid, key_name, key_valid, last_update)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (room, state, key_uid, key_name, 1 if key_valid else 0, timestamp))
+def build_logs_query(limit=100, offset=0, filter_type=None, before_id=None, room=None,
+                     key_uid=None, since=None, until=None, after_id=None):
+    """Construit la requete des logs (filtres + pagination par curseur sur id)
 
-    conn.commit()
-    conn.close()
+    Tri decroissant par defaut; avec after_id, tri croissant a partir de cet id.
+    """
+    clauses, params = [], []
 
-def get_logs(limit=100, offset=0, filter_type=None):
-    """Recupere les logs"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    if filter_type in LOG_FILTERS:
+        clauses.append(LOG_FILTERS[filter_type])
+    if room:
+        clauses.append('room = ?')
+        params.append(room)
+    if key_uid:
+        clauses.append('key_uid = ?')
+        params.append(key_uid)
+    if since:
+        clauses.append('timestamp >= ?')
+        params.append(since)
+    if until:
+        clauses.append('timestamp <= ?')
+        params.append(until)
+    if before_id:
+        clauses.append('id < ?')
+        params.append(int(before_id))
+    if after_id is not None:
+        clauses.append('id > ?')
+        params.append(int(after_id))
 
     query = 'SELECT * FROM logs'
-    params = []
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY id ASC LIMIT ?' if after_id is not None else ' ORDER BY id DESC LIMIT ?'
+    params.append(limit)
+    if offset:
+        query += ' OFFSET ?'
+        params.append(offset)
+
+    return query, params
 
-    if filter_type:
-        if filter_type == 'in':
-            query += ' WHERE state = "IN" AND is_swap = 0'
-        elif filter_type == 'out':
-            query += ' WHERE state = "OUT"'
-        elif filter_type == 'swap':
-            query += ' WHERE is_swap = 1'
-        elif filter_type == 'alert':
-            query += ' WHERE is_swap = 1 OR is_multi = 1'
+def get_logs(limit=100, offset=0, filter_type=None, before_id=None, room=None,
+             key_uid=None, since=None, until=None):
+    """Recupere les logs, du plus recent au plus ancien
 
-    query += ' ORDER BY id DESC LIMIT ? OFFSET ?'
-    params.extend([limit, offset])
+    Pour paginer, passer before_id = id du dernier log de la page precedente
+    (keyset) plutot qu'un offset qui oblige SQLite a relire les pages sautees.
+    """
+    query, params = build_logs_query(limit, offset, filter_type, before_id, room, key_uid, since, until)
 
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute(query, params).fetchall()
 
     return [dict(row) for row in rows]
 
-def get_stats():
-    """Recupere les statistiques"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def iter_logs(chunk_size=1000, **filters):
+    """Parcourt les logs par ordre chronologique, par paquets de chunk_size
 
-    c.execute('SELECT COUNT(*) FROM logs WHERE state = "IN" AND is_swap = 0')
-    count_in = c.fetchone()[0]
+    Chaque paquet est une requete keyset (id > dernier id lu): la connexion est
+    rendue au pool entre deux paquets et la memoire reste constante.
+    """
+    last_id = 0
+    while True:
+        query, params = build_logs_query(chunk_size, after_id=last_id, **filters)
+        with connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1]['id']
 
-    c.execute('SELECT COUNT(*) FROM logs WHERE state = "OUT"')
-    count_out = c.fetchone()[0]
+def next_cursor(logs, limit):
+    """Curseur de la page suivante (None si derniere page)"""
+    return logs[-1]['id'] if logs and len(logs) >= limit else None
 
-    c.execute('SELECT COUNT(*) FROM logs WHERE is_swap = 1 OR is_multi = 1')
-    count_alert = c.fetchone()[0]
+def get_stats():
+    """Recupere les statistiques (compteurs en memoire, O(1))"""
+    with _stats_lock:
+        return dict(_stats)
 
-    c.execute('SELECT COUNT(*) FROM logs')
-    total = c.fetchone()[0]
+def checkpoint_room_states(conn):
+    """Integre au checkpoint les logs ecrits depuis le precedent (dans la transaction de conn)
 
-    conn.close()
+    Un seul INSERT ... SELECT suivi d'un UPDATE: le verrou d'ecriture est pris des la
+    premiere instruction, aucun log ne peut s'intercaler. Sans effet si rien n'a change.
+    Retourne le nouveau last_log_id.
+    """
+    conn.execute(SQL_CHECKPOINT_ROOMS)
+    conn.execute('''
+        UPDATE room_checkpoint SET
+            last_log_id = MAX(last_log_id, COALESCE((SELECT MAX(id) FROM logs), 0)),
+            created_at = ?
+        WHERE id = 1
+    ''', (now(),))
+    return conn.execute('SELECT last_log_id FROM room_checkpoint WHERE id = 1').fetchone()[0]
 
-    return {'in': count_in, 'out': count_out, 'alert': count_alert, 'total': total}
+def get_room_checkpoint():
+    """Dernier checkpoint: {last_log_id, created_at}"""
+    with connection() as conn:
+        return dict(conn.execute('SELECT last_log_id, created_at FROM room_checkpoint WHERE id = 1').fetchone())
 
 def get_room_states():
-    """Recupere l'etat actuel de toutes les salles"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    """Etat actuel de toutes les salles: dernier checkpoint + rejeu des logs posterieurs"""
+    with connection() as conn:
+        # Une seule transaction de lecture: checkpoint et logs vus au meme instant
+        conn.execute('BEGIN')
+        try:
+            states = {row['room']: dict(row) for row in conn.execute('SELECT * FROM room_states')}
+            last_log_id = conn.execute('SELECT last_log_id FROM room_checkpoint WHERE id = 1').fetchone()[0]
+            for row in conn.execute(SQL_ROOM_STATES_SINCE, (last_log_id,)):
+                states[row['room']] = dict(row)
+        finally:
+            conn.rollback()
 
-    c.execute('SELECT * FROM room_states')
-    rows = c.fetchall()
-    conn.close()
-
-    return {row['room']: dict(row) for row in rows}
+    return states
 
 def clear_logs():
-    """Efface tous les logs"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('DELETE FROM logs')
-    conn.commit()
-    conn.close()
+    """Efface tous les logs (l'etat des salles est conserve dans le checkpoint)"""
+    with _stats_sync:
+        with connection() as conn, conn:
+            checkpoint_room_states(conn)
+            conn.execute('DELETE FROM logs')
+            conn.execute('UPDATE log_stats SET count_in = 0, count_out = 0, count_alert = 0, total = 0')
+        with _stats_lock:
+            _stats.update(dict.fromkeys(STATS_KEYS, 0))
+
+def add_dead_letters(entries):
+    """Ecrit un lot de payloads rejetes: dicts avec received_at, topic, reason, error, payload, event_id"""
+    with connection() as conn, conn:
+        conn.executemany(SQL_INSERT_DEAD_LETTER, [
+            (e['received_at'], e.get('topic'), e['reason'], e.get('error'),
+             (e.get('payload') or '')[:DEAD_LETTER_PAYLOAD_MAX], e.get('event_id'))
+            for e in entries])
+        conn.execute('DELETE FROM dead_letters WHERE id <= (SELECT MAX(id) FROM dead_letters) - ?',
+                     (DEAD_LETTERS_MAX,))
+
+def get_dead_letters(limit=100, reason=None, before_id=None):
+    """Derniers payloads rejetes (id decroissant)"""
+    clauses, params = [], []
+    if reason:
+        clauses.append('reason = ?')
+        params.append(reason)
+    if before_id:
+        clauses.append('id < ?')
+        params.append(before_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    with connection() as conn:
+        rows = conn.execute(f'SELECT * FROM dead_letters {where} ORDER BY id DESC LIMIT ?',
+                            params + [limit]).fetchall()
+    return [dict(row) for row in rows]
+
+def save_admin_token(token, username, ttl_hours):
+    """Enregistre un jeton de session admin"""
+    expires_at = (datetime.now() + timedelta(hours=ttl_hours)).strftime('%Y-%m-%d %H:%M:%S')
+    with connection() as conn, conn:
+        conn.execute('DELETE FROM admin_tokens WHERE expires_at < ?', (now(),))
+        conn.execute('INSERT OR REPLACE INTO admin_tokens (token, username, expires_at) VALUES (?, ?, ?)',
+                     (token, username, expires_at))
+
+def get_admin_token(token):
+    """Retourne le nom de l'admin si le jeton est valide, sinon None"""
+    with connection() as conn:
+        row = conn.execute('SELECT username FROM admin_tokens WHERE token = ? AND expires_at >= ?',
+                           (token, now())).fetchone()
+    return row['username'] if row else None
+
+def delete_admin_token(token):
+    with connection() as conn, conn:
+        conn.execute('DELETE FROM admin_tokens WHERE token = ?', (token,))
+
+def is_ip_blocked(ip):
+    """Vrai si l'IP est bloquee; efface le blocage expire"""
+    with connection() as conn, conn:
+        row = conn.execute('SELECT blocked_until FROM login_attempts WHERE ip = ?', (ip,)).fetchone()
+        if row is None or row['blocked_until'] is None:
+            return False
+        if now() < row['blocked_until']:
+            return True
+        conn.execute('DELETE FROM login_attempts WHERE ip = ?', (ip,))
+    return False
+
+def record_login_attempt(ip, success, max_attempts, block_minutes):
+    """Compte un echec de connexion (blocage a max_attempts); retourne les essais restants"""
+    with connection() as conn, conn:
+        if success:
+            conn.execute('DELETE FROM login_attempts WHERE ip = ?', (ip,))
+            return max_attempts
+        conn.execute('''
+            INSERT INTO login_attempts (ip, count) VALUES (?, 1)
+            ON CONFLICT (ip) DO UPDATE SET count = count + 1
+        ''', (ip,))
+        count = conn.execute('SELECT count FROM login_attempts WHERE ip = ?', (ip,)).fetchone()['count']
+        if count >= max_attempts:
+            blocked_until = (datetime.now() + timedelta(minutes=block_minutes)).strftime('%Y-%m-%d %H:%M:%S')
+            conn.execute('UPDATE login_attempts SET blocked_until = ? WHERE ip = ?', (blocked_until, ip))
+    return max_attempts - count
 
 # Init au chargement
 init_db()
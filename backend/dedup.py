@@ -0,0 +1,57 @@
+"""
+Identifiants d'evenements recents (champ eid attribue par la gateway)
+
+Premier filtre contre les retransmissions (QoS 1, rejeu du spool de la
+gateway): un eid deja vu depuis moins de DEDUP_TTL_S secondes est ignore
+avant toute verification ou ecriture. Le cache est borne (DEDUP_CACHE_SIZE,
+les plus anciens sortent en premier) et propre a chaque worker: l'index
+unique logs.event_id reste la garantie finale (db.add_events).
+
+Un eid est enregistre a la reception, avant l'ecriture: si l'evenement n'est
+finalement pas ecrit (file pleine, lot perdu), forget() le retire pour que sa
+retransmission (rejeu du message retenu apres reconnexion) soit acceptee.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecentEventIds:
+    def __init__(self, max_size=100000, ttl=3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._ids = OrderedDict()   # eid -> instant de premiere reception (ordre d'arrivee)
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'evicted': 0}
+
+    def seen(self, event_id):
+        """True si l'eid a deja ete recu recemment; sinon l'enregistre et retourne False"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._ids:
+                self.counters['hits'] += 1
+                return True
+            self._ids[event_id] = now
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+                self.counters['evicted'] += 1
+            return False
+
+    def forget(self, event_id):
+        """Retire un eid dont l'evenement n'a pas ete ecrit"""
+        with self._lock:
+            self._ids.pop(event_id, None)
+
+    def _expire(self, now):
+        limit = now - self.ttl
+        while self._ids:
+            event_id, first_seen = next(iter(self._ids.items()))
+            if first_seen > limit:
+                return
+            del self._ids[event_id]
+            self.counters['evicted'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._ids))
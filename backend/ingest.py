@@ -0,0 +1,225 @@
+"""
+File d'ecriture differee (write-behind) pour les evenements MQTT
+
+Le callback MQTT ne fait qu'enfiler l'evenement enrichi; un thread dedie
+vide la file et ecrit les evenements par lots (une transaction par lot,
+bornee en taille et en temps). La file est bornee: quand elle est pleine,
+put() bloque le thread MQTT (contre-pression) jusqu'a put_timeout, puis
+l'evenement est abandonne et compte. Un lot dont l'ecriture echoue (SQLITE_BUSY
+entre workers, disque plein...) est reessaye write_retries fois avec un delai
+croissant, puis compte comme perdu ('lost') et passe a on_lost(batch).
+
+SiteIngestQueues partitionne l'ingestion par site: une file et un thread
+d'ecriture par site, pour qu'un site bruyant (rafale, gateway qui rejoue son
+spool) n'allonge pas l'attente des evenements des autres sites.
+"""
+import logging
+import queue
+import threading
+import time
+
+_STOP = object()
+RETRY_BACKOFF = 0.1         # delai avant le premier nouvel essai d'un lot (s), double a chaque essai
+log = logging.getLogger('INGEST')
+
+
+class WriteBehindQueue:
+    def __init__(self, write_batch, on_commit=None, maxsize=10000, batch_size=200,
+                 flush_interval=0.05, put_timeout=2.0, write_retries=3, on_lost=None, name='ingest-writer'):
+        self.write_batch = write_batch
+        self.on_commit = on_commit
+        self.on_lost = on_lost
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.write_retries = write_retries
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._stopped = False
+        self._full = False          # file pleine: un seul message par episode de saturation
+        self._lock = threading.Lock()
+        self.counters = {
+            'enqueued': 0, 'written': 0, 'dropped': 0, 'errors': 0, 'retries': 0, 'lost': 0, 'batches': 0,
+            'last_batch_size': 0, 'last_batch_ms': 0.0, 'max_batch_ms': 0.0, 'total_batch_ms': 0.0,
+        }
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, event):
+        """Enfile un evenement; retourne False s'il a ete abandonne"""
+        if self._stopped:
+            self._count('dropped')
+            return False
+        try:
+            self._queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            self._count('dropped')
+            if not self._full:
+                self._full = True
+                log.warning("File %s pleine (%d), evenements abandonnes (compteur 'dropped')",
+                            self._thread.name, self._queue.maxsize)
+            return False
+        self._full = False
+        self._count('enqueued')
+        return True
+
+    def stop(self, timeout=10.0):
+        """Vide la file sur disque puis arrete le thread d'ecriture"""
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self.counters)
+        data['queue_depth'] = self._queue.qsize()
+        data['queue_capacity'] = self._queue.maxsize
+        data['avg_batch_ms'] = data['total_batch_ms'] / data['batches'] if data['batches'] else 0.0
+        return data
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                self.write_batch(batch)
+                break
+            except Exception as e:
+                self._count('errors')
+                if attempt >= self.write_retries:
+                    self._count('lost', len(batch))
+                    log.error("Erreur ecriture lot (%d evenements), abandonne: %s", len(batch), e)
+                    if self.on_lost:
+                        try:
+                            self.on_lost(batch)
+                        except Exception as e:
+                            log.error("Erreur on_lost: %s", e)
+                    return
+                # Ecriture idempotente (index unique event_id): le lot entier est reessaye
+                attempt += 1
+                self._count('retries')
+                log.warning("Erreur ecriture lot (%d evenements), essai %d/%d: %s",
+                            len(batch), attempt, self.write_retries, e)
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            c = self.counters
+            c['written'] += len(batch)
+            c['batches'] += 1
+            c['last_batch_size'] = len(batch)
+            c['last_batch_ms'] = elapsed
+            c['max_batch_ms'] = max(c['max_batch_ms'], elapsed)
+            c['total_batch_ms'] += elapsed
+        if self.on_commit:
+            try:
+                self.on_commit(batch)
+            except Exception as e:
+                log.error("Erreur post-commit: %s", e)
+
+
+class SiteIngestQueues:
+    """Une WriteBehindQueue par site (event['site']), creee a la premiere reception
+
+    Le thread MQTT est commun a tous les sites: la contre-pression d'une file
+    pleine est limitee a put_timeout (court), au-dela l'evenement du site
+    sature est abandonne. Au-dela de max_sites, les nouveaux sites partagent
+    une file commune. partitioned=False: une seule file (comportement historique).
+    """
+    SHARED = '*'
+
+    def __init__(self, write_batch, on_commit=None, maxsize=10000, batch_size=200, flush_interval=0.05,
+                 put_timeout=0.1, write_retries=3, on_lost=None, max_sites=32, partitioned=True):
+        self.write_batch = write_batch
+        self.on_commit = on_commit
+        self.on_lost = on_lost
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.write_retries = write_retries
+        self.max_sites = max_sites
+        self.partitioned = partitioned
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self):
+        return self
+
+    def put(self, event):
+        site = event.get('site') if self.partitioned else self.SHARED
+        q = self._queues.get(site) or self._create(site)
+        return q.put(event) if q else False
+
+    def _create(self, site):
+        with self._lock:
+            if self._stopped:
+                return None
+            if site not in self._queues and len(self._queues) >= self.max_sites:
+                site = self.SHARED
+            if site not in self._queues:
+                name = 'ingest-writer' if site == self.SHARED else f'ingest-writer-{site}'
+                self._queues[site] = WriteBehindQueue(
+                    self.write_batch, on_commit=self.on_commit, maxsize=self.maxsize,
+                    batch_size=self.batch_size, flush_interval=self.flush_interval,
+                    put_timeout=self.put_timeout, write_retries=self.write_retries, on_lost=self.on_lost,
+                    name=name).start()
+            return self._queues[site]
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            self._stopped = True
+            queues = list(self._queues.values())
+        for q in queues:
+            q.stop(timeout)
+
+    def stats(self):
+        """Compteurs cumules de toutes les files, et detail par site ('sites')"""
+        with self._lock:
+            queues = dict(self._queues)
+        sites = {site: q.stats() for site, q in queues.items()}
+        data = dict.fromkeys(('enqueued', 'written', 'dropped', 'errors', 'retries', 'lost', 'batches',
+                              'total_batch_ms', 'queue_depth', 'queue_capacity'), 0)
+        data['max_batch_ms'] = 0.0
+        for site_stats in sites.values():
+            for name in data:
+                if name == 'max_batch_ms':
+                    data[name] = max(data[name], site_stats[name])
+                else:
+                    data[name] += site_stats[name]
+        data['avg_batch_ms'] = data['total_batch_ms'] / data['batches'] if data['batches'] else 0.0
+        data['sites'] = {site: {k: site_stats[k] for k in ('queue_depth', 'enqueued', 'written', 'dropped',
+                                                          'lost', 'max_batch_ms', 'avg_batch_ms')}
+                         for site, site_stats in sites.items()}
+        return data
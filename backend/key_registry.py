@@ -0,0 +1,261 @@
+"""
+Registre des cles (UID RFID -> salle, nom) stocke en SQLite
+
+Remplace le chargement unique de corresponding_table.json:
+    - table `keys` indexee par UID (cle primaire) et par salle
+    - caches LRU en lecture (UID -> cle, salle -> cles attendues), y compris
+      les UID inconnus, invalides a chaque import
+    - resultat de verification precalcule par couple (salle, UID): valide,
+      nom et message, calcules une fois par import (verify)
+    - import atomique JSON/CSV sans redemarrage (une transaction remplace tout)
+    - generation en base: les autres processus (workers, CLI) voient l'import
+      au plus tard KEY_CACHE_CHECK_S secondes apres
+
+Les lectures (cle primaire ou index, cache devant) sont faites directement,
+sans run_blocking: lookup() est appele depuis le callback MQTT, et en mode
+eventlet le greenlet de paho peut etre reveille par un select() en cours
+pendant une attente tpool.
+
+Usage CLI:
+    python key_registry.py import corresponding_table.json
+    python key_registry.py import cles.csv      # colonnes uid,salle,nom_cle
+"""
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import database as db
+
+KEY_CACHE_SIZE = 4096
+KEY_CACHE_CHECK_S = 2.0
+NO_KEY = 'N/A'
+log = logging.getLogger('KEYS')
+
+_MISSING = object()
+
+Verification = namedtuple('Verification', 'valid key_name message')
+
+
+def parse_json(text):
+    """Format de corresponding_table.json: {uid: {salle, nom_cle}}"""
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError(f"Objet JSON attendu, {type(data).__name__} recu")
+    rows = []
+    for uid, info in data.items():
+        if not isinstance(info, dict) or info.get('salle') in (None, ''):
+            raise ValueError(f"Entree invalide: {uid}")
+        name = info.get('nom_cle')
+        rows.append((uid, str(info['salle']), str(name) if name is not None else None))
+    return rows
+
+
+def parse_csv(text):
+    """CSV avec en-tete uid,salle,nom_cle (ou uid,room,name)"""
+    rows = []
+    for row in csv.DictReader(io.StringIO(text)):
+        uid = (row.get('uid') or '').strip()
+        room = (row.get('salle') or row.get('room') or '').strip()
+        if not uid or not room:
+            raise ValueError(f"Ligne invalide: {row}")
+        rows.append((uid, room, (row.get('nom_cle') or row.get('name') or '').strip() or None))
+    return rows
+
+
+def parse(text, fmt):
+    if fmt == 'json':
+        return parse_json(text)
+    if fmt == 'csv':
+        return parse_csv(text)
+    raise ValueError(f"Format inconnu: {fmt}")
+
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key, _MISSING)
+        if value is not _MISSING:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class KeyRegistry:
+    def __init__(self, cache_size=KEY_CACHE_SIZE, check_interval=KEY_CACHE_CHECK_S):
+        self.check_interval = check_interval
+        self._by_uid = LRUCache(cache_size)
+        self._by_room = LRUCache(cache_size)
+        self._verified = LRUCache(cache_size)
+        self._lock = threading.Lock()
+        self._generation = None
+        self._epoch = 0             # incremente a chaque vidage des caches
+        self._checked_at = 0.0
+        self.counters = {'hits': 0, 'misses': 0, 'reloads': 0}
+
+    def init(self, seed_path=None):
+        """Cree les tables; importe seed_path si le registre est vide"""
+        with db.connection() as conn, conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS keys (
+                    uid TEXT PRIMARY KEY,
+                    room TEXT NOT NULL,
+                    name TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_keys_room ON keys(room)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS keys_meta (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    generation INTEGER NOT NULL
+                )
+            ''')
+            conn.execute('INSERT OR IGNORE INTO keys_meta (id, generation) VALUES (1, 0)')
+            empty = conn.execute('SELECT 1 FROM keys LIMIT 1').fetchone() is None
+        if empty and seed_path and os.path.exists(seed_path):
+            with open(seed_path, 'r', encoding='utf-8') as f:
+                count = self.import_keys(parse_json(f.read()))
+            log.info("%d cles importees depuis %s", count, os.path.basename(seed_path))
+        return self
+
+    def import_keys(self, entries):
+        """Remplace atomiquement tout le registre par entries [(uid, salle, nom)]"""
+        entries = list(entries)
+        with db.connection() as conn, conn:
+            conn.execute('DELETE FROM keys')
+            conn.executemany('INSERT OR REPLACE INTO keys (uid, room, name) VALUES (?, ?, ?)', entries)
+            conn.execute('UPDATE keys_meta SET generation = generation + 1 WHERE id = 1')
+        self.invalidate()
+        return len(entries)
+
+    def invalidate(self):
+        with self._lock:
+            self._by_uid.clear()
+            self._by_room.clear()
+            self._verified.clear()
+            self._generation = None
+            self._epoch += 1
+            self.counters['reloads'] += 1
+
+    def lookup(self, uid):
+        """Cle par UID: {'uid', 'room', 'name'} ou None si inconnue"""
+        self._check_generation()
+        with self._lock:
+            value = self._by_uid.get(uid)
+            if value is not _MISSING:
+                self.counters['hits'] += 1
+                return value
+            self.counters['misses'] += 1
+            epoch = self._epoch
+        row = self._fetch_one('SELECT uid, room, name FROM keys WHERE uid = ?', uid)
+        value = dict(row) if row else None
+        self._put(self._by_uid, uid, value, epoch)
+        return value
+
+    def verify(self, room, uid):
+        """Verification d'une cle presentee dans une salle (Verification, en cache par couple)"""
+        if uid == NO_KEY:
+            # Cle sortie (OUT): ne depend pas du registre
+            return Verification(False, None, f"Aucune cle salle {room}")
+        self._check_generation()
+        with self._lock:
+            value = self._verified.get((room, uid))
+            if value is not _MISSING:
+                self.counters['hits'] += 1
+                return value
+            epoch = self._epoch
+        info = self.lookup(uid)
+        if info is None:
+            value = Verification(False, None, f"Cle inconnue '{uid}'")
+        elif info['room'] == room:
+            value = Verification(True, info['name'], f"OK - {info['name']}")
+        else:
+            value = Verification(False, info['name'], f"ERREUR - {info['name']} (salle {info['room']})")
+        self._put(self._verified, (room, uid), value, epoch)
+        return value
+
+    def keys_for_room(self, room):
+        """Cles attendues dans une salle (index inverse)"""
+        self._check_generation()
+        with self._lock:
+            value = self._by_room.get(room)
+            if value is not _MISSING:
+                self.counters['hits'] += 1
+                return value
+            self.counters['misses'] += 1
+            epoch = self._epoch
+        rows = self._fetch_all('SELECT uid, room, name FROM keys WHERE room = ? ORDER BY uid', room)
+        value = tuple(dict(r) for r in rows)
+        self._put(self._by_room, room, value, epoch)
+        return value
+
+    def all_keys(self):
+        return [dict(r) for r in self._fetch_all('SELECT uid, room, name FROM keys ORDER BY room, uid')]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, generation=self._generation)
+
+    def _check_generation(self):
+        """Invalide les caches si un autre processus a importe des cles"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        generation = self._fetch_one('SELECT generation FROM keys_meta WHERE id = 1')[0]
+        with self._lock:
+            if self._generation is not None and generation != self._generation:
+                self._by_uid.clear()
+                self._by_room.clear()
+                self._verified.clear()
+                self._epoch += 1
+                self.counters['reloads'] += 1
+            self._generation = generation
+
+    def _put(self, cache, key, value, epoch):
+        """Met en cache une valeur lue en base, sauf si les caches ont ete vides depuis la lecture"""
+        with self._lock:
+            if self._epoch == epoch:
+                cache.put(key, value)
+
+    @staticmethod
+    def _fetch_one(query, *params):
+        with db.connection() as conn:
+            return conn.execute(query, params).fetchone()
+
+    @staticmethod
+    def _fetch_all(query, *params):
+        with db.connection() as conn:
+            return conn.execute(query, params).fetchall()
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] != 'import':
+        print(__doc__)
+        return 1
+    path = sys.argv[2]
+    fmt = 'csv' if path.lower().endswith('.csv') else 'json'
+    with open(path, 'r', encoding='utf-8') as f:
+        count = KeyRegistry().init().import_keys(parse(f.read(), fmt))
+    print(f"[KEYS] {count} cles importees depuis {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Table de vivacite des gateways et des boitiers (modules XBee), en memoire
+
+Alimentee par les rapports de sante des gateways (topic health, voir
+gateway/health.py), recus par chaque worker (abonnement non partage) et
+retenus par le broker: un backend qui demarre connait aussitot le dernier
+etat de chaque gateway.
+
+    gateway: 'online', 'stale' (pas de rapport depuis STALE_FACTOR intervalles)
+             ou 'offline' (testament MQTT ou arret normal)
+    boitier: 'ok', 'silent' (aucune trame depuis silent_after secondes) ou
+             'unknown' (sa gateway n'est pas 'online')
+
+Pas de balayage periodique: chaque entree a une echeance (prochain changement
+d'etat possible sans nouveau message), rangee dans un tas; un seul thread dort
+jusqu'a la plus proche. Les changements sont passes a on_change(update) avec
+les entrees modifiees, pour etre pousses aux admins.
+"""
+import heapq
+import logging
+import threading
+import time
+
+STALE_FACTOR = 3.0
+NODE_FIELDS = ('room', 'frames', 'rejected', 'fps')
+GATEWAY_FIELDS = ('uptime_s', 'xbee', 'mqtt', 'spool')
+log = logging.getLogger('HEALTH')
+
+
+class NodeLiveness:
+    def __init__(self, silent_after=21600, stale_factor=STALE_FACTOR, on_change=None):
+        self.silent_after = silent_after
+        self.stale_factor = stale_factor
+        self.on_change = on_change
+        self._gateways = {}         # (site, gateway) -> entree
+        self._nodes = {}            # adresse 64 bits -> entree
+        self._deadlines = []        # tas (echeance, nature, cle); entrees perimees ignorees
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='liveness', daemon=True)
+        self.counters = {'reports': 0, 'transitions': 0}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(2)
+
+    def report(self, site, data, received_at=None):
+        """Rapport de sante (dict decode) d'une gateway du site `site`"""
+        now = received_at or time.time()
+        gateway = data.get('gw')
+        if not isinstance(gateway, str) or not gateway:
+            raise ValueError("rapport sans gateway")
+        key = (site, gateway)
+        changes = []
+        with self._cond:
+            self.counters['reports'] += 1
+            entry = self._gateways.get(key)
+            if entry is None:
+                entry = self._gateways[key] = {'site': site, 'gateway': gateway, 'status': None, 'since': now,
+                                               'last_report': None, 'interval': None}
+            if data.get('status') == 'offline':
+                entry['last_report'] = now
+                self._set_status('gateway', entry, 'offline', now, changes)
+            else:
+                entry['interval'] = float(data.get('interval') or 10)
+                entry['last_report'] = now
+                entry.update({f: data.get(f) for f in GATEWAY_FIELDS})
+                self._set_status('gateway', entry, 'online', now, changes)
+                self._schedule(entry['last_report'] + self.stale_factor * entry['interval'], 'gateway', key)
+                nodes = data.get('nodes') or {}
+                for address, node in nodes.items():
+                    self._update_node(site, gateway, address, node, now, changes)
+            updated = [dict(entry)]
+            # Boitiers de cette gateway: etat 'unknown' si elle n'est plus en ligne, et inversement
+            touched = set(data.get('nodes') or ()) if entry['status'] == 'online' else set()
+            for address, node in self._nodes.items():
+                if node['site'] == site and node['gateway'] == gateway and address not in touched:
+                    self._refresh_node(node, now, changes)
+            nodes = [dict(n) for n in self._nodes.values() if n['site'] == site and n['gateway'] == gateway]
+            self._cond.notify()
+        self._notify({'gateways': updated, 'nodes': nodes, 'changes': changes})
+
+    def snapshot(self):
+        with self._cond:
+            return {'gateways': [dict(g) for g in self._gateways.values()],
+                    'nodes': [dict(n) for n in self._nodes.values()],
+                    'silent_after': self.silent_after}
+
+    def stats(self):
+        with self._cond:
+            data = dict(self.counters, gateways_online=0, gateways_stale=0, gateways_offline=0,
+                        nodes_ok=0, nodes_silent=0, nodes_unknown=0)
+            for entry in self._gateways.values():
+                data[f"gateways_{entry['status']}"] += 1
+            for entry in self._nodes.values():
+                data[f"nodes_{entry['status']}"] += 1
+            return data
+
+    # --- Etats (appeles sous self._cond) ---
+    def _update_node(self, site, gateway, address, report, now, changes):
+        node = self._nodes.get(address)
+        if node is None:
+            node = self._nodes[address] = {'address': address, 'status': None, 'since': now, 'last_seen': None}
+        node.update({f: report.get(f) for f in NODE_FIELDS}, site=site, gateway=gateway)
+        age = report.get('age_s')
+        if isinstance(age, (int, float)):
+            # Anciennete relative au rapport: independante de l'horloge de la gateway
+            node['last_seen'] = max(node['last_seen'] or 0, now - age)
+        self._refresh_node(node, now, changes)
+
+    def _refresh_node(self, node, now, changes):
+        gateway = self._gateways.get((node['site'], node['gateway']))
+        if gateway is None or gateway['status'] != 'online':
+            status = 'unknown'
+        elif node['last_seen'] is not None and now - node['last_seen'] >= self.silent_after:
+            status = 'silent'
+        else:
+            status = 'ok'
+            # Une echeance par valeur de last_seen (pas une par rapport): le tas reste petit
+            deadline = node['last_seen'] + self.silent_after if node['last_seen'] is not None else None
+            if deadline is not None and node.get('deadline') != deadline:
+                node['deadline'] = deadline
+                self._schedule(deadline, 'node', node['address'])
+        self._set_status('node', node, status, now, changes)
+
+    def _set_status(self, kind, entry, status, now, changes):
+        previous = entry['status']
+        if previous == status:
+            return
+        entry['status'], entry['since'] = status, now
+        if previous is not None:
+            self.counters['transitions'] += 1
+        changes.append({'kind': kind, 'key': entry['address'] if kind == 'node' else entry['gateway'],
+                        'site': entry['site'], 'room': entry.get('room'), 'from': previous, 'to': status})
+
+    def _schedule(self, deadline, kind, key):
+        heapq.heappush(self._deadlines, (deadline, kind, key))
+
+    def _expire(self, now):
+        """Entrees dont l'echeance est passee: retourne la mise a jour a pousser (ou None)"""
+        changes, gateways, nodes = [], {}, {}
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, kind, key = heapq.heappop(self._deadlines)
+            if kind == 'gateway':
+                entry = self._gateways.get(key)
+                # Echeance perimee si un rapport plus recent a repousse la limite
+                if (entry is None or entry['status'] != 'online'
+                        or entry['last_report'] + self.stale_factor * entry['interval'] > now):
+                    continue
+                self._set_status('gateway', entry, 'stale', now, changes)
+                gateways[key] = entry
+                for node in self._nodes.values():
+                    if (node['site'], node['gateway']) == key:
+                        self._refresh_node(node, now, changes)
+                        nodes[node['address']] = node
+            else:
+                node = self._nodes.get(key)
+                if node is None or node['status'] != 'ok':
+                    continue
+                self._refresh_node(node, now, changes)
+                nodes[key] = node
+        if not changes:
+            return None
+        return {'gateways': [dict(g) for g in gateways.values()], 'nodes': [dict(n) for n in nodes.values()],
+                'changes': changes}
+
+    def _notify(self, update):
+        if self.on_change:
+            try:
+                self.on_change(update)
+            except Exception as e:
+                log.error("Erreur: %s", e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                timeout = self._deadlines[0][0] - time.time() if self._deadlines else None
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                update = self._expire(time.time())
+            if update:
+                self._notify(update)
@@ -0,0 +1,171 @@
+"""
+Flux des logs en direct pour les admins (live tail) et tampon des logs recents
+
+Un admin s'abonne une fois a un flux filtre (filtre de get_logs + salle) et
+recoit seulement les nouveaux logs correspondants, pousses depuis l'ingestion
+(trames 'admin_new_logs' du Broadcaster, relayees entre workers). Chaque flux
+est une room Socket.IO: une emission par filtre actif, pas par admin.
+
+Les logs recents (ADMIN_TAIL_BUFFER) restent en memoire, tries par id:
+    - page initiale et pages precedentes (before_id) lues dans le tampon,
+      SQLite n'est interroge que pour la partie plus ancienne
+    - reprise apres reconnexion (since_id): logs manques lus dans le tampon
+Les ids de logs sont denses (AUTOINCREMENT, pas de trou hors suppression): une
+suite d'ids contigus du tampon est exactement le contenu de la table; au
+premier trou, la suite est lue en base.
+"""
+import threading
+from bisect import bisect_left, insort
+
+ADMIN_TAIL_BUFFER = 5000
+
+# Memes filtres que db.LOG_FILTERS, appliques aux logs en memoire
+TAIL_FILTERS = {
+    'in': lambda row: row['state'] == 'IN' and not row['is_swap'],
+    'out': lambda row: row['state'] == 'OUT',
+    'swap': lambda row: bool(row['is_swap']),
+    'alert': lambda row: bool(row['is_swap'] or row['is_multi']),
+}
+
+
+def matches(row, filter_type=None, room=None):
+    if room and row['room'] != room:
+        return False
+    return filter_type not in TAIL_FILTERS or TAIL_FILTERS[filter_type](row)
+
+
+def tail_room(filter_type=None, room=None):
+    """Room Socket.IO d'un flux filtre"""
+    return f"tail:{filter_type or 'all'}:{room or '*'}"
+
+
+class LogTail:
+    def __init__(self, capacity=ADMIN_TAIL_BUFFER):
+        self.capacity = capacity
+        self._ids = []              # ids tries (croissants), paralleles a _rows
+        self._rows = []
+        self._complete = False      # le tampon contient toute la table (rien de plus ancien en base)
+        self._subscriptions = {}    # sid -> (filter_type, room)
+        self._lock = threading.Lock()
+        self.last_id = 0
+        self.counters = {'pushed': 0, 'frames': 0, 'buffer_pages': 0, 'db_pages': 0, 'resumed': 0}
+
+    def load(self, rows):
+        """Initialise depuis db.get_logs(limit=capacity) (ordre decroissant)"""
+        with self._lock:
+            self._ids, self._rows = [], []
+            for row in reversed(rows):
+                self._ids.append(row['id'])
+                self._rows.append(row)
+            self._complete = len(rows) < self.capacity
+            self.last_id = max(self.last_id, self._ids[-1] if self._ids else 0)
+
+    def clear(self):
+        """Table videe (clear_logs): le tampon vide est complet"""
+        with self._lock:
+            self._ids, self._rows = [], []
+            self._complete = True
+
+    def push(self, rows):
+        """Ajoute des logs ecrits (un lot, ou relayes par un autre worker); retourne les nouveaux"""
+        added = []
+        with self._lock:
+            for row in rows:
+                i = bisect_left(self._ids, row['id'])
+                if i < len(self._ids) and self._ids[i] == row['id']:
+                    continue
+                if i == len(self._ids):
+                    self._ids.append(row['id'])
+                    self._rows.append(row)
+                else:
+                    # Lot d'un autre worker arrive apres des ids plus recents
+                    insort(self._ids, row['id'])
+                    self._rows.insert(i, row)
+                added.append(row)
+            excess = len(self._ids) - self.capacity
+            if excess > 0:
+                del self._ids[:excess]
+                del self._rows[:excess]
+                self._complete = False
+            if added:
+                self.last_id = max(self.last_id, self._ids[-1])
+                self.counters['pushed'] += len(added)
+        return added
+
+    # --- Abonnements (sid -> flux) ---
+    def subscribe(self, sid, filter_type=None, room=None):
+        """Retourne (ancienne room, nouvelle room) pour leave_room/join_room"""
+        with self._lock:
+            previous = self._subscriptions.get(sid)
+            self._subscriptions[sid] = (filter_type, room)
+        return (tail_room(*previous) if previous else None), tail_room(filter_type, room)
+
+    def unsubscribe(self, sid):
+        with self._lock:
+            previous = self._subscriptions.pop(sid, None)
+        return tail_room(*previous) if previous else None
+
+    def dispatch(self, rows, emit):
+        """Envoie a chaque flux actif les logs qui le concernent (ordre croissant des ids)"""
+        if not rows:
+            return
+        with self._lock:
+            streams = set(self._subscriptions.values())
+        for filter_type, room in streams:
+            selected = [row for row in rows if matches(row, filter_type, room)]
+            if selected:
+                emit('admin_new_logs', {'logs': selected, 'last_id': self.last_id},
+                     to=tail_room(filter_type, room))
+                with self._lock:
+                    self.counters['frames'] += 1
+
+    # --- Lectures ---
+    def page(self, limit, filter_type=None, before_id=None, room=None):
+        """Logs d'id < before_id (id decroissant) lus dans le tampon
+
+        Retourne (logs, complete, suite): si complete est faux, la page se
+        complete en base avec before_id=suite (None: depuis le log le plus recent).
+        """
+        with self._lock:
+            end = len(self._ids) if before_id is None else bisect_left(self._ids, before_id)
+            if end == 0:
+                return [], self._complete, before_id
+            # Le tampon ne couvre pas le debut demande (lot d'un autre worker en retard): tout en base
+            if before_id is not None and self._ids[end - 1] != before_id - 1:
+                self.counters['db_pages'] += 1
+                return [], False, before_id
+            logs, expected = [], self._ids[end - 1]
+            for i in range(end - 1, -1, -1):
+                if self._ids[i] != expected:
+                    break
+                row = self._rows[i]
+                if matches(row, filter_type, room):
+                    logs.append(row)
+                    if len(logs) >= limit:
+                        self.counters['buffer_pages'] += 1
+                        return logs, True, None
+                expected -= 1
+            else:
+                if self._complete:
+                    self.counters['buffer_pages'] += 1
+                    return logs, True, None
+            self.counters['db_pages'] += 1
+            return logs, False, expected + 1
+
+    def since(self, after_id, filter_type=None, room=None):
+        """Logs d'id > after_id (ordre croissant), ou None si le tampon ne les couvre pas tous"""
+        with self._lock:
+            start = bisect_left(self._ids, after_id + 1)
+            if start == len(self._ids):
+                missed = []
+            elif self._ids[start] != after_id + 1 or self._ids[-1] - self._ids[start] != len(self._ids) - 1 - start:
+                return None
+            else:
+                missed = [row for row in self._rows[start:] if matches(row, filter_type, room)]
+            self.counters['resumed'] += 1
+            return missed
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, buffered=len(self._ids), subscribers=len(self._subscriptions),
+                        streams=len(set(self._subscriptions.values())), last_id=self.last_id)
@@ -0,0 +1,229 @@
+"""
+Retention des logs: agregation journaliere, archivage et vacuum
+
+Les logs plus anciens que `days` jours (LOG_RETENTION_DAYS) sont traites par lots courts
+(une transaction par lot, le verrou d'ecriture n'est jamais garde longtemps):
+    1. agregation par salle et par jour dans room_daily_stats
+       (IN/OUT/SWAP/ALERT + duree de sortie des cles OUT -> IN)
+    2. copie dans la base d'archive attachee (ARCHIVE_DB_PATH)
+    3. suppression de la table logs, apres integration au checkpoint de l'etat
+       des salles (room_projection: l'etat survit a la suppression de ses logs)
+Puis un incremental_vacuum rend les pages liberees au systeme.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database as db
+from async_support import run_blocking
+
+# Valeurs par defaut (app.py passe la configuration lue depuis .env)
+RETENTION_BATCH_SIZE = 500
+RETENTION_BATCH_PAUSE = 0.05
+VACUUM_PAGES = 2000
+DEFAULT_ARCHIVE_DB_PATH = os.path.join(os.path.dirname(db.DB_PATH), 'keybox_archive.db')
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+ARCHIVE_COLUMNS = 'id, timestamp, room, state, key_uid, key_name, key_valid, message, is_swap, is_multi, event_id'
+log = logging.getLogger('RETENTION')
+
+
+def init_tables(conn):
+    """Tables d'agregats (base principale) et d'archive (base attachee)"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS room_daily_stats (
+                room TEXT NOT NULL,
+                day TEXT NOT NULL,
+                count_in INTEGER NOT NULL DEFAULT 0,
+                count_out INTEGER NOT NULL DEFAULT 0,
+                count_swap INTEGER NOT NULL DEFAULT 0,
+                count_alert INTEGER NOT NULL DEFAULT 0,
+                out_sessions INTEGER NOT NULL DEFAULT 0,
+                out_seconds INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (room, day)
+            )
+        ''')
+        # Derniere sortie de cle non encore rendue, par salle (sessions a cheval sur deux lots)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_pending_out (
+                room TEXT PRIMARY KEY,
+                out_timestamp TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.logs (
+                id INTEGER PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                room TEXT NOT NULL,
+                state TEXT NOT NULL,
+                key_uid TEXT,
+                key_name TEXT,
+                key_valid INTEGER,
+                message TEXT,
+                is_swap INTEGER DEFAULT 0,
+                is_multi INTEGER DEFAULT 0,
+                event_id TEXT
+            )
+        ''')
+        if 'event_id' not in [row['name'] for row in conn.execute('PRAGMA archive.table_info(logs)')]:
+            conn.execute('ALTER TABLE archive.logs ADD COLUMN event_id TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_logs_timestamp ON logs(timestamp)')
+
+
+def _rollup(conn, rows):
+    """Agrege un lot de logs (tries par id) dans room_daily_stats"""
+    pending = {r['room']: r['out_timestamp'] for r in conn.execute('SELECT * FROM rollup_pending_out')}
+    aggregates = {}
+
+    for row in rows:
+        room, state = row['room'], row['state']
+        key = (room, row['timestamp'][:10])
+        agg = aggregates.setdefault(key, [0, 0, 0, 0, 0, 0])
+        if row['is_multi']:
+            agg[3] += 1
+        elif row['is_swap']:
+            agg[2] += 1
+        elif state == 'IN':
+            agg[0] += 1
+        elif state == 'OUT':
+            agg[1] += 1
+
+        if state == 'OUT':
+            pending[room] = row['timestamp']
+        elif state == 'IN' and room in pending:
+            out_ts = datetime.strptime(pending.pop(room), TIMESTAMP_FORMAT)
+            in_ts = datetime.strptime(row['timestamp'], TIMESTAMP_FORMAT)
+            agg[4] += 1
+            agg[5] += max(0, int((in_ts - out_ts).total_seconds()))
+
+    conn.executemany('''
+        INSERT INTO room_daily_stats (room, day, count_in, count_out, count_swap, count_alert, out_sessions, out_seconds)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (room, day) DO UPDATE SET
+            count_in = count_in + excluded.count_in,
+            count_out = count_out + excluded.count_out,
+            count_swap = count_swap + excluded.count_swap,
+            count_alert = count_alert + excluded.count_alert,
+            out_sessions = out_sessions + excluded.out_sessions,
+            out_seconds = out_seconds + excluded.out_seconds
+    ''', [key + tuple(agg) for key, agg in aggregates.items()])
+
+    conn.execute('DELETE FROM rollup_pending_out')
+    conn.executemany('INSERT INTO rollup_pending_out (room, out_timestamp) VALUES (?, ?)', pending.items())
+
+
+def _vacuum(conn, allow_full_vacuum):
+    mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    if mode == 2:
+        # Une page rendue par pas d'execution de la pragma; execute() s'arrete au premier pas
+        # (pas de colonne resultat), executescript() la deroule jusqu'au bout
+        conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_PAGES})')
+    elif allow_full_vacuum:
+        # Conversion d'une base creee sans auto_vacuum (VACUUM complet, bloquant)
+        log.warning("Conversion en auto_vacuum incremental (VACUUM complet)")
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+
+
+def run_retention(days, batch_size=RETENTION_BATCH_SIZE, archive_path=None, allow_full_vacuum=False):
+    """Agrege, archive et supprime les logs plus vieux que `days` jours
+
+    Retourne le nombre de logs archives.
+    """
+    if days <= 0:
+        return 0
+    cutoff = (datetime.now() - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+
+    conn = db.open_connection()
+    archived = 0
+    try:
+        conn.execute('ATTACH DATABASE ? AS archive', (archive_path or DEFAULT_ARCHIVE_DB_PATH,))
+        init_tables(conn)
+        while True:
+            with conn:
+                rows = conn.execute('SELECT * FROM logs WHERE timestamp < ? ORDER BY id LIMIT ?',
+                                    (cutoff, batch_size)).fetchall()
+                if not rows:
+                    break
+                _rollup(conn, rows)
+                ids = [(r['id'],) for r in rows]
+                # OR IGNORE: idempotent si un lot precedent a ete archive sans etre supprime
+                conn.executemany(f'INSERT OR IGNORE INTO archive.logs ({ARCHIVE_COLUMNS}) '
+                                 f'SELECT {ARCHIVE_COLUMNS} FROM main.logs WHERE id = ?', ids)
+                db.checkpoint_room_states(conn)
+                conn.executemany('DELETE FROM main.logs WHERE id = ?', ids)
+            archived += len(rows)
+            if len(rows) < batch_size:
+                break
+            time.sleep(RETENTION_BATCH_PAUSE)
+        _vacuum(conn, allow_full_vacuum)
+    finally:
+        conn.close()
+
+    # Les triggers log_stats ont decompte les lignes supprimees
+    db.reload_stats()
+    if archived:
+        log.info("%d logs archives (avant %s)", archived, cutoff)
+    return archived
+
+
+def get_daily_stats(room=None, since=None, until=None):
+    """Agregats journaliers par salle (avg_out_seconds = duree moyenne de sortie de la cle)"""
+    clauses, params = [], []
+    if room:
+        clauses.append('room = ?')
+        params.append(room)
+    if since:
+        clauses.append('day >= ?')
+        params.append(since[:10])
+    if until:
+        clauses.append('day <= ?')
+        params.append(until[:10])
+    query = 'SELECT * FROM room_daily_stats'
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY day DESC, room'
+
+    with db.connection() as conn:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'room_daily_stats'").fetchone()
+        rows = conn.execute(query, params).fetchall() if exists else []
+
+    result = []
+    for row in rows:
+        data = dict(row)
+        data['avg_out_seconds'] = data['out_seconds'] / data['out_sessions'] if data['out_sessions'] else None
+        result.append(data)
+    return result
+
+
+class RetentionJob:
+    """Thread de fond qui lance run_retention toutes les `interval_hours` heures"""
+
+    def __init__(self, days, interval_hours=6, archive_path=None, allow_full_vacuum=False):
+        self.days = days
+        self.interval = interval_hours * 3600
+        self.archive_path = archive_path
+        self.allow_full_vacuum = allow_full_vacuum
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+
+    def start(self):
+        if self.days > 0:
+            log.info("Conservation des logs: %d jours", self.days)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_blocking(run_retention, self.days, archive_path=self.archive_path,
+                             allow_full_vacuum=self.allow_full_vacuum)
+            except Exception as e:
+                log.error("Erreur: %s", e)
+            self._stop.wait(self.interval)
@@ -0,0 +1,85 @@
+"""
+Cache memoire de l'etat des salles, versionne
+
+Projection en memoire des logs: chargee une fois depuis le dernier checkpoint
+(+ rejeu des logs posterieurs, voir room_projection) puis mise a jour a chaque
+lot ecrit.
+La version d'une salle est l'id du dernier log qui l'a modifiee: elle est
+monotone et commune a tous les workers. Un client qui se reconnecte avec
+(epoch, since_version) ne recoit que les salles modifiees depuis; l'epoch
+change a chaque demarrage du processus (snapshot complet par prudence).
+
+Les salles sont indexees par cle de salle (events.room_key, "<site>/206" hors
+site par defaut); chaque entree porte son site, et un dashboard ne recoit que
+les salles de son site (snapshot(site=...)).
+"""
+import os
+import secrets
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from events import split_room_key  # noqa: E402
+
+ENTRY_FIELDS = ('room', 'site', 'state', 'key', 'key_valid', 'key_name', 'version')
+
+
+class RoomStateCache:
+    def __init__(self):
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def load(self, states):
+        """Initialise depuis db.get_room_states()"""
+        for room, data in states.items():
+            self.apply({
+                'room': room, 'site': split_room_key(room)[0], 'state': data['state'], 'key': data['key_uid'],
+                'key_valid': bool(data['key_valid']), 'key_name': data['key_name'],
+                'version': data.get('version') or 0
+            })
+
+    def update(self, event, version):
+        """Applique un evenement (events.Event verifie par handle_event) ecrit sous l'id `version`"""
+        self.apply({
+            'room': event.room_key, 'site': event.site, 'state': event.state, 'key': event.key,
+            'key_valid': bool(event.key_valid), 'key_name': event.key_name,
+            'version': version
+        })
+        return version
+
+    def apply(self, entry):
+        """Applique une entree compacte; ignoree si plus ancienne que l'etat connu"""
+        with self._lock:
+            current = self._rooms.get(entry['room'])
+            if current is not None and current['version'] >= entry['version']:
+                return False
+            self._rooms[entry['room']] = {k: entry.get(k) for k in ENTRY_FIELDS}
+            self.version = max(self.version, entry['version'])
+            return True
+
+    def snapshot(self, epoch=None, since_version=None, site=None):
+        """Etat complet, ou seulement les deltas si le client connait deja cette epoch
+
+        site: seulement les salles de ce site (None: tous les sites). La version
+        reste globale: un client qui change de site repart d'un snapshot complet.
+        """
+        with self._lock:
+            delta = epoch == self.epoch and since_version is not None and since_version <= self.version
+            rooms = self._rooms.values()
+            if site is not None:
+                rooms = [r for r in rooms if r['site'] == site]
+            if delta:
+                rooms = [r for r in rooms if r['version'] > since_version]
+            else:
+                rooms = list(rooms)
+            return {'epoch': self.epoch, 'version': self.version, 'delta': delta, 'site': site, 'rooms': rooms}
+
+    def sites(self):
+        """Sites connus et leur nombre de salles"""
+        with self._lock:
+            counts = {}
+            for r in self._rooms.values():
+                counts[r['site']] = counts.get(r['site'], 0) + 1
+            return counts
@@ -0,0 +1,135 @@
+"""
+Etat des salles derive des logs (event sourcing)
+
+La table logs est la seule source de verite; aucun chemin d'ecriture ne modifie
+directement l'etat d'une salle:
+    - projection en memoire: RoomStateCache, mise a jour apres chaque lot ecrit
+    - checkpoint periodique (ROOM_CHECKPOINT_INTERVAL_S): room_states recoit le
+      dernier log de chaque salle et room_checkpoint.last_log_id avance
+    - au demarrage: checkpoint + rejeu des seuls logs posterieurs (db.get_room_states)
+La retention et clear_logs integrent les logs au checkpoint avant de les supprimer.
+
+Usage CLI:
+    python room_projection.py checkpoint
+    python room_projection.py verify [--archive keybox_archive.db]
+
+verify reconstruit l'etat depuis tous les logs (et l'archive de la retention si
+fournie) et le compare a checkpoint + rejeu. Sans archive, une salle dont tous
+les logs ont ete archives apparait comme absente de la reconstruction; apres un
+clear_logs (historique efface sans archive), les salles concernees divergent.
+"""
+import argparse
+import logging
+import sys
+import threading
+
+import database as db
+from async_support import run_blocking
+
+log = logging.getLogger('PROJECTION')
+
+ROOM_CHECKPOINT_INTERVAL_S = 300
+STATE_COLUMNS = ('state', 'key_uid', 'key_name', 'key_valid', 'version')
+
+
+def checkpoint():
+    """Integre les nouveaux logs au checkpoint; retourne {last_log_id, replayed}"""
+    with db.connection() as conn, conn:
+        previous = conn.execute('SELECT last_log_id FROM room_checkpoint WHERE id = 1').fetchone()[0]
+        last_log_id = db.checkpoint_room_states(conn)
+    return {'last_log_id': last_log_id, 'replayed': last_log_id - previous}
+
+
+def rebuild(archive_path=None):
+    """Etat des salles reconstruit depuis zero: dernier log de chaque salle"""
+    conn = db.open_connection()
+    try:
+        source = 'logs'
+        if archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+            columns = 'id, timestamp, room, state, key_uid, key_name, key_valid'
+            source = f'(SELECT {columns} FROM main.logs UNION ALL SELECT {columns} FROM archive.logs)'
+        rows = conn.execute(f'''
+            SELECT room, state, key_uid, key_name, key_valid, timestamp AS last_update, id AS version
+            FROM {source} AS all_logs
+            WHERE id IN (SELECT MAX(id) FROM {source} AS l GROUP BY room)
+        ''').fetchall()
+    finally:
+        conn.close()
+    return {row['room']: dict(row) for row in rows}
+
+
+def verify(archive_path=None):
+    """Compare checkpoint + rejeu a une reconstruction complete"""
+    projected = db.get_room_states()
+    rebuilt = rebuild(archive_path)
+    different = {}
+    for room in projected.keys() & rebuilt.keys():
+        diff = {c: (projected[room][c], rebuilt[room][c]) for c in STATE_COLUMNS
+                if projected[room][c] != rebuilt[room][c]}
+        if diff:
+            different[room] = diff
+    return {
+        'rooms': len(rebuilt),
+        'missing': sorted(rebuilt.keys() - projected.keys()),   # dans les logs, pas dans la projection
+        'extra': sorted(projected.keys() - rebuilt.keys()),     # dans la projection, plus dans les logs
+        'different': different,
+    }
+
+
+class CheckpointJob:
+    """Thread de fond qui lance checkpoint toutes les `interval` secondes"""
+
+    def __init__(self, interval=ROOM_CHECKPOINT_INTERVAL_S):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='room-checkpoint', daemon=True)
+
+    def start(self):
+        if self.interval > 0:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Arrete le thread et ecrit un dernier checkpoint (demarrage suivant sans rejeu)"""
+        self._stop.set()
+        try:
+            checkpoint()
+        except Exception as e:
+            log.error("Erreur checkpoint: %s", e)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                run_blocking(checkpoint)
+            except Exception as e:
+                log.error("Erreur checkpoint: %s", e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('checkpoint', 'verify'))
+    parser.add_argument('--archive', help="base d'archive de la retention (ARCHIVE_DB_PATH)")
+    args = parser.parse_args()
+
+    if args.command == 'checkpoint':
+        result = checkpoint()
+        print(f"[PROJECTION] Checkpoint au log {result['last_log_id']} ({result['replayed']} logs integres)")
+        return 0
+
+    result = verify(args.archive)
+    print(f"[PROJECTION] {result['rooms']} salles reconstruites depuis les logs")
+    for room in result['missing']:
+        print(f"  absente de la projection: {room}")
+    for room in result['extra']:
+        print(f"  absente des logs: {room}")
+    for room, diff in sorted(result['different'].items()):
+        details = ', '.join(f"{c}: {p!r} != {r!r}" for c, (p, r) in diff.items())
+        print(f"  {room}: {details}")
+    ok = not (result['missing'] or result['different'])
+    print(f"[PROJECTION] {'OK' if ok else 'ECHEC'}: projection {'identique' if ok else 'divergente'}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Journalisation structuree et metriques Prometheus du backend
+
+Journalisation: les appels logging ne font que deposer l'enregistrement dans
+une file bornee (jamais bloquant: enregistrement perdu et compte si pleine);
+un thread natif ecrit sur stdout, en texte ("... [MQTT] message") ou en JSON
+une ligne par evenement (LOG_FORMAT=json, champs additionnels via
+extra={'fields': {...}}).
+
+Metriques: exposees en format texte Prometheus par la route /metrics.
+Latences par etape d'un evenement (histogramme keybox_stage_latency_seconds):
+    xbee_to_backend   reception XBee (gateway, champ rx_ts) -> reception MQTT
+    ingest_commit     reception MQTT -> commit en base
+    emit              commit -> emission Socket.IO
+"""
+import os
+import sys
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from async_support import native_queue, native_threading
+
+# Journalisation et collecteurs communs avec la gateway (shared/observability.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+import observability  # noqa: E402
+from observability import StatsCollector, register  # noqa: E402,F401
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+MQTT_MESSAGES = Counter('keybox_mqtt_messages', 'Messages MQTT recus', ['kind'])
+EVENTS = Counter('keybox_events', 'Evenements de badge recus', ['state'])
+DUPLICATES = Counter('keybox_duplicates_suppressed', 'Evenements ignores (deja recus)', ['reason'])
+REJECTED = Counter('keybox_events_rejected', 'Payloads rejetes par le decodeur (dead letters)', ['reason'])
+STAGE_LATENCY = Histogram('keybox_stage_latency_seconds', "Latence par etape d'un evenement",
+                          ['stage'], buckets=LATENCY_BUCKETS)
+DB_QUERY = Histogram('keybox_db_query_seconds', 'Duree des appels base de donnees', ['query'],
+                     buckets=LATENCY_BUCKETS)
+SOCKET_CLIENTS = Gauge('keybox_socketio_clients', 'Clients Socket.IO connectes')
+LOG_DROPPED = Counter('keybox_log_records_dropped', 'Enregistrements de log perdus (file pleine)')
+
+
+def setup_logging(level='INFO', fmt='text'):
+    """Configure le logger racine; retourne le listener (stop() a l'arret pour vider la file)
+
+    File et thread d'ecriture natifs: en mode eventlet, les ecritures stdout ne bloquent pas le hub.
+    """
+    return observability.setup_logging(level, fmt, on_drop=LOG_DROPPED.inc,
+                                       queue_module=native_queue, threading_module=native_threading)
+
+
+def observe_since(stage, start):
+    STAGE_LATENCY.labels(stage).observe(max(0.0, time.time() - start))
+
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,66 @@
+"""
+Lance plusieurs workers backend (un processus app.py par port)
+
+Chaque worker recoit une part des evenements MQTT via un abonnement partage
+($share/<groupe>/<filtre> pour chaque filtre de shared/topics.py,
+Mosquitto >= 1.6) et relaie ses
+trames Socket.IO aux autres workers par MQTT. Les sessions admin et les
+blocages d'IP sont en base, donc valables sur tous les workers.
+
+Placer un reverse proxy avec affinite de session devant les ports, ex. nginx:
+    upstream keybox { ip_hash; server 127.0.0.1:5001; server 127.0.0.1:5002; }
+
+Usage:
+    python workers.py --workers 4 --base-port 5001
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+
+def spawn(count, base_port, group, extra_env=None):
+    procs = []
+    for i in range(count):
+        env = dict(os.environ, **(extra_env or {}))
+        env.update({'KEYBOX_WORKER_ID': str(i), 'FLASK_PORT': str(base_port + i), 'MQTT_SHARED_GROUP': group})
+        procs.append(subprocess.Popen([sys.executable, APP_PATH], cwd=os.path.dirname(APP_PATH), env=env))
+        print(f"[WORKERS] Worker {i} sur le port {base_port + i} (pid {procs[-1].pid})")
+    return procs
+
+
+def stop(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--base-port', type=int, default=int(os.getenv('FLASK_PORT', 5001)))
+    parser.add_argument('--group', default=os.getenv('MQTT_SHARED_GROUP') or 'keybox')
+    args = parser.parse_args()
+
+    procs = spawn(args.workers, args.base_port, args.group)
+    try:
+        while all(p.poll() is None for p in procs):
+            time.sleep(1)
+        print("[WORKERS] Un worker s'est arrete, arret des autres")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop(procs)
+
+
+if __name__ == '__main__':
+    main()
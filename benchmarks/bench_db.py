@@ -0,0 +1,127 @@
+"""
+Benchmark d'ingestion SQLite: connexion par appel (ancien code) vs pool WAL
+
+Simule le chemin de on_message (ancien code: add_log + update_room_state par
+evenement; actuel: add_log seul, l'etat des salles est derive des logs)
+pendant que des lecteurs admin interrogent get_logs/get_stats en boucle.
+
+Usage:
+    python benchmarks/bench_db.py --events 5000 --readers 4
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), '..', 'backend')
+
+ROOMS = [str(r) for r in range(100, 140)]
+STATES = ('IN', 'OUT', 'SWAP')
+
+
+# --- Ancienne implementation (une connexion par appel) ---
+class LegacyDB:
+    def __init__(self, path):
+        self.path = path
+        conn = sqlite3.connect(path)
+        conn.execute('''CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, room TEXT NOT NULL,
+            state TEXT NOT NULL, key_uid TEXT, key_name TEXT, key_valid INTEGER, message TEXT,
+            is_swap INTEGER DEFAULT 0, is_multi INTEGER DEFAULT 0)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS room_states (
+            room TEXT PRIMARY KEY, state TEXT NOT NULL, key_uid TEXT, key_name TEXT,
+            key_valid INTEGER, last_update TEXT)''')
+        conn.commit()
+        conn.close()
+
+    def add_log(self, room, state, key_uid, key_name, key_valid, message, is_swap=False, is_multi=False):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('''INSERT INTO logs (timestamp, room, state, key_uid, key_name, key_valid, message, is_swap, is_multi)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), room, state, key_uid, key_name,
+                      1 if key_valid else 0, message, 1 if is_swap else 0, 1 if is_multi else 0))
+        conn.commit()
+        conn.close()
+
+    def update_room_state(self, room, state, key_uid, key_name, key_valid):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('''INSERT OR REPLACE INTO room_states (room, state, key_uid, key_name, key_valid, last_update)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (room, state, key_uid, key_name, 1 if key_valid else 0,
+                      datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+        conn.close()
+
+    def get_logs(self, limit=100):
+        conn = sqlite3.connect(self.path, timeout=30)
+        rows = conn.execute('SELECT * FROM logs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        conn.close()
+        return rows
+
+    def get_stats(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        total = conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+        conn.close()
+        return total
+
+
+def load_pooled_db(path):
+    os.environ['KEYBOX_DB_PATH'] = path
+    sys.path.insert(0, BACKEND_DIR)
+    import database
+    return database
+
+
+def run(db, events, readers):
+    stop = threading.Event()
+    reads = [0] * readers
+
+    def reader(i):
+        while not stop.is_set():
+            db.get_logs(limit=200)
+            db.get_stats()
+            reads[i] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,), daemon=True) for i in range(readers)]
+    for t in threads:
+        t.start()
+
+    start = time.perf_counter()
+    for i in range(events):
+        room = ROOMS[i % len(ROOMS)]
+        state = STATES[i % len(STATES)]
+        db.add_log(room, state, 'B4:75:4F:B0', 'Cle', True, 'OK', state == 'SWAP', False)
+        if isinstance(db, LegacyDB):
+            db.update_room_state(room, state, 'B4:75:4F:B0', 'Cle', True)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    for t in threads:
+        t.join()
+    return events / elapsed, sum(reads) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_rate, legacy_reads = run(LegacyDB(os.path.join(tmp, 'legacy.db')), args.events, args.readers)
+        db = load_pooled_db(os.path.join(tmp, 'pooled.db'))
+        pooled_rate, pooled_reads = run(db, args.events, args.readers)
+        db.close()
+
+    print(f"{'mode':<10} {'events/s':>10} {'lectures/s':>12}")
+    print(f"{'legacy':<10} {legacy_rate:>10.0f} {legacy_reads:>12.0f}")
+    print(f"{'pool WAL':<10} {pooled_rate:>10.0f} {pooled_reads:>12.0f}")
+    print(f"Gain ingestion: x{pooled_rate / legacy_rate:.1f} ({args.readers} lecteurs admin)")
+
+
+if __name__ == '__main__':
+    main()
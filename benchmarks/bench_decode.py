@@ -0,0 +1,206 @@
+"""
+Benchmark du decodage des evenements: ancien chemin (dict ad hoc) vs shared/events.py
+
+Deux mesures, sur un melange de trames du firmware (IN valide, IN dans la
+mauvaise salle, OUT "N/A", SWAP, ALERT "MULTI:...", quelques trames invalides):
+    - gateway: trame texte XBee -> payload (ancien parse_frame vs events.from_text)
+    - backend: message MQTT -> evenement verifie pret pour la file d'ecriture
+      (ancien on_message: json.loads + startswith/split + verify_key + payload.update,
+      vs events.from_payload + KeyRegistry.verify precalcule par couple (salle, cle))
+
+Les resultats de verification (valide, nom, message) des deux chemins sont
+compares sur les trames valides. Le registre des cles est une base temporaire
+amorcee avec backend/corresponding_table.json.
+
+Usage:
+    python benchmarks/bench_decode.py --events 200000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+sys.path.insert(0, os.path.join(ROOT, 'shared'))
+import events  # noqa: E402
+
+ROOMS = [str(r) for r in range(200, 240)]
+
+
+def frames(count):
+    """Trames texte du firmware, dans un ordre fixe (une invalide sur 50)"""
+    templates = [
+        lambda room: {'room': '206', 'key': 'B4:75:4F:B0', 'state': 'IN'},
+        lambda room: {'room': room, 'key': '16:E3:04:02', 'state': 'IN'},
+        lambda room: {'room': room, 'key': 'N/A', 'state': 'OUT'},
+        lambda room: {'room': room, 'key': 'AA:BB:CC:DD', 'state': 'SWAP'},
+        lambda room: {'room': room, 'key': 'MULTI:B4:75:4F:B0,16:E3:04:02', 'state': 'ALERT'},
+    ]
+    result = []
+    for i in range(count):
+        if i % 50 == 49:
+            result.append('{"room": "206", "state": "ALERT"}' if i % 100 == 99 else 'bruit serie')
+        elif i % 10 == 9:
+            result.append(f'{ROOMS[i % len(ROOMS)]}:OUT')
+        else:
+            result.append(json.dumps(templates[i % len(templates)](ROOMS[i % len(ROOMS)])))
+    return result
+
+
+# --- Ancien code (gateway/xbee_handler.py et backend/app.py avant le decodeur commun) ---
+def legacy_parse_frame(sender, data_raw):
+    try:
+        payload = json.loads(data_raw)
+        if isinstance(payload, dict):
+            payload['xbee_id'] = sender
+            return payload
+    except json.JSONDecodeError:
+        pass
+    if ":" in data_raw:
+        parts = data_raw.split(":")
+        if len(parts) >= 2:
+            return {"room": parts[0], "state": parts[1], "xbee_id": sender}
+    return {"raw": data_raw, "xbee_id": sender}
+
+
+def legacy_verify_key(registry, room, key):
+    if key == 'N/A':
+        return {'valid': False, 'message': f"Aucune cle salle {room}", 'key_name': None}
+    info = registry.lookup(key)
+    if info is None:
+        return {'valid': False, 'message': f"Cle inconnue '{key}'", 'key_name': None}
+    if info['room'] == room:
+        return {'valid': True, 'message': f"OK - {info['name']}", 'key_name': info['name']}
+    return {'valid': False, 'message': f"ERREUR - {info['name']} (salle {info['room']})", 'key_name': info['name']}
+
+
+def legacy_handle(registry, raw):
+    try:
+        payload = json.loads(raw.decode())
+    except Exception:
+        return None
+    try:
+        room, key, state = payload.get('room'), payload.get('key'), payload.get('state')
+        is_swap, is_multi = False, False
+        if state == "ALERT" and key.startswith("MULTI:"):
+            uids = key.replace("MULTI:", "").split(",")
+            is_multi = True
+            payload.update({
+                'key_valid': False, 'key_name': f"{len(uids)} badges",
+                'verification_message': f"ALERTE: {len(uids)} badges!", 'multi_badge': True
+            })
+        elif state == "SWAP":
+            is_swap = True
+            v = legacy_verify_key(registry, room, key)
+            payload.update({
+                'key_valid': v['valid'], 'key_name': v['key_name'],
+                'verification_message': f"SWAP! {v['message']}", 'swap_detected': True
+            })
+        else:
+            v = legacy_verify_key(registry, room, key)
+            payload.update({
+                'key_valid': v['valid'], 'key_name': v['key_name'],
+                'verification_message': v['message']
+            })
+        return {'room': room, 'state': state, 'key_uid': key, 'key_name': payload.get('key_name'),
+                'key_valid': payload.get('key_valid'), 'message': payload.get('verification_message'),
+                'is_swap': is_swap, 'is_multi': is_multi, 'event_id': payload.get('eid'), 'payload': payload}
+    except Exception:
+        # Ancien comportement: erreur journalisee, evenement perdu
+        return None
+
+
+# --- Chemin actuel (meme code que handle_event, sans file ni journalisation) ---
+def decoder_handle(registry, raw):
+    try:
+        event = events.from_payload(raw)
+    except events.DecodeError:
+        return None
+    if event.uids is not None:
+        event.key_name = f"{len(event.uids)} badges"
+        event.message = f"ALERTE: {len(event.uids)} badges!"
+    else:
+        event.key_valid, event.key_name, event.message = registry.verify(event.room, event.key)
+        if event.state == 'SWAP':
+            event.message = f"SWAP! {event.message}"
+    return {'room': event.room, 'state': event.state, 'key_uid': event.key, 'key_name': event.key_name,
+            'key_valid': event.key_valid, 'message': event.message,
+            'is_swap': event.is_swap, 'is_multi': event.is_multi, 'event_id': event.eid, 'event': event}
+
+
+def decoder_parse(sender, text):
+    try:
+        return events.from_text(text, sender).to_dict()
+    except events.DecodeError:
+        return None
+
+
+def timed(fn, items, *args):
+    start = time.perf_counter()
+    for item in items:
+        fn(*args, item)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help='meilleur temps sur N passes')
+    args = parser.parse_args()
+
+    texts = frames(args.events)
+    sender = '0013A20041B2C3D4'
+    # Messages MQTT tels que publies par la gateway (trames valides pour le firmware actuel)
+    messages = []
+    for text in texts:
+        try:
+            event = events.from_text(text, sender)
+        except events.DecodeError:
+            messages.append(json.dumps({'raw': text, 'xbee_id': sender}).encode())
+            continue
+        event.rx_ts, event.eid = time.time(), f'bench-{len(messages)}'
+        messages.append(json.dumps(event.to_dict()).encode())
+    # Ancien firmware: ALERT sans cle (plantait sur startswith, evenement perdu sans trace)
+    messages[99::100] = [b'{"room": "206", "state": "ALERT"}'] * len(messages[99::100])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['KEYBOX_DB_PATH'] = os.path.join(tmp, 'keybox.db')
+        sys.path.insert(0, BACKEND_DIR)
+        import key_registry
+        registry = key_registry.KeyRegistry(check_interval=3600).init(
+            seed_path=os.path.join(BACKEND_DIR, 'corresponding_table.json'))
+
+        # Memes resultats de verification sur les evenements acceptes par les deux chemins
+        mismatches = 0
+        for raw in messages:
+            old, new = legacy_handle(registry, raw), decoder_handle(registry, raw)
+            if old and new and any(old[f] != new[f] for f in ('key_valid', 'key_name', 'message',
+                                                               'is_swap', 'is_multi')):
+                mismatches += 1
+        rejected = sum(decoder_handle(registry, raw) is None for raw in messages)
+        lost = sum(legacy_handle(registry, raw) is None for raw in messages)
+
+        rows = []
+        for label, old_fn, new_fn, items, extra in (
+                ('gateway (texte -> payload)', legacy_parse_frame, decoder_parse, texts, (sender,)),
+                ('backend (MQTT -> evenement)', legacy_handle, decoder_handle, messages, (registry,))):
+            # Passes alternees (meme charge machine pour les deux chemins), meilleur temps
+            runs = [(timed(old_fn, items, *extra), timed(new_fn, items, *extra)) for _ in range(args.repeat)]
+            rows.append((label, min(r[0] for r in runs), min(r[1] for r in runs)))
+        from database import close
+        close()
+
+    n = len(texts)
+    print(f"{'etape':<30} {'ancien us/evt':>14} {'decodeur us/evt':>16} {'gain':>6}")
+    for label, old_s, new_s in rows:
+        print(f"{label:<30} {old_s / n * 1e6:>14.2f} {new_s / n * 1e6:>16.2f} {old_s / new_s:>5.1f}x")
+    print(f"Rejetes par le decodeur (dead letters): {rejected}; perdus sans trace par l'ancien code: {lost}")
+    print(f"{'OK' if not mismatches else 'ECHEC'}: {mismatches} verifications differentes")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Verifie via EXPLAIN QUERY PLAN qu'aucun filtre de get_logs ni aucune requete
+d'analytics.py ne parcourt toute la table
+
+Remplit une base temporaire avec une repartition realiste d'evenements, puis
+echoue (code 1) si un plan contient 'SCAN logs'.
+
+Usage:
+    python benchmarks/check_query_plans.py
+"""
+import os
+import random
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), '..', 'backend')
+
+CASES = [
+    {'filter_type': 'in'},
+    {'filter_type': 'out'},
+    {'filter_type': 'swap'},
+    {'filter_type': 'alert'},
+    {'room': '120'},
+    {'key_uid': 'B4:75:4F:B0'},
+    {'since': '2026-01-01 00:00:00', 'until': '2026-12-31 23:59:59'},
+    {'filter_type': 'alert', 'before_id': 5000},
+    {'filter_type': 'out', 'room': '120', 'before_id': 5000},
+    {'room': '120', 'since': '2026-01-01 00:00:00'},
+    {'before_id': 5000},
+]
+ANALYTICS_PARAMS = {'since': '2026-01-01 00:00:00', 'until': '2026-12-31 23:59:59', 'room': '120'}
+
+
+def analytics_queries(analytics):
+    """[(libelle, requete)] des requetes d'analytics, avec et sans filtre de salle"""
+    queries = [('room_summary', analytics.SQL_ROOM_SUMMARY)]
+    for room_clause in ('', 'AND room = :room'):
+        label = ' room' if room_clause else ''
+        queries.append(('sessions' + label, analytics.SESSIONS_CTE.format(room_clause=room_clause) +
+                        'SELECT * FROM sessions'))
+        for bucket, expr in analytics.BUCKETS.items():
+            queries.append((f'histogram {bucket}{label}',
+                            analytics.SQL_BUCKET_COUNTS.format(bucket=expr, room_clause=room_clause)))
+    return queries
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['KEYBOX_DB_PATH'] = os.path.join(tmp, 'plans.db')
+        sys.path.insert(0, BACKEND_DIR)
+        import database as db
+        import analytics
+
+        events = []
+        for i in range(20000):
+            state = random.choices(['IN', 'OUT', 'SWAP', 'ALERT'], [48, 48, 3, 1])[0]
+            events.append({'room': str(100 + i % 50), 'state': state, 'key_uid': f'K{i % 60}',
+                           'is_swap': state == 'SWAP', 'is_multi': state == 'ALERT'})
+        db.add_events(events)
+
+        failures = 0
+        with db.connection() as conn:
+            for analyzed in (False, True):
+                if analyzed:
+                    conn.execute('ANALYZE')
+                for case in CASES:
+                    query, params = db.build_logs_query(200, **case)
+                    plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+                    scan = any(step.startswith('SCAN logs') for step in plan)
+                    failures += scan
+                    print(f"{'ECHEC' if scan else 'OK':<6} {case} -> {' | '.join(plan)}")
+                for label, query in analytics_queries(analytics):
+                    plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, ANALYTICS_PARAMS)]
+                    scan = any(step.startswith('SCAN logs') for step in plan)
+                    failures += scan
+                    print(f"{'ECHEC' if scan else 'OK':<6} {label} -> {' | '.join(plan)}")
+        db.close()
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
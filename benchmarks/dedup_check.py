@@ -0,0 +1,124 @@
+"""
+Verification de la suppression des doublons a l'ingestion
+
+Lance N workers backend sur une base temporaire puis verifie que:
+    - un evenement publie deux fois (meme eid, retransmission QoS 1 ou rejeu
+      du spool) n'est ecrit qu'une fois, quel que soit le worker qui le recoit
+    - un etat retenu sans eid (ancienne gateway) n'est pas journalise a l'abonnement
+    - un etat retenu avec eid manque pendant l'arret du backend est journalise
+      une fois, et n'est pas rejournalise au redemarrage suivant
+
+Usage:
+    python benchmarks/dedup_check.py --workers 2 --events 100 --fake-broker
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+import workers  # noqa: E402
+from multi_worker_check import wait_http  # noqa: E402
+
+DUPLICATES = re.compile(r'^keybox_duplicates_suppressed_total\{reason="(\w+)"\} ([0-9.]+)', re.M)
+
+
+def start_backend(args, env):
+    procs = workers.spawn(args.workers, args.base_port, 'keybox_dedup', env)
+    urls = [f'http://localhost:{args.base_port + i}' for i in range(args.workers)]
+    if not all(wait_http(url) for url in urls):
+        raise RuntimeError("workers non demarres")
+    time.sleep(1)
+    return procs, urls
+
+
+def duplicates(urls):
+    totals = {}
+    for url in urls:
+        body = urllib.request.urlopen(f'{url}/metrics').read().decode()
+        for reason, value in DUPLICATES.findall(body):
+            totals[reason] = totals.get(reason, 0) + int(float(value))
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--base-port', type=int, default=5151)
+    parser.add_argument('--mqtt-port', type=int, default=1883)
+    parser.add_argument('--fake-broker', action='store_true')
+    args = parser.parse_args()
+
+    procs, broker, publisher = [], None, None
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {'KEYBOX_DB_PATH': os.path.join(tmp, 'keybox.db'), 'MQTT_USE_TLS': 'false',
+               'MQTT_PORT': str(args.mqtt_port), 'MQTT_BROKER': 'localhost'}
+        try:
+            if args.fake_broker:
+                broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_broker.py'),
+                                           '--port', str(args.mqtt_port)])
+                time.sleep(1)
+            publisher = mqtt.Client(CallbackAPIVersion.VERSION2, 'Dedup_Check')
+            publisher.connect('localhost', args.mqtt_port, 60)
+            publisher.loop_start()
+
+            def publish(room, state, eid=None, retain=False):
+                payload = {'room': room, 'key': 'N/A', 'state': state}
+                if eid:
+                    payload['eid'] = eid
+                publisher.publish(f'ecole/salles/{room}/status', json.dumps(payload), qos=1,
+                                  retain=retain).wait_for_publish()
+
+            # Etats retenus publies backend arrete
+            publish('DDLEGACY', 'OUT', retain=True)
+            publish('DDMISSED', 'OUT', eid='check-retained-1', retain=True)
+
+            procs, urls = start_backend(args, env)
+            for i in range(args.events):
+                for _ in range(2):
+                    publish(f'DD{i}', 'OUT', eid=f'check-{i}')
+            time.sleep(2)
+            first_run = duplicates(urls)
+            workers.stop(procs)
+
+            # Redemarrage: le broker renvoie les etats retenus
+            procs, urls = start_backend(args, env)
+            time.sleep(1)
+            second_run = duplicates(urls)
+
+            logs = json.load(urllib.request.urlopen(f'{urls[0]}/api/logs?limit=10000'))
+            rooms = [log['room'] for log in logs]
+            ok = True
+            events = [r for r in rooms if re.fullmatch(r'DD\d+', r)]
+            once = len(events) == len(set(events)) == args.events
+            ok &= once
+            print(f"{'OK' if once else 'ECHEC'}: {len(events)} logs pour {args.events} evenements publies deux fois")
+            legacy = rooms.count('DDLEGACY') == 0
+            ok &= legacy
+            print(f"{'OK' if legacy else 'ECHEC'}: etat retenu sans eid non journalise")
+            missed = rooms.count('DDMISSED') == 1
+            ok &= missed
+            print(f"{'OK' if missed else 'ECHEC'}: etat retenu manque journalise {rooms.count('DDMISSED')} fois "
+                  f"(attendu 1, apres redemarrage)")
+            print(f"Doublons ignores: 1er demarrage {first_run}, 2e demarrage {second_run}")
+            return 0 if ok else 1
+        finally:
+            if publisher:
+                publisher.loop_stop()
+            workers.stop(procs)
+            if broker:
+                broker.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
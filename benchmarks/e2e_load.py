@@ -0,0 +1,306 @@
+"""
+Banc de charge de bout en bout: salles simulees -> gateway -> broker -> backend -> dashboards
+
+    N salles (machine a etats du firmware: IN / OUT "N/A" / SWAP / ALERT "MULTI:uid1,uid2")
+      -> FakeXBeeDevice -> XBeeService -> [FrameBatcher] -> Spool -> MQTT
+      -> backend (app.py ou N workers) -> M clients Socket.IO
+
+La chaine gateway est montee dans ce processus a partir de ses modules (un
+XBeeDevice reel n'est pas necessaire); le backend tourne dans son propre
+processus sur une base temporaire, avec une cle enregistree par salle.
+
+Mesures: debit genere et ecrit, latence reception XBee -> update_rooms sur
+chaque dashboard (p50/p95/p99), latences par etape (/metrics), croissance de
+la base et memoire (RSS) du backend. --output ecrit les resultats en JSON;
+--max-p95-ms / --min-delivery font echouer le script (code 1) en cas de
+regression.
+
+Usage:
+    python benchmarks/e2e_load.py --fake-broker --rooms 50 --rate 200 --duration 20 --clients 50
+    python benchmarks/e2e_load.py --fake-broker --batch-ms 100 --encoding msgpack --workers 2
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import paho.mqtt.client as mqtt
+import socketio
+from paho.mqtt.client import CallbackAPIVersion
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+sys.path.insert(0, os.path.join(ROOT, 'gateway'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import workers  # noqa: E402
+from batcher import FrameBatcher  # noqa: E402
+from fake_xbee import FakeXBeeDevice  # noqa: E402
+from spool import Spool  # noqa: E402
+from xbee_handler import XBeeService, event_id_prefix  # noqa: E402
+
+
+def room_key(i):
+    return ':'.join(f'{b:02X}' for b in (0xE0, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF))
+
+
+class SimRoom:
+    """Reproduit les envois de sendKeyEvent() d'une KeyBox"""
+    def __init__(self, index, rooms):
+        self.room = str(100 + index)
+        self.key = room_key(index)
+        self.foreign = room_key((index + 1) % rooms)
+        self.address = f'0013A2004{index:07X}'
+        self.uid = None
+
+    def next_event(self, rng):
+        if self.uid is None:
+            self.uid = self.key if rng.random() < 0.9 else self.foreign
+            return {'room': self.room, 'key': self.uid, 'state': 'IN'}
+        r = rng.random()
+        if r < 0.7:
+            self.uid = None
+            return {'room': self.room, 'key': 'N/A', 'state': 'OUT'}
+        if r < 0.85:
+            self.uid = self.foreign if self.uid == self.key else self.key
+            return {'room': self.room, 'key': self.uid, 'state': 'SWAP'}
+        return {'room': self.room, 'key': f'MULTI:{self.uid},{self.foreign}', 'state': 'ALERT'}
+
+
+class LatencyTracker:
+    """Associe chaque mise a jour recue au dernier evenement envoye correspondant (salle, etat, cle)"""
+    def __init__(self):
+        self.sent = {}
+        self.latencies = []
+        self.received = 0
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def on_sent(self, payload):
+        with self._lock:
+            self.sent.setdefault(payload['room'], []).append((payload['state'], payload['key'], payload['rx_ts']))
+
+    def on_update(self, client_id, entry, now):
+        with self._lock:
+            self.received += 1
+            events = self.sent.get(entry['room'], [])
+            cursor = self._cursors.get((client_id, entry['room']), 0)
+            for i in range(len(events) - 1, cursor - 1, -1):
+                state, key, sent_at = events[i]
+                if state == entry['state'] and key == entry['key']:
+                    self.latencies.append((now - sent_at) * 1000)
+                    self._cursors[(client_id, entry['room'])] = i + 1
+                    return
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def db_size_mb(path):
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p)) / 1e6
+
+
+def get_json(url):
+    return json.load(urllib.request.urlopen(url, timeout=5))
+
+
+def wait_http(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return True
+        except Exception:
+            time.sleep(0.3)
+    return False
+
+
+def stage_latencies(url):
+    """Moyennes par etape depuis keybox_stage_latency_seconds (sum / count)"""
+    text = urllib.request.urlopen(f'{url}/metrics', timeout=5).read().decode()
+    sums, counts = {}, {}
+    for name, stage, value in re.findall(r'keybox_stage_latency_seconds_(sum|count)\{stage="(\w+)"\} (\S+)', text):
+        (sums if name == 'sum' else counts)[stage] = float(value)
+    return {stage: sums[stage] / counts[stage] * 1000 for stage in counts if counts[stage]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=200, help='evenements/s (toutes salles)')
+    parser.add_argument('--duration', type=float, default=20, help='secondes de generation')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1, help='workers backend (>1: abonnement partage)')
+    parser.add_argument('--async-mode', default='eventlet', choices=('threading', 'eventlet'))
+    parser.add_argument('--batch-ms', type=int, default=0, help='envoi groupe de la gateway (0 = par trame)')
+    parser.add_argument('--encoding', default='json', choices=('json', 'msgpack'))
+    parser.add_argument('--base-port', type=int, default=5201)
+    parser.add_argument('--mqtt-port', type=int, default=18832)
+    parser.add_argument('--fake-broker', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='fichier JSON des resultats')
+    parser.add_argument('--max-p95-ms', type=float, help='echec si la latence p95 depasse ce seuil')
+    parser.add_argument('--min-delivery', type=float, default=1.0, help='part minimale des evenements ecrits')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rooms = [SimRoom(i, args.rooms) for i in range(args.rooms)]
+    total = int(args.rate * args.duration)
+    frames = []
+    for _ in range(total):
+        room = rng.choice(rooms)
+        frames.append((room.address, json.dumps(room.next_event(rng)).encode()))
+
+    procs, broker, clients = [], None, []
+    service = spool = batcher = gw_client = None
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'keybox.db')
+        env = {'KEYBOX_DB_PATH': db_path, 'MQTT_USE_TLS': 'false', 'MQTT_BROKER': 'localhost',
+               'MQTT_PORT': str(args.mqtt_port), 'KEYBOX_ASYNC_MODE': args.async_mode,
+               'LOG_LEVEL': 'WARNING', 'LOG_RETENTION_DAYS': '0'}
+        try:
+            # Une cle valide par salle dans le registre du backend
+            keys_csv = os.path.join(tmp, 'keys.csv')
+            with open(keys_csv, 'w') as f:
+                f.write('uid,salle,nom_cle\n')
+                f.writelines(f'{r.key},{r.room},Cle {r.room}\n' for r in rooms)
+            subprocess.run([sys.executable, os.path.join(ROOT, 'backend', 'key_registry.py'), 'import', keys_csv],
+                           cwd=os.path.join(ROOT, 'backend'), env=dict(os.environ, **env), check=True,
+                           stdout=subprocess.DEVNULL)
+
+            if args.fake_broker:
+                broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_broker.py'),
+                                           '--port', str(args.mqtt_port)], stdout=subprocess.DEVNULL)
+                time.sleep(1)
+            if args.workers > 1:
+                procs = workers.spawn(args.workers, args.base_port, 'keybox_e2e', env)
+            else:
+                procs = [subprocess.Popen([sys.executable, workers.APP_PATH], cwd=os.path.dirname(workers.APP_PATH),
+                                          env=dict(os.environ, **env, FLASK_PORT=str(args.base_port)))]
+            urls = [f'http://localhost:{args.base_port + i}' for i in range(len(procs))]
+            if not all(wait_http(url) for url in urls):
+                print("ECHEC: backend non demarre")
+                return 1
+            db_start, rss_start = db_size_mb(db_path), sum(rss_mb(p.pid) for p in procs)
+
+            # Dashboards
+            tracker = LatencyTracker()
+            for i in range(args.clients):
+                sio = socketio.Client(reconnection=False)
+                sio.on('update_rooms', lambda frame, i=i: [tracker.on_update(i, e, time.time())
+                                                           for e in frame['rooms']])
+                sio.connect(urls[i % len(urls)], transports=['websocket'])
+                clients.append(sio)
+
+            # Chaine gateway
+            gw_client = mqtt.Client(CallbackAPIVersion.VERSION2, 'E2E_Gateway')
+            spool = Spool(gw_client, os.path.join(tmp, 'spool.db'), replay_rate=0, max_inflight=100)
+            gw_client.on_connect = lambda c, u, f, rc, p: spool.on_connect()
+            gw_client.on_disconnect = lambda c, u, f, rc, p: spool.on_disconnect()
+            gw_client.on_publish = lambda c, u, mid, rc, p: spool.on_publish(mid)
+            gw_client.connect('localhost', args.mqtt_port, 60)
+            gw_client.loop_start()
+            spool.start()
+            if args.batch_ms:
+                batcher = FrameBatcher(spool.append, 'E2E_Gateway', args.batch_ms / 1000, 100, args.encoding).start()
+
+            def relay(payload):
+                tracker.on_sent(payload)
+                if batcher:
+                    batcher.add(payload)
+                else:
+                    spool.append(f"ecole/salles/{payload['room']}/status", json.dumps(payload), 1, True)
+
+            device = FakeXBeeDevice()
+            service = XBeeService('FAKE', 9600, relay, workers=4, device=device,
+                                  event_prefix=event_id_prefix('E2E_Gateway'))
+            service.start()
+            time.sleep(1)
+
+            start = time.time()
+            device.replay(frames, args.rate).join()
+            generated_in = time.time() - start
+            written, deadline = 0, time.time() + 30
+            while time.time() < deadline:
+                written = sum(get_json(f'{url}/api/ingest/stats')['written'] for url in urls)
+                if written >= total:
+                    break
+                time.sleep(0.2)
+            committed_in = time.time() - start
+            time.sleep(1)  # derniere fenetre de diffusion
+
+            stages = stage_latencies(urls[0])
+            results = {
+                'rooms': args.rooms, 'events': total, 'clients': len(clients), 'workers': len(procs),
+                'async_mode': args.async_mode, 'batch_ms': args.batch_ms, 'encoding': args.encoding,
+                'generated_rate': total / generated_in, 'written': written,
+                'written_rate': written / committed_in, 'delivery': written / total if total else 1.0,
+                'updates_received': tracker.received,
+                'latency_ms': {p: percentile(tracker.latencies, p) for p in (50, 95, 99)},
+                'latency_max_ms': max(tracker.latencies) if tracker.latencies else float('nan'),
+                'stage_avg_ms': stages,
+                'xbee': service.stats(), 'spool': spool.stats(),
+                'db_growth_mb': db_size_mb(db_path) - db_start,
+                'db_bytes_per_event': (db_size_mb(db_path) - db_start) * 1e6 / max(written, 1),
+                'backend_rss_mb': sum(rss_mb(p.pid) for p in procs), 'backend_rss_start_mb': rss_start,
+            }
+
+            print(f"Salles={args.rooms} evenements={total} dashboards={len(clients)} workers={len(procs)} "
+                  f"mode={args.async_mode} lots={args.batch_ms}ms/{args.encoding}")
+            print(f"Debit : genere {results['generated_rate']:.0f}/s, ecrit {written}/{total} "
+                  f"({results['written_rate']:.0f}/s)")
+            lat = results['latency_ms']
+            print(f"Latence XBee -> dashboard : p50={lat[50]:.0f}ms p95={lat[95]:.0f}ms p99={lat[99]:.0f}ms "
+                  f"max={results['latency_max_ms']:.0f}ms ({len(tracker.latencies)} mesures)")
+            print("Etapes (moyenne) : " + ', '.join(f"{k}={v:.1f}ms" for k, v in sorted(stages.items())))
+            print(f"Base : +{results['db_growth_mb']:.2f} Mo ({results['db_bytes_per_event']:.0f} octets/evenement)")
+            print(f"Memoire backend : {rss_start:.0f} -> {results['backend_rss_mb']:.0f} Mo RSS")
+
+            if args.output:
+                with open(args.output, 'w') as f:
+                    json.dump(results, f, indent=2, default=str)
+
+            ok = results['delivery'] >= args.min_delivery
+            if args.max_p95_ms is not None:
+                ok &= lat[95] <= args.max_p95_ms
+            print('OK' if ok else 'ECHEC: seuils depasses')
+            return 0 if ok else 1
+        finally:
+            for sio in clients:
+                sio.disconnect()
+            if service:
+                service.stop()
+            if batcher:
+                batcher.stop()
+            if gw_client:
+                gw_client.loop_stop()
+            if spool:
+                spool.stop()
+            workers.stop(procs)
+            if broker:
+                broker.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+Broker MQTT 3.1.1 minimal (asyncio) pour les tests de charge locaux
+
+Remplace Mosquitto quand il n'est pas installe: CONNECT (sans auth, avec
+testament), SUBSCRIBE avec jokers + et #, abonnements partages
+$share/<groupe>/<filtre>, PUBLISH QoS 0/1, messages retenus, PINGREQ,
+UNSUBSCRIBE, DISCONNECT. Pas de TLS, pas de QoS 2, pas de session persistante.
+Le testament est publie si la connexion se ferme sans DISCONNECT.
+
+Usage:
+    python benchmarks/fake_broker.py --port 1883
+Puis lancer backend/gateway avec MQTT_USE_TLS=false MQTT_PORT=1883.
+"""
+import argparse
+import asyncio
+import itertools
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(pattern, topic):
+    p_parts, t_parts = pattern.split('/'), topic.split('/')
+    for i, p in enumerate(p_parts):
+        if p == '#':
+            return True
+        if i >= len(t_parts) or (p != '+' and p != t_parts[i]):
+            return False
+    return len(p_parts) == len(t_parts)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def packet(ptype, flags, body):
+    return bytes([(ptype << 4) | flags]) + encode_length(len(body)) + body
+
+
+def utf8(s):
+    data = s.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+class Client:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.will = None         # (topic, payload, qos, retain)
+        self.subscriptions = {}  # filtre -> (qos, groupe partage ou None)
+        self._packet_ids = itertools.cycle(range(1, 65536))
+
+    def send_publish(self, topic, payload, qos, retain=False):
+        flags = (qos << 1) | (1 if retain else 0)
+        body = utf8(topic)
+        if qos:
+            body += struct.pack('!H', next(self._packet_ids))
+        self.writer.write(packet(PUBLISH, flags, body + payload))
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def run(self):
+        try:
+            while True:
+                ptype, flags, body = await self.read_packet()
+                if ptype == CONNECT:
+                    name_len = struct.unpack('!H', body[:2])[0]
+                    connect_flags = body[2 + name_len + 1]
+                    pos = 2 + name_len + 4  # nom protocole, niveau, flags, keepalive
+                    id_len = struct.unpack('!H', body[pos:pos + 2])[0]
+                    self.client_id = body[pos + 2:pos + 2 + id_len].decode()
+                    pos += 2 + id_len
+                    if connect_flags & 0x04:
+                        topic_len = struct.unpack('!H', body[pos:pos + 2])[0]
+                        will_topic = body[pos + 2:pos + 2 + topic_len].decode()
+                        pos += 2 + topic_len
+                        msg_len = struct.unpack('!H', body[pos:pos + 2])[0]
+                        self.will = (will_topic, body[pos + 2:pos + 2 + msg_len],
+                                     min((connect_flags >> 3) & 0x03, 1), bool(connect_flags & 0x20))
+                    self.writer.write(packet(CONNACK, 0, b'\x00\x00'))
+                elif ptype == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_len = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_len].decode()
+                    pos = 2 + topic_len
+                    if qos:
+                        packet_id = body[pos:pos + 2]
+                        pos += 2
+                        self.writer.write(packet(PUBACK, 0, packet_id))
+                    self.broker.publish(topic, body[pos:], qos, bool(flags & 0x01))
+                elif ptype == SUBSCRIBE:
+                    packet_id, pos, granted = body[:2], 2, bytearray()
+                    while pos < len(body):
+                        f_len = struct.unpack('!H', body[pos:pos + 2])[0]
+                        topic_filter = body[pos + 2:pos + 2 + f_len].decode()
+                        qos = min(body[pos + 2 + f_len], 1)
+                        pos += 3 + f_len
+                        granted.append(qos)
+                        self.broker.subscribe(self, topic_filter, qos)
+                    self.writer.write(packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif ptype == UNSUBSCRIBE:
+                    packet_id, pos = body[:2], 2
+                    while pos < len(body):
+                        f_len = struct.unpack('!H', body[pos:pos + 2])[0]
+                        self.subscriptions.pop(body[pos + 2:pos + 2 + f_len].decode(), None)
+                        pos += 2 + f_len
+                    self.writer.write(packet(UNSUBACK, 0, packet_id))
+                elif ptype == PINGREQ:
+                    self.writer.write(packet(PINGRESP, 0, b''))
+                elif ptype == DISCONNECT:
+                    self.will = None
+                    break
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.clients.discard(self)
+            self.writer.close()
+            if self.will:
+                self.broker.publish(*self.will)
+
+
+class FakeBroker:
+    def __init__(self):
+        self.clients = set()
+        self.retained = {}
+        self._share_cursor = {}
+        self.published = 0
+
+    def subscribe(self, client, topic_filter, qos):
+        group = None
+        if topic_filter.startswith('$share/'):
+            _, group, topic_filter = topic_filter.split('/', 2)
+        client.subscriptions[topic_filter] = (qos, group)
+        for topic, (payload, r_qos) in self.retained.items():
+            if topic_matches(topic_filter, topic):
+                client.send_publish(topic, payload, min(qos, r_qos), retain=True)
+
+    def publish(self, topic, payload, qos, retain):
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        shared = {}
+        for client in list(self.clients):
+            for topic_filter, (sub_qos, group) in client.subscriptions.items():
+                if topic_matches(topic_filter, topic):
+                    if group:
+                        shared.setdefault((group, topic_filter), []).append((client, sub_qos))
+                    else:
+                        client.send_publish(topic, payload, min(qos, sub_qos))
+                    break
+        # Abonnements partages: un seul membre du groupe recoit (round robin)
+        for key, members in shared.items():
+            index = self._share_cursor.get(key, 0) % len(members)
+            self._share_cursor[key] = index + 1
+            client, sub_qos = members[index]
+            client.send_publish(topic, payload, min(qos, sub_qos))
+
+    async def handle(self, reader, writer):
+        client = Client(self, reader, writer)
+        self.clients.add(client)
+        await client.run()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"[BROKER] Ecoute sur {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    try:
+        asyncio.run(FakeBroker().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+XBeeDevice de substitution: rejoue des trames a haut debit sans materiel
+
+FakeXBeeDevice expose ce qu'utilise gateway/xbee_handler.py (open, close,
+is_open, serial_port, add_data_received_callback) et appelle les callbacks
+depuis son propre thread "lecteur", comme digi-xbee.
+
+En script: rejoue des trames de plusieurs salles dans XBeeService avec un
+callback lent (publication simulee) et affiche le temps passe dans le thread
+lecteur, les compteurs du service et la verification de l'ordre par module.
+
+Usage:
+    python benchmarks/fake_xbee.py --senders 20 --frames 20000 --callback-ms 2
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class FakeRemote:
+    def __init__(self, address):
+        self.address = address
+
+    def get_64bit_addr(self):
+        return self.address
+
+
+class FakeMessage:
+    def __init__(self, remote_device, data):
+        self.remote_device = remote_device
+        self.data = data
+
+
+class FakeXBeeDevice:
+    def __init__(self, port='FAKE', baud_rate=9600):
+        self.serial_port = port
+        self._open = False
+        self._callbacks = []
+        self.reader_seconds = 0.0
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def is_open(self):
+        return self._open
+
+    def add_data_received_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def replay(self, frames, rate=0):
+        """frames: [(adresse 64 bits, bytes)]; rate en trames/s (0 = au plus vite)"""
+        def run():
+            interval = 1 / rate if rate else 0
+            for address, data in frames:
+                message = FakeMessage(FakeRemote(address), data)
+                start = time.perf_counter()
+                for callback in self._callbacks:
+                    callback(message)
+                self.reader_seconds += time.perf_counter() - start
+                if interval:
+                    time.sleep(interval)
+        thread = threading.Thread(target=run, name='fake-xbee-reader', daemon=True)
+        thread.start()
+        return thread
+
+
+def room_frames(senders, count):
+    """Trames JSON de l'Arduino, reparties sur `senders` modules (champ seq pour l'ordre)"""
+    frames = []
+    for i in range(count):
+        s = i % senders
+        state = 'IN' if (i // senders) % 2 == 0 else 'OUT'
+        data = {'room': str(100 + s), 'key': 'B4:75:4F:B0' if state == 'IN' else 'N/A', 'state': state, 'seq': i}
+        frames.append((f'0013A2004{s:07X}', json.dumps(data).encode()))
+    return frames
+
+
+def main():
+    sys.path.insert(0, os.path.join(ROOT, 'gateway'))
+    from xbee_handler import XBeeService
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--senders', type=int, default=20)
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0, help='trames/s (0 = au plus vite)')
+    parser.add_argument('--callback-ms', type=float, default=2, help='duree simulee de la publication')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--overflow', default='drop_oldest')
+    args = parser.parse_args()
+
+    last_seq, disorder, lock = {}, [0], threading.Lock()
+
+    def callback(payload):
+        with lock:
+            if payload['seq'] < last_seq.get(payload['xbee_id'], -1):
+                disorder[0] += 1
+            last_seq[payload['xbee_id']] = payload['seq']
+        if args.callback_ms:
+            time.sleep(args.callback_ms / 1000)
+
+    device = FakeXBeeDevice()
+    service = XBeeService('FAKE', 9600, callback, args.workers, args.queue_size, args.overflow,
+                          device=device)
+    service.start()
+    start = time.perf_counter()
+    device.replay(room_frames(args.senders, args.frames), args.rate).join()
+    reader_elapsed = time.perf_counter() - start
+    while service.stats()['queue_depth']:
+        time.sleep(0.05)
+    service.stop()
+    total = time.perf_counter() - start
+    stats = service.stats()
+
+    print(f"Trames rejouees : {args.frames} depuis {args.senders} modules en {reader_elapsed:.2f}s "
+          f"(thread lecteur: {device.reader_seconds / args.frames * 1e6:.1f} us/trame)")
+    print(f"Recues={stats['received']} traitees={stats['parsed']} perdues={stats['dropped']} "
+          f"erreurs={stats['errors']} en {total:.2f}s")
+    print(f"Latence en file : moyenne={stats['latency_avg_ms']:.1f}ms max={stats['latency_max_ms']:.1f}ms")
+    ok = disorder[0] == 0 and stats['received'] == args.frames and \
+        stats['parsed'] + stats['dropped'] == stats['received']
+    print(f"{'OK' if ok else 'ECHEC'}: ordre par module {'respecte' if not disorder[0] else f'viole {disorder[0]} fois'}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
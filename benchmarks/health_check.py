@@ -0,0 +1,215 @@
+"""
+Verification locale de la sante des gateways et de la vivacite des boitiers
+
+Lance le backend (NODE_SILENT_AFTER_S court) et une gateway simulee dans un
+processus enfant: XBeeService sur un FakeXBeeDevice, rapport de sante
+(gateway/health.py) toutes les secondes et testament MQTT. Quatre boitiers:
+deux emettent en continu, un se tait apres quelques trames, un n'envoie que
+des trames invalides. Un client admin Socket.IO recoit les 'admin_liveness'
+pousses par le serveur (aucune interrogation periodique) et verifie que:
+    - la gateway passe 'online', ses boitiers apparaissent avec leur salle
+    - le boitier muet est signale 'silent' environ NODE_SILENT_AFTER_S apres
+      sa derniere trame; les autres restent 'ok'; les trames invalides sont comptees
+    - gateway suspendue (SIGSTOP): 'stale' apres GATEWAY_STALE_FACTOR intervalles,
+      puis de nouveau 'online' (SIGCONT)
+    - gateway tuee (SIGKILL): 'offline' par le testament MQTT, boitiers 'unknown'
+
+Usage:
+    python benchmarks/health_check.py --fake-broker
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import paho.mqtt.client as mqtt
+import socketio
+from paho.mqtt.client import CallbackAPIVersion
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+sys.path.insert(0, os.path.join(ROOT, 'gateway'))
+sys.path.insert(0, os.path.join(ROOT, 'shared'))
+import workers  # noqa: E402
+import topics  # noqa: E402
+from multi_worker_check import wait_http  # noqa: E402
+
+SITE = 'lyon'
+GATEWAY_ID = 'Health_Check_Gateway'
+NODES = {'0013A20000000001': '101', '0013A20000000002': '102', '0013A20000000003': '103',
+         '0013A20000000004': '104'}
+QUIET, NOISY_INVALID = '0013A20000000003', '0013A20000000004'
+
+
+def run_gateway(args):
+    """Processus enfant: gateway simulee jusqu'a son arret (signal)"""
+    from fake_xbee import FakeXBeeDevice
+    from health import HealthReporter
+    from xbee_handler import XBeeService, event_id_prefix
+
+    client = mqtt.Client(CallbackAPIVersion.VERSION2, GATEWAY_ID)
+    topic = topics.health_topic(SITE, GATEWAY_ID)
+    health = HealthReporter(client.publish, topic, GATEWAY_ID, SITE, args.interval)
+    client.will_set(topic, health.will(), qos=1, retain=True)
+    client.connect('localhost', args.mqtt_port, 60)
+    client.loop_start()
+
+    def publish(payload):
+        client.publish(topics.status_topic(SITE, payload.get('room', 'unknown')), json.dumps(payload), qos=1)
+
+    device = FakeXBeeDevice()
+    xbee = XBeeService(None, 9600, publish, device=device, event_prefix=event_id_prefix(GATEWAY_ID))
+    xbee.start()
+    health.xbee = xbee
+    health.start()
+    count = 0
+    while True:
+        frames = []
+        for address, room in NODES.items():
+            if address == QUIET and count >= 3:
+                continue
+            if address == NOISY_INVALID:
+                frames.append((address, b'\x00bruit'))
+            else:
+                state = 'IN' if count % 2 else 'OUT'
+                frames.append((address, json.dumps({'room': room, 'key': 'N/A', 'state': state}).encode()))
+        device.replay(frames).join()
+        count += 1
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--silent-after', type=float, default=4.0, help='NODE_SILENT_AFTER_S du backend')
+    parser.add_argument('--interval', type=float, default=1.0, help='intervalle des rapports de sante (s)')
+    parser.add_argument('--base-port', type=int, default=5171)
+    parser.add_argument('--mqtt-port', type=int, default=1883)
+    parser.add_argument('--fake-broker', action='store_true')
+    parser.add_argument('--gateway', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.gateway:
+        run_gateway(args)
+        return 0
+
+    procs, broker, gateway, sio = [], None, None, None
+    updates, lock = [], threading.Lock()
+    ok = True
+
+    def check(good, message):
+        nonlocal ok
+        ok &= bool(good)
+        print(f"{'OK' if good else 'ECHEC'}: {message}")
+
+    def wait_for(predicate, timeout):
+        """Attend une mise a jour poussee qui verifie predicate(gateways, nodes); retourne son heure"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with lock:
+                state = ({}, {})
+                for at, update in updates:
+                    state[0].update({g['gateway']: g for g in update.get('gateways', [])})
+                    state[1].update({n['address']: n for n in update.get('nodes', [])})
+                    if predicate(*state):
+                        return at
+            time.sleep(0.1)
+        return None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {'KEYBOX_DB_PATH': os.path.join(tmp, 'keybox.db'), 'MQTT_USE_TLS': 'false',
+               'MQTT_PORT': str(args.mqtt_port), 'MQTT_BROKER': 'localhost',
+               'NODE_SILENT_AFTER_S': str(args.silent_after), 'GATEWAY_STALE_FACTOR': '3'}
+        try:
+            if args.fake_broker:
+                broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_broker.py'),
+                                           '--port', str(args.mqtt_port)])
+                time.sleep(1)
+            procs = workers.spawn(1, args.base_port, '', env)
+            url = f'http://localhost:{args.base_port}'
+            if not wait_http(url):
+                print("ECHEC: backend non demarre")
+                return 1
+
+            sio = socketio.Client()
+            logged_in = threading.Event()
+
+            def on_liveness(update):
+                with lock:
+                    updates.append((time.time(), update))
+            sio.on('admin_liveness', on_liveness)
+            login = {}
+            sio.on('admin_login_response', lambda data: (login.update(data), sio.emit('admin_get_liveness'),
+                                                         logged_in.set()))
+            sio.connect(url, transports=['websocket'])
+            sio.emit('admin_login', {'username': os.getenv('ADMIN_USERNAME', 'admin'),
+                                     'password': os.getenv('ADMIN_PASSWORD', 'admin123')})
+            check(logged_in.wait(5), "connexion admin")
+
+            started = time.time()
+            gateway = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--gateway',
+                                        '--mqtt-port', str(args.mqtt_port), '--interval', str(args.interval)])
+            at = wait_for(lambda g, n: g.get(GATEWAY_ID, {}).get('status') == 'online'
+                          and {n[a].get('room') for a in n} >= set(NODES.values()) - {'104'}, 10)
+            check(at, f"gateway en ligne, boitiers visibles ({at - started:.1f}s)" if at else "gateway en ligne")
+
+            # Le boitier 103 se tait apres 3 tours (~1.5s)
+            at = wait_for(lambda g, n: n.get(QUIET, {}).get('status') == 'silent', args.silent_after + 10)
+            request = urllib.request.Request(f'{url}/api/liveness',
+                                             headers={'Authorization': f"Bearer {login.get('token')}"})
+            quiet = json.load(urllib.request.urlopen(request))
+            node = {n['address']: n for n in quiet['nodes']}
+            if at and QUIET in node:
+                delay = at - node[QUIET]['last_seen']
+                check(args.silent_after <= delay + 0.5 < args.silent_after + 2 * args.interval + 1,
+                      f"boitier muet (salle 103) signale 'silent' {delay:.1f}s apres sa derniere trame "
+                      f"(seuil {args.silent_after:g}s)")
+            else:
+                check(False, "boitier muet signale 'silent'")
+            others = [node.get(a, {}).get('status') for a in NODES if a not in (QUIET, NOISY_INVALID)]
+            check(others == ['ok', 'ok'], f"boitiers actifs toujours 'ok' ({others})")
+            invalid = node.get(NOISY_INVALID, {})
+            check(invalid.get('rejected', 0) > 0 and invalid.get('room') is None,
+                  f"trames invalides comptees par boitier ({invalid.get('rejected')})")
+
+            # Gateway suspendue: plus de rapports, connexion ouverte
+            os.kill(gateway.pid, signal.SIGSTOP)
+            stopped = time.time()
+            at = wait_for(lambda g, n: g.get(GATEWAY_ID, {}).get('status') == 'stale', 10 * args.interval + 5)
+            check(at, f"gateway suspendue 'stale' apres {at - stopped:.1f}s (3 intervalles)" if at
+                  else "gateway suspendue 'stale'")
+            os.kill(gateway.pid, signal.SIGCONT)
+            resumed = time.time()
+            with lock:
+                updates.clear()
+            at = wait_for(lambda g, n: g.get(GATEWAY_ID, {}).get('status') == 'online', 5 * args.interval + 5)
+            check(at, f"gateway reprise 'online' apres {at - resumed:.1f}s" if at else "gateway reprise 'online'")
+
+            # Gateway tuee: testament publie par le broker
+            gateway.kill()
+            gateway.wait()
+            killed = time.time()
+            at = wait_for(lambda g, n: g.get(GATEWAY_ID, {}).get('status') == 'offline'
+                          and all(n.get(a, {}).get('status') == 'unknown' for a in NODES), 5)
+            check(at, f"gateway tuee 'offline' (testament) apres {at - killed:.1f}s, boitiers 'unknown'" if at
+                  else "gateway tuee 'offline' (testament)")
+
+            metrics = urllib.request.urlopen(f'{url}/metrics').read().decode()
+            check('keybox_liveness_gateways_offline 1.0' in metrics, "metriques keybox_liveness_* exposees")
+            return 0 if ok else 1
+        finally:
+            if sio:
+                sio.disconnect()
+            if gateway and gateway.poll() is None:
+                gateway.kill()
+            workers.stop(procs)
+            if broker:
+                broker.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Test de charge des dashboards Socket.IO
+
+Ouvre N clients Socket.IO sur un backend en cours d'execution, mesure le
+temps de connexion (jusqu'au rooms_snapshot), puis publie des evenements
+MQTT et mesure la latence publication -> reception update_rooms sur tous
+les clients.
+
+Exemple (broker de substitution local, sans TLS):
+    python benchmarks/fake_broker.py --port 1883 &
+    cd backend && KEYBOX_ASYNC_MODE=eventlet MQTT_USE_TLS=false MQTT_PORT=1883 python app.py &
+    python benchmarks/load_dashboard.py --url http://localhost:5001 --clients 500
+
+Dependances: python-socketio[client], paho-mqtt.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import socketio
+from paho.mqtt.client import CallbackAPIVersion
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class DashboardClient:
+    def __init__(self, url, sent_at, latencies, lock):
+        self.sio = socketio.Client(reconnection=False)
+        self.url = url
+        self.snapshot = threading.Event()
+        self.connect_ms = None
+        self._start = None
+
+        @self.sio.on('rooms_snapshot')
+        def on_snapshot(data):
+            self.connect_ms = (time.perf_counter() - self._start) * 1000
+            self.snapshot.set()
+
+        @self.sio.on('update_rooms')
+        def on_update(frame):
+            now = time.perf_counter()
+            with lock:
+                for room in frame['rooms']:
+                    t0 = sent_at.get(room.get('key'))
+                    if t0 is not None:
+                        latencies.append((now - t0) * 1000)
+
+    def connect(self):
+        self._start = time.perf_counter()
+        self.sio.connect(self.url, transports=['websocket'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5001')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=10, help='evenements MQTT par seconde')
+    parser.add_argument('--mqtt-host', default='localhost')
+    parser.add_argument('--mqtt-port', type=int, default=1883)
+    args = parser.parse_args()
+
+    sent_at, latencies, lock = {}, [], threading.Lock()
+    clients, failures = [], 0
+    start = time.perf_counter()
+    for _ in range(args.clients):
+        client = DashboardClient(args.url, sent_at, latencies, lock)
+        try:
+            client.connect()
+            clients.append(client)
+        except Exception as e:
+            failures += 1
+            print(f"[LOAD] Connexion refusee: {e}")
+    for client in clients:
+        client.snapshot.wait(10)
+    connect_elapsed = time.perf_counter() - start
+    connect_ms = [c.connect_ms for c in clients if c.connect_ms is not None]
+
+    publisher = mqtt.Client(CallbackAPIVersion.VERSION2, 'Load_Test')
+    publisher.connect(args.mqtt_host, args.mqtt_port, 60)
+    publisher.loop_start()
+    for i in range(args.events):
+        # Cle unique par evenement pour retrouver l'heure d'envoi a la reception
+        room, key = str(100 + i % 40), f'LOAD:{i}'
+        sent_at[key] = time.perf_counter()
+        publisher.publish(f'ecole/salles/{room}/status', json.dumps({'room': room, 'key': key, 'state': 'IN'}), qos=1)
+        time.sleep(1 / args.rate)
+    time.sleep(2)
+    publisher.loop_stop()
+
+    expected = args.events * len(clients)
+    print(f"Clients connectes : {len(clients)}/{args.clients} ({failures} echecs) en {connect_elapsed:.1f}s")
+    if connect_ms:
+        print(f"Connexion -> snapshot : p50={percentile(connect_ms, 50):.0f}ms "
+              f"p95={percentile(connect_ms, 95):.0f}ms max={max(connect_ms):.0f}ms")
+    print(f"Mises a jour recues : {len(latencies)}/{expected} (coalescees par salle)")
+    if latencies:
+        print(f"Latence MQTT -> dashboard : moyenne={statistics.mean(latencies):.0f}ms "
+              f"p50={percentile(latencies, 50):.0f}ms p95={percentile(latencies, 95):.0f}ms "
+              f"p99={percentile(latencies, 99):.0f}ms")
+
+    for client in clients:
+        client.sio.disconnect()
+
+
+if __name__ == '__main__':
+    main()
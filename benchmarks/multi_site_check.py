@@ -0,0 +1,236 @@
+"""
+Verification locale du routage par site (plusieurs gateways, un backend)
+
+Lance le backend sur une base temporaire et simule plusieurs gateways, une
+par site, qui publient toutes la salle "206" (evenements unitaires pour le
+site par defaut, lots FrameBatcher pour les autres), puis verifie que:
+    - chaque site a sa propre salle 206 en base (cles "206", "lyon/206", ...)
+    - un dashboard ne recoit que les salles de son site (snapshot et trames)
+    - /api/sites liste les sites, avec une file d'ecriture par site
+
+Puis un site bruyant publie une rafale de lots pendant qu'un site calme
+publie un evenement toutes les 20 ms: latence publication -> dashboard du
+site calme, ingestion partitionnee par site ou non (--compare: les deux).
+Sur une machine rapide l'ecriture suit la rafale et les deux modes se valent;
+--batch-size (INGEST_BATCH_SIZE) reduit le debit d'ecriture pour simuler un
+disque lent, cas ou la file du site bruyant se remplit.
+
+Broker: Mosquitto sur localhost (--mqtt-port, sans TLS), ou a defaut le
+broker de substitution benchmarks/fake_broker.py (--fake-broker).
+
+Usage:
+    python benchmarks/multi_site_check.py --fake-broker --flood 20000 --batch-size 5 --compare
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import paho.mqtt.client as mqtt
+import socketio
+from paho.mqtt.client import CallbackAPIVersion
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+sys.path.insert(0, os.path.join(ROOT, 'gateway'))
+sys.path.insert(0, os.path.join(ROOT, 'shared'))
+import workers  # noqa: E402
+import topics  # noqa: E402
+from batcher import FrameBatcher  # noqa: E402
+from multi_worker_check import wait_http  # noqa: E402
+
+# Site -> dernier etat publie pour sa salle 206
+SITES = {'default': ('IN', 'B4:75:4F:B0'), 'lyon': ('OUT', 'N/A'), 'paris': ('SWAP', 'AA:BB:CC:DD')}
+
+
+class Gateway:
+    """Gateway simulee d'un site: client MQTT dedie, eid prefixes par gateway"""
+
+    def __init__(self, site, port, batch_ms=0):
+        self.site = site
+        self.gateway_id = f'Check_Gateway_{site}'
+        self.count = 0
+        self.client = mqtt.Client(CallbackAPIVersion.VERSION2, self.gateway_id)
+        self.client.connect('localhost', port, 60)
+        self.client.loop_start()
+        self.batcher = None
+        if batch_ms:
+            self.batcher = FrameBatcher(lambda topic, payload, qos, retain: self.client.publish(
+                topic, payload, qos, retain), self.gateway_id, batch_ms / 1000, 100, 'json', site=site).start()
+
+    def send(self, room, state, key='N/A'):
+        self.count += 1
+        frame = {'room': room, 'key': key, 'state': state, 'eid': f'{self.gateway_id}-{self.count}',
+                 'rx_ts': time.time(), 'xbee_id': f'0013A200{self.site[:8]:0>8}'}
+        if self.batcher:
+            self.batcher.add(frame)
+        else:
+            self.client.publish(topics.status_topic(self.site, room), json.dumps(frame), qos=1)
+
+    def stop(self):
+        if self.batcher:
+            self.batcher.stop()
+        self.client.loop_stop()
+
+
+def dashboard(url, site):
+    """Client Socket.IO d'un site: snapshot recu et salles des trames update_rooms (avec l'heure)"""
+    seen = {'snapshot': None, 'rooms': {}}
+    sio = socketio.Client()
+    sio.on('rooms_snapshot', lambda snapshot: seen.update(snapshot=snapshot))
+
+    def on_update(frame):
+        now = time.time()
+        for entry in frame['rooms']:
+            seen['rooms'].setdefault(entry['room'], now)
+    sio.on('update_rooms', on_update)
+    sio.connect(url, transports=['websocket'], auth={'site': site})
+    return sio, seen
+
+
+def check_routing(args, url):
+    ok = True
+    gateways = [Gateway(site, args.mqtt_port, 0 if site == 'default' else 50) for site in SITES]
+    clients = {site: dashboard(url, site) for site in SITES}
+    time.sleep(1)
+    for gateway in gateways:
+        state, key = SITES[gateway.site]
+        gateway.send('206', 'OUT')
+        gateway.send('206', state, key)
+    for gateway in gateways:
+        gateway.stop()
+    time.sleep(2)
+
+    logs = json.load(urllib.request.urlopen(f'{url}/api/logs?limit=1000'))
+    for site, (state, _) in SITES.items():
+        room = '206' if site == 'default' else f'{site}/206'
+        rows = [log for log in logs if log['room'] == room]
+        good = len(rows) == 2 and rows[0]['state'] == state
+        ok &= good
+        print(f"{'OK' if good else 'ECHEC'}: site {site}: {len(rows)} logs salle {room}, "
+              f"dernier etat {rows[0]['state'] if rows else None} (attendu {state})")
+
+    for site, (sio, seen) in clients.items():
+        sio.disconnect()
+        own = '206' if site == 'default' else f'{site}/206'
+        isolated = set(seen['rooms']) == {own}
+        ok &= isolated
+        print(f"{'OK' if isolated else 'ECHEC'}: dashboard {site}: trames {sorted(seen['rooms'])}")
+    # Nouveau dashboard: snapshot du site uniquement
+    sio, seen = dashboard(url, 'lyon')
+    time.sleep(0.5)
+    sio.disconnect()
+    rooms = [(r['room'], r['state']) for r in seen['snapshot']['rooms']]
+    good = rooms == [('lyon/206', 'OUT')]
+    ok &= good
+    print(f"{'OK' if good else 'ECHEC'}: snapshot du site lyon: {rooms}")
+
+    sites = json.load(urllib.request.urlopen(f'{url}/api/sites'))
+    listed = {s['site']: s for s in sites['sites']}
+    good = set(listed) == set(SITES) and all(s['ingest'] for s in listed.values()) == sites['partitioned']
+    ok &= good
+    print(f"{'OK' if good else 'ECHEC'}: /api/sites -> {sorted(listed)} (partitionne: {sites['partitioned']})")
+    return ok
+
+
+def measure_noisy(args, url):
+    """Latence du site calme pendant la rafale du site bruyant"""
+    noisy = Gateway('noisy', args.mqtt_port, 20)
+    quiet = Gateway('quiet', args.mqtt_port)
+    sio, seen = dashboard(url, 'quiet')
+    time.sleep(0.5)
+    sent = {}
+    stop = threading.Event()
+
+    def flood():
+        for i in range(args.flood):
+            noisy.send(f'N{i % 50}', 'IN' if i % 2 else 'OUT')
+            if i % 1000 == 999:
+                time.sleep(0.01)
+        stop.set()
+
+    thread = threading.Thread(target=flood)
+    thread.start()
+    i = 0
+    while not stop.is_set() or i < 10:
+        room = f'Q{i}'
+        sent[f'quiet/{room}'] = time.time()
+        quiet.send(room, 'OUT')
+        i += 1
+        time.sleep(0.02)
+    thread.join()
+    noisy.stop()
+    quiet.stop()
+    deadline = time.time() + 60
+    while len(seen['rooms']) < len(sent) and time.time() < deadline:
+        time.sleep(0.2)
+    sio.disconnect()
+    latencies = sorted((seen['rooms'][room] - t) * 1000 for room, t in sent.items() if room in seen['rooms'])
+    stats = json.load(urllib.request.urlopen(f'{url}/api/ingest/stats'))
+    return latencies, len(sent), stats
+
+
+def run(args, partitioned):
+    procs, broker = [], None
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {'KEYBOX_DB_PATH': os.path.join(tmp, 'keybox.db'), 'MQTT_USE_TLS': 'false',
+               'MQTT_PORT': str(args.mqtt_port), 'MQTT_BROKER': 'localhost', 'LOG_LEVEL': 'WARNING',
+               'INGEST_PARTITION_BY_SITE': 'true' if partitioned else 'false',
+               'INGEST_BATCH_SIZE': str(args.batch_size)}
+        try:
+            if args.fake_broker:
+                broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_broker.py'),
+                                           '--port', str(args.mqtt_port)])
+                time.sleep(1)
+            procs = workers.spawn(1, args.base_port, '', env)
+            url = f'http://localhost:{args.base_port}'
+            if not wait_http(url):
+                print("ECHEC: backend non demarre")
+                return False, None
+            print(f"--- Ingestion {'partitionnee par site' if partitioned else 'file unique'} ---")
+            ok = check_routing(args, url)
+            latencies, sent, stats = measure_noisy(args, url)
+            received = len(latencies)
+            good = received == sent
+            ok &= good
+            print(f"{'OK' if good else 'ECHEC'}: site calme {received}/{sent} evenements recus pendant "
+                  f"{args.flood} evenements du site bruyant (abandonnes: {stats['dropped']}, "
+                  f"en attente: {stats['queue_depth']})")
+            if latencies:
+                p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else latencies[-1]
+                print(f"    latence site calme: mediane {statistics.median(latencies):.0f} ms, "
+                      f"p95 {p95:.0f} ms, max {latencies[-1]:.0f} ms")
+            for site, site_stats in sorted(stats.get('sites', {}).items()):
+                print(f"    file {site}: ecrits {site_stats['written']}, lot max {site_stats['max_batch_ms']:.1f} ms")
+            return ok, latencies
+        finally:
+            workers.stop(procs)
+            if broker:
+                broker.terminate()
+                broker.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flood', type=int, default=20000, help='evenements publies par le site bruyant')
+    parser.add_argument('--batch-size', type=int, default=200, help='INGEST_BATCH_SIZE du backend')
+    parser.add_argument('--base-port', type=int, default=5161)
+    parser.add_argument('--mqtt-port', type=int, default=1883)
+    parser.add_argument('--fake-broker', action='store_true')
+    parser.add_argument('--compare', action='store_true', help='aussi avec INGEST_PARTITION_BY_SITE=false')
+    args = parser.parse_args()
+
+    ok, _ = run(args, True)
+    if args.compare:
+        ok &= run(args, False)[0]
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Verification locale du mode multi-workers
+
+Lance N workers backend (backend/workers.py) sur une base temporaire, un
+client Socket.IO par worker, publie M evenements MQTT puis verifie:
+    - chaque evenement est ecrit exactement une fois (abonnement partage)
+    - chaque client, quel que soit son worker, recoit tous les evenements
+    - un jeton admin obtenu sur un worker est accepte par un autre
+
+Broker: Mosquitto sur localhost (--mqtt-port, sans TLS), ou a defaut le
+broker de substitution benchmarks/fake_broker.py (--fake-broker).
+
+Usage:
+    python benchmarks/multi_worker_check.py --workers 3 --events 200 --fake-broker
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import paho.mqtt.client as mqtt
+import socketio
+from paho.mqtt.client import CallbackAPIVersion
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'backend'))
+import workers  # noqa: E402
+
+
+def wait_http(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return True
+        except Exception:
+            time.sleep(0.3)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--base-port', type=int, default=5101)
+    parser.add_argument('--mqtt-port', type=int, default=1883)
+    parser.add_argument('--fake-broker', action='store_true')
+    args = parser.parse_args()
+
+    procs, broker = [], None
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {'KEYBOX_DB_PATH': os.path.join(tmp, 'keybox.db'), 'MQTT_USE_TLS': 'false',
+               'MQTT_PORT': str(args.mqtt_port), 'MQTT_BROKER': 'localhost'}
+        try:
+            if args.fake_broker:
+                broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_broker.py'),
+                                           '--port', str(args.mqtt_port)])
+                time.sleep(1)
+            procs = workers.spawn(args.workers, args.base_port, 'keybox_check', env)
+            urls = [f'http://localhost:{args.base_port + i}' for i in range(args.workers)]
+            if not all(wait_http(url) for url in urls):
+                print("ECHEC: workers non demarres")
+                return 1
+
+            received = [set() for _ in urls]
+            lock = threading.Lock()
+            clients = []
+            for i, url in enumerate(urls):
+                sio = socketio.Client()
+
+                def on_update(frame, i=i):
+                    with lock:
+                        received[i].update(r['room'] for r in frame['rooms'])
+                sio.on('update_rooms', on_update)
+                sio.connect(url, transports=['websocket'])
+                clients.append(sio)
+            time.sleep(1)
+
+            publisher = mqtt.Client(CallbackAPIVersion.VERSION2, 'Multi_Worker_Check')
+            publisher.connect('localhost', args.mqtt_port, 60)
+            publisher.loop_start()
+            rooms = [f'MW{i}' for i in range(args.events)]
+            for room in rooms:
+                publisher.publish(f'ecole/salles/{room}/status',
+                                  json.dumps({'room': room, 'key': 'N/A', 'state': 'OUT'}), qos=1)
+            time.sleep(3)
+            publisher.loop_stop()
+
+            ok = True
+            logs = json.load(urllib.request.urlopen(f'{urls[0]}/api/logs?limit=10000'))
+            written = [log['room'] for log in logs if log['room'].startswith('MW')]
+            once = len(written) == len(set(written)) == args.events
+            ok &= once
+            print(f"{'OK' if once else 'ECHEC'}: {len(written)} logs ecrits pour {args.events} evenements "
+                  f"({len(set(written))} distincts)")
+            for i, rooms_seen in enumerate(received):
+                all_seen = rooms_seen >= set(rooms)
+                ok &= all_seen
+                print(f"{'OK' if all_seen else 'ECHEC'}: worker {i} -> {len(rooms_seen & set(rooms))}/{args.events} salles")
+
+            # Jeton admin obtenu sur le worker 0, verifie sur le dernier
+            responses = {}
+            clients[0].on('admin_login_response', lambda d: responses.setdefault('login', d))
+            clients[-1].on('admin_verify_response', lambda d: responses.setdefault('verify', d))
+            clients[0].emit('admin_login', {'username': os.getenv('ADMIN_USERNAME', 'admin'),
+                                            'password': os.getenv('ADMIN_PASSWORD', 'admin123')})
+            time.sleep(1)
+            token = responses.get('login', {}).get('token')
+            clients[-1].emit('admin_verify', {'token': token})
+            time.sleep(1)
+            shared = bool(token) and responses.get('verify', {}).get('valid', False)
+            ok &= shared
+            print(f"{'OK' if shared else 'ECHEC'}: jeton admin partage entre workers")
+
+            for sio in clients:
+                sio.disconnect()
+            return 0 if ok else 1
+        finally:
+            workers.stop(procs)
+            if broker:
+                broker.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
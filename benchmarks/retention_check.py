@@ -0,0 +1,78 @@
+"""
+Verification de la retention des logs (backend/retention.py)
+
+Remplit une base temporaire de logs anciens, lance run_retention puis verifie
+que les logs sont archives et agreges, et que l'incremental_vacuum rend bien
+les pages liberees: freelist_count doit baisser d'autant que VACUUM_PAGES le
+permet (conn.execute ne fait qu'un pas de la pragma, soit une seule page).
+
+Usage:
+    python benchmarks/retention_check.py --events 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), '..', 'backend')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['KEYBOX_DB_PATH'] = os.path.join(tmp, 'retention.db')
+        sys.path.insert(0, BACKEND_DIR)
+        import database as db
+        import retention
+        retention.RETENTION_BATCH_PAUSE = 0
+        db.init_db()
+
+        # _vacuum observe: pages libres juste avant et apres la pragma
+        observed = []
+        vacuum = retention._vacuum
+
+        def observe_vacuum(conn, allow_full_vacuum):
+            before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            vacuum(conn, allow_full_vacuum)
+            observed.append((before, conn.execute('PRAGMA freelist_count').fetchone()[0]))
+        retention._vacuum = observe_vacuum
+
+        def fill(n):
+            old = (datetime.now() - timedelta(days=30)).strftime(retention.TIMESTAMP_FORMAT)
+            db.add_events([{'timestamp': old, 'room': str(100 + i % 40), 'state': 'OUT' if i % 2 else 'IN',
+                            'key_uid': f'K{i % 60}', 'message': 'x' * 200} for i in range(n)])
+
+        def pages():
+            with db.connection() as conn:
+                return (conn.execute('PRAGMA page_count').fetchone()[0],
+                        conn.execute('PRAGMA freelist_count').fetchone()[0])
+
+        ok = True
+        for limit in (retention.VACUUM_PAGES, 50):
+            retention.VACUUM_PAGES = limit
+            fill(args.events)
+            before_pages, _ = pages()
+            archived = retention.run_retention(7, archive_path=os.path.join(tmp, 'archive.db'))
+            after_pages, free = pages()
+            freed_before, freed_after = observed[-1]
+            expected = max(0, freed_before - limit)
+            good = archived == args.events and freed_after == expected and after_pages < before_pages
+            ok &= good
+            print(f"{'OK' if good else 'ECHEC'}: VACUUM_PAGES={limit}: {archived} logs archives, "
+                  f"pages libres {freed_before} -> {freed_after} (attendu {expected}), "
+                  f"fichier {before_pages} -> {after_pages} pages")
+
+        stats = retention.get_daily_stats()
+        good = sum(s['count_in'] + s['count_out'] for s in stats) == 2 * args.events
+        ok &= good
+        print(f"{'OK' if good else 'ECHEC'}: agregats journaliers: {len(stats)} lignes")
+        db.close()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
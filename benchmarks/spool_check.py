@@ -0,0 +1,175 @@
+"""
+Verification du spool disque de la gateway (gateway/spool.py)
+
+Scenario, avec le broker de substitution benchmarks/fake_broker.py:
+    1. broker actif: N messages publies via le spool
+    2. broker arrete: N messages mis en spool, puis "redemarrage" de la
+       gateway (nouvelle instance Spool sur le meme fichier)
+    3. broker relance: le spool rejoue a debit borne
+Verifie que l'abonne recoit les 3N messages dans l'ordre, sans perte, et que
+le spool est vide et compacte a la fin: plus de page libre (freelist_count)
+et fichier revenu a quelques pages.
+
+Usage:
+    python benchmarks/spool_check.py --events 1000 --rate 2000 --payload-bytes 1024
+"""
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'gateway'))
+from spool import Spool  # noqa: E402
+
+TOPIC = 'ecole/salles/SPOOL/status'
+
+
+def start_broker(port):
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_broker.py'), '--port', str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(0.8)
+    return proc
+
+
+def gateway_client(port, name):
+    client = mqtt.Client(CallbackAPIVersion.VERSION2, name)
+    client.reconnect_delay_set(min_delay=1, max_delay=2)
+    spool = None
+
+    def on_connect(c, u, flags, rc, props):
+        if not rc.is_failure and spool:
+            spool.on_connect()
+
+    client.on_connect = on_connect
+    client.on_disconnect = lambda c, u, flags, rc, props: spool and spool.on_disconnect()
+    client.on_publish = lambda c, u, mid, rc, props: spool and spool.on_publish(mid)
+    client.connect_async('localhost', port, 60)
+
+    def attach(s):
+        nonlocal spool
+        spool = s
+        if client.is_connected():
+            s.on_connect()
+        return s
+    return client, attach
+
+
+def wait_until(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return predicate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=500)
+    parser.add_argument('--payload-bytes', type=int, default=1024, help='taille de chaque message')
+    parser.add_argument('--port', type=int, default=18831)
+    args = parser.parse_args()
+
+    received, lock = [], threading.Lock()
+
+    def subscriber():
+        sub = mqtt.Client(CallbackAPIVersion.VERSION2, 'Spool_Check_Sub')
+        sub.on_connect = lambda c, u, f, rc, p: c.subscribe(TOPIC, qos=1)
+
+        def on_message(c, u, msg):
+            with lock:
+                received.append(int(msg.payload))
+        sub.on_message = on_message
+        sub.connect('localhost', args.port, 60)
+        sub.loop_start()
+        return sub
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'spool.db')
+        broker = start_broker(args.port)
+        sub = subscriber()
+        client, attach = gateway_client(args.port, 'Spool_Check_Gw1')
+        client.loop_start()
+        spool = attach(Spool(client, path, args.rate).start())
+        n, seq = args.events, 0
+
+        def message(i):
+            # Numero de sequence complete a la taille voulue (int() ignore les espaces)
+            return str(i).ljust(args.payload_bytes)
+
+        def spool_file():
+            conn = sqlite3.connect(path)
+            try:
+                free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            finally:
+                conn.close()
+            return free, sum(os.path.getsize(path + ext) for ext in ('', '-wal') if os.path.exists(path + ext))
+        try:
+            for _ in range(n):
+                spool.append(TOPIC, message(seq))
+                seq += 1
+            wait_until(lambda: len(received) >= n, 10)
+            print(f"Broker actif : {len(received)}/{n} recus")
+
+            broker.terminate()
+            broker.wait()
+            sub.loop_stop()
+            wait_until(lambda: not client.is_connected(), 5)
+            for _ in range(n):
+                spool.append(TOPIC, message(seq))
+                seq += 1
+            pending = spool.stats()['pending']
+            print(f"Broker arrete : {pending} messages en spool")
+
+            # Redemarrage de la gateway: le spool est relu depuis le disque
+            client.loop_stop()
+            spool.stop()
+            client, attach = gateway_client(args.port, 'Spool_Check_Gw2')
+            spool = attach(Spool(client, path, args.rate).start())
+            for _ in range(n):
+                spool.append(TOPIC, message(seq))
+                seq += 1
+            print(f"Gateway relancee : {spool.stats()['pending']} messages en spool")
+            _, full_size = spool_file()
+
+            broker = start_broker(args.port)
+            sub = subscriber()
+            time.sleep(0.5)
+            start = time.perf_counter()
+            client.loop_start()
+            wait_until(lambda: spool.stats()['pending'] == 0, 30)
+            elapsed = time.perf_counter() - start
+            wait_until(lambda: len(received) >= seq, 5)
+            stats = spool.stats()
+            print(f"Rejeu : {seq - n} messages en {elapsed:.1f}s, spool {stats}")
+            time.sleep(0.5)
+            free, size = spool_file()
+            compacted = free == 0 and size < full_size / 4
+            print(f"{'OK' if compacted else 'ECHEC'}: spool compacte: {full_size / 1e6:.2f} Mo -> "
+                  f"{size / 1e6:.2f} Mo, {free} pages libres")
+
+            with lock:
+                got = sorted(set(received))
+                in_order = received == sorted(received)
+            ok = got == list(range(seq)) and stats['pending'] == 0
+            print(f"{'OK' if ok else 'ECHEC'}: {len(got)}/{seq} messages distincts "
+                  f"({len(received) - len(got)} doublons), ordre {'respecte' if in_order else 'NON respecte'}")
+            return 0 if ok and in_order and compacted else 1
+        finally:
+            client.loop_stop()
+            spool.stop()
+            sub.loop_stop()
+            broker.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Regroupement des trames XBee avant publication MQTT
+
+Au lieu d'un message QoS 1 (et d'un PUBACK) par badge, les trames recues
+pendant BATCH_MS sont envoyees en un seul message sur
+    ecole/gateway/batch/<encodage>     (json ou msgpack)
+    ecole/sites/<site>/batch/<encodage> (gateway d'un autre site, voir shared/topics.py)
+au format colonnes: {"v": 1, "gw": id, "fields": [...], "frames": [[...], ...]}.
+
+L'etat de chaque salle reste publie en retained (derniere trame du lot) sur
+le topic state de la salle pour les abonnes tardifs; le backend ne consomme
+que le topic batch, donc rien n'est ingere deux fois.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+import topics  # noqa: E402
+
+ENCODINGS = ('json', 'msgpack')
+log = logging.getLogger('GATEWAY')
+
+
+def encode_batch(frames, gateway_id, encoding='json', site=None):
+    """Encode une liste de trames (dict) en colonnes; les champs absents valent None"""
+    fields = []
+    for frame in frames:
+        for field in frame:
+            if field not in fields:
+                fields.append(field)
+    batch = {'v': 1, 'gw': gateway_id, 'fields': fields,
+             'frames': [[frame.get(f) for f in fields] for frame in frames]}
+    if site:
+        # Informatif: le backend prend le site du topic
+        batch['site'] = site
+    if encoding == 'msgpack':
+        import msgpack
+        return msgpack.packb(batch)
+    return json.dumps(batch, separators=(',', ':'))
+
+
+class FrameBatcher:
+    def __init__(self, publish, gateway_id, flush_interval=0.2, max_frames=100, encoding='json', site=None):
+        """publish(topic, payload, qos, retain): mqtt_client.publish; site: GATEWAY_SITE"""
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Encodage inconnu: {encoding}")
+        self.publish = publish
+        self.gateway_id = gateway_id
+        self.flush_interval = flush_interval
+        self.max_frames = max_frames
+        self.encoding = encoding
+        self.site = site
+        self.topic = topics.batch_topic(site, encoding)
+        self._frames = []
+        self._lock = threading.Lock()
+        # Flush depuis add() (lot plein, threads XBee) ou le minuteur: lots et etats
+        # retenus publies dans l'ordre des trames, un flush a la fois
+        self._publish_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='frame-batcher', daemon=True)
+        self.counters = {'frames': 0, 'batches': 0, 'bytes': 0, 'retained': 0}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(self.flush_interval * 4)
+        self.flush()
+
+    def add(self, frame):
+        with self._lock:
+            self._frames.append(frame)
+            self.counters['frames'] += 1
+            full = len(self._frames) >= self.max_frames
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._publish_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            frames, self._frames = self._frames, []
+        if not frames:
+            return None
+        payload = encode_batch(frames, self.gateway_id, self.encoding, self.site)
+        self.publish(self.topic, payload, 1, False)
+
+        # Etat retenu: derniere trame de chaque salle du lot (trames rejetees exclues)
+        last = {}
+        for frame in frames:
+            if 'raw' not in frame:
+                last[frame['room']] = frame
+        for room, frame in last.items():
+            self.publish(topics.state_topic(self.site, room), json.dumps(frame), 1, True)
+
+        with self._lock:
+            self.counters['batches'] += 1
+            self.counters['bytes'] += len(payload)
+            self.counters['retained'] += len(last)
+        return payload
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Erreur envoi du lot: %s", e)
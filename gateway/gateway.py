@@ -1,17 +1,35 @@
 import json
+import logging
+import sys
+import time
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
-from xbee_handler import XBeeService
-from datetime import datetime
 from dotenv import load_dotenv
 import os
 import ssl
 
+# Modules communs avec le backend (shared/events.py, shared/topics.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+import events  # noqa: E402
+import topics  # noqa: E402
+from xbee_handler import XBeeService, event_id_prefix  # noqa: E402
+from batcher import FrameBatcher  # noqa: E402
+from health import HealthReporter  # noqa: E402
+from spool import Spool  # noqa: E402
+import telemetry  # noqa: E402
+
 # --- CONFIGURATION ---
 load_dotenv()
+log_listener = telemetry.setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "text"))
+log = logging.getLogger("GATEWAY")
+exchange_log = logging.getLogger("EXCHANGE")
 
 XBEE_PORT = os.getenv("XBEE_PORT")  # Windows: Silicon Labs CP210x USB (XBee) 
 BAUD_RATE = 9600
+# File de traitement des trames XBee (thread de lecture serie decharge)
+XBEE_WORKERS = int(os.getenv("XBEE_WORKERS", 2))
+XBEE_QUEUE_SIZE = int(os.getenv("XBEE_QUEUE_SIZE", 1000))
+XBEE_OVERFLOW = os.getenv("XBEE_OVERFLOW", "drop_oldest")
 MQTT_BROKER = os.getenv("MQTT_BROKER", "localhost")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 8883))
 MQTT_USE_TLS = os.getenv("MQTT_USE_TLS", "true").lower() == "true"
@@ -20,6 +38,26 @@ MQTT_PASSWORD = os.getenv("GATEWAY_MQTT_PASSWORD", "cesi123")
 MQTT_CA_CERT = os.path.join(os.path.dirname(__file__), '..', os.getenv("MQTT_CA_CERT", "mqtt_certs/ca.crt"))
 MQTT_CLIENT_CERT = os.path.join(os.path.dirname(__file__), '..', os.getenv("MQTT_CLIENT_CERT", "mqtt_certs/client.crt"))
 MQTT_CLIENT_KEY = os.path.join(os.path.dirname(__file__), '..', os.getenv("MQTT_CLIENT_KEY", "mqtt_certs/client.key"))
+# Site (batiment) de cette gateway: topics ecole/sites/<site>/..., sauf site par defaut
+GATEWAY_SITE = events.check_site(os.getenv("GATEWAY_SITE") or events.DEFAULT_SITE)
+# Identifiant unique par gateway (client MQTT, prefixe des eid)
+GATEWAY_ID = os.getenv("GATEWAY_ID") or (
+    "XBee_Gateway" if GATEWAY_SITE == events.DEFAULT_SITE else f"XBee_Gateway_{GATEWAY_SITE}")
+
+# Regroupement des trames (0 = une publication par trame, mode historique)
+GATEWAY_BATCH_MS = int(os.getenv("GATEWAY_BATCH_MS", 0))
+GATEWAY_BATCH_MAX = int(os.getenv("GATEWAY_BATCH_MAX", 100))
+GATEWAY_BATCH_ENCODING = os.getenv("GATEWAY_BATCH_ENCODING", "json")
+
+# Tampon disque des messages en attente de PUBACK (coupures du broker)
+GATEWAY_SPOOL_PATH = os.getenv("GATEWAY_SPOOL_PATH") or None
+GATEWAY_REPLAY_RATE = float(os.getenv("GATEWAY_REPLAY_RATE", 100))
+GATEWAY_SPOOL_INFLIGHT = int(os.getenv("GATEWAY_SPOOL_INFLIGHT", 20))
+SPOOL_STATS_INTERVAL = 10
+GATEWAY_METRICS_PORT = int(os.getenv("GATEWAY_METRICS_PORT", 9101))  # 0 = desactive
+# Rapport de sante (topic health, retenu + testament MQTT), en secondes; 0 = desactive
+GATEWAY_HEALTH_INTERVAL_S = float(os.getenv("GATEWAY_HEALTH_INTERVAL_S", 10))
+HEALTH_TOPIC = topics.health_topic(GATEWAY_SITE, GATEWAY_ID)
 
 # --- LOGGING UTILITIES ---
 def log_exchange(direction, protocol, topic, qos=None, data=None, is_confirmable=True, status=""):
@@ -35,28 +73,58 @@ def log_exchange(direction, protocol, topic, qos=None, data=None, is_confirmable
         is_confirmable: Si c'est un message confirmable (MQTT: toujours true, CoAP serait variable)
         status: Message de statut additionnel
     """
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-    qos_str = f"QoS={qos}" if qos is not None else "QoS=N/A"
-    confirmable_str = "Confirmable" if is_confirmable else "Non-confirmable"
-    status_str = f"| {status}" if status else ""
-    
-    print(f"[{timestamp}] [{protocol}] {direction} | Topic/Resource: {topic} | {qos_str} | {confirmable_str} {status_str}")
-    if data:
-        print(f"  -> Payload: {data}")
+    # Horodatage et mise en forme faits par le thread d'ecriture des logs (rien si niveau > INFO)
+    if not exchange_log.isEnabledFor(logging.INFO):
+        return
+    exchange_log.info(
+        "[%s] %s | Topic/Resource: %s | QoS=%s | %s %s%s", protocol, direction, topic,
+        qos if qos is not None else "N/A", "Confirmable" if is_confirmable else "Non-confirmable",
+        f"| {status}" if status else "", f"\n  -> Payload: {data}" if data else "",
+        extra={'fields': {'protocol': protocol, 'direction': direction, 'topic': topic, 'qos': qos}})
 
 # Configuration du Client MQTT
-mqtt_client = mqtt.Client(CallbackAPIVersion.VERSION2, "XBee_Gateway")
+mqtt_client = mqtt.Client(CallbackAPIVersion.VERSION2, GATEWAY_ID)
+
+# Sante de la gateway: rapport periodique; le broker publie "offline" si la connexion est perdue
+health = None
+if GATEWAY_HEALTH_INTERVAL_S > 0:
+    health = HealthReporter(mqtt_client.publish, HEALTH_TOPIC, GATEWAY_ID, GATEWAY_SITE, GATEWAY_HEALTH_INTERVAL_S)
+    mqtt_client.will_set(HEALTH_TOPIC, health.will(), qos=1, retain=True)
 
 def on_connect(client, userdata, flags, reason_code, properties):
     log_exchange("CONNECT", "MQTT", "Broker", status=f"Code de connexion: {reason_code}")
-    print(f"[GATEWAY] Connecte au Broker MQTT avec le code {reason_code}")
+    log.info("Connecte au Broker MQTT avec le code %s", reason_code)
+    if not reason_code.is_failure:
+        spool.on_connect()
+        if health and health.running:
+            health.publish_report()
+
+def on_disconnect(client, userdata, flags, reason_code, properties):
+    spool.on_disconnect()
+    log_exchange("DISCONNECT", "MQTT", "Broker", status=f"Code: {reason_code}")
+
+def on_publish(client, userdata, mid, reason_code, properties):
+    spool.on_publish(mid)
+
+def on_spool_ack(seconds):
+    """Latence mise en spool -> PUBACK: histogramme et rapport de sante"""
+    telemetry.STAGE_LATENCY.labels('mqtt_publish').observe(seconds)
+    if health:
+        health.observe_publish(seconds)
 
 mqtt_client.on_connect = on_connect
+mqtt_client.on_disconnect = on_disconnect
+mqtt_client.on_publish = on_publish
+spool = Spool(mqtt_client, GATEWAY_SPOOL_PATH, GATEWAY_REPLAY_RATE, GATEWAY_SPOOL_INFLIGHT,
+              on_ack=on_spool_ack).start()
+telemetry.register(telemetry.StatsCollector(
+    'keybox_gateway_spool', spool.stats, counters=('appended', 'published', 'acked'),
+    gauges=('pending', 'inflight', 'connected', 'size_bytes', 'replay_lag_s')))
 
 # Configure MQTT authentication
 if MQTT_USERNAME and MQTT_PASSWORD:
     mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    print(f"[GATEWAY] Authentification configuree pour l'utilisateur: {MQTT_USERNAME}")
+    log.info("Authentification configuree pour l'utilisateur: %s", MQTT_USERNAME)
 
 # Configure TLS if enabled
 if MQTT_USE_TLS:
@@ -71,43 +139,103 @@ if MQTT_USE_TLS:
             )
             # Disable hostname verification for localhost
             mqtt_client.tls_insecure_set(True)
-            print(f"[GATEWAY] TLS active (Port {MQTT_PORT})")
+            log.info("TLS active (Port %s)", MQTT_PORT)
         else:
-            print(f"[GATEWAY] Avertissement: Certificat CA non trouve: {MQTT_CA_CERT}")
-            print(f"[GATEWAY] Connexion sans TLS sur le port {MQTT_PORT}")
+            log.warning("Certificat CA non trouve: %s", MQTT_CA_CERT)
+            log.info("Connexion sans TLS sur le port %s", MQTT_PORT)
     except Exception as e:
-        print(f"[GATEWAY] Erreur configuration TLS: {e}")
+        log.error("Erreur configuration TLS: %s", e)
 else:
-    print(f"[GATEWAY] Connexion sans TLS sur le port {MQTT_PORT}")
+    log.info("Connexion sans TLS sur le port %s", MQTT_PORT)
 
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+# Connexion asynchrone: la gateway demarre (et met en spool) meme si le broker est absent
+mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
+mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
 mqtt_client.loop_start()
 
+def publish_batch(topic, payload, qos, retain):
+    spool.append(topic, payload, qos, retain)
+    log_exchange("TX", "MQTT", topic, qos=qos, status=f"{len(payload)} octets{' (retained)' if retain else ''}")
+
+batcher = None
+if GATEWAY_BATCH_MS > 0:
+    batcher = FrameBatcher(
+        publish_batch, GATEWAY_ID, GATEWAY_BATCH_MS / 1000, GATEWAY_BATCH_MAX, GATEWAY_BATCH_ENCODING,
+        site=GATEWAY_SITE
+    ).start()
+    telemetry.register(telemetry.StatsCollector(
+        'keybox_gateway_batch', batcher.stats, counters=('frames', 'batches', 'bytes', 'retained')))
+    log.info("Envoi groupe: %s ms, %s trames max, %s", GATEWAY_BATCH_MS, GATEWAY_BATCH_MAX, GATEWAY_BATCH_ENCODING)
+
 # Fonction appelee a chaque reception XBee
 def process_xbee_data(data):
+    telemetry.STAGE_LATENCY.labels('xbee_queue').observe(max(0.0, time.time() - data['rx_ts']))
     log_exchange("RX", "XBEE", "XBee_Serial", data=data, status="Donnees Arduino")
     # data est le dictionnaire JSON venant de l'Arduino
+    if batcher:
+        batcher.add(data)
+        return
+
     room = data.get('room', 'unknown')
-    topic = f"ecole/salles/{room}/status"
-    
-    # Publication sur le Bus MQTT avec QoS=1 (au moins une fois)
-    mqtt_client.publish(topic, json.dumps(data), qos=1, retain=True)
-    log_exchange("TX", "MQTT", topic, qos=1, data=json.dumps(data), status="Donnees relayees du XBee")
+    topic = topics.status_topic(GATEWAY_SITE, room)
+    message = json.dumps(data)
+    # Trame rejetee par le decodeur (relayee brute pour dead_letters): jamais retenue
+    retain = 'raw' not in data
+
+    # Publication sur le Bus MQTT avec QoS=1 (au moins une fois), via le spool disque
+    spool.append(topic, message, qos=1, retain=retain)
+    log_exchange("TX", "MQTT", topic, qos=1, data=message, status="Donnees relayees du XBee")
 
 # Lancement du service XBee
 try:
-    print("[GATEWAY] Initialisation du XBee...")
+    log.info("Initialisation du XBee...")
     # On force AP=1 dans ton XBee via XCTU pour que ce service fonctionne
-    xbee_service = XBeeService(XBEE_PORT, BAUD_RATE, process_xbee_data)
+    xbee_service = XBeeService(XBEE_PORT, BAUD_RATE, process_xbee_data,
+                               XBEE_WORKERS, XBEE_QUEUE_SIZE, XBEE_OVERFLOW,
+                               event_prefix=event_id_prefix(GATEWAY_ID))
     xbee_service.start()
-    print("[GATEWAY] Pret a relayer les donnees.")
+    telemetry.register(telemetry.StatsCollector(
+        'keybox_gateway_xbee', xbee_service.stats, counters=('received', 'parsed', 'rejected', 'dropped', 'errors'),
+        gauges=('queue_depth', 'latency_max_ms')))
+    log.info("Pret a relayer les donnees (site %s, %s).", GATEWAY_SITE, topics.status_topic(GATEWAY_SITE, '+'))
 except Exception as e:
-    print(f"[GATEWAY] Erreur fatale: {e}")
+    xbee_service = None
+    log.error("Erreur fatale: %s", e)
+
+if health:
+    # Sans XBee (erreur ci-dessus), le rapport signale xbee absent mais la gateway reste visible
+    health.xbee, health.spool = xbee_service, spool
+    health.start()
+    log.info("Rapport de sante toutes les %gs sur %s", GATEWAY_HEALTH_INTERVAL_S, HEALTH_TOPIC)
+
+telemetry.serve(GATEWAY_METRICS_PORT)
 
 # Boucle infinie pour maintenir le script actif
-import time
 try:
+    ticks = 0
     while True:
         time.sleep(1)
+        ticks += 1
+        if ticks % SPOOL_STATS_INTERVAL == 0:
+            stats = spool.stats()
+            if stats['pending']:
+                logging.getLogger("SPOOL").warning(
+                    "%d en attente (%d octets), retard %.1fs, connecte=%s",
+                    stats['pending'], stats['size_bytes'], stats['replay_lag_s'], stats['connected'])
+            if xbee_service and xbee_service.counters['dropped']:
+                xbee = xbee_service.stats()
+                logging.getLogger("XBEE").warning(
+                    "%d trames perdues sur %d, file %d, latence max %.0fms",
+                    xbee['dropped'], xbee['received'], xbee['queue_depth'], xbee['latency_max_ms'])
 except KeyboardInterrupt:
-    print("[GATEWAY] Arrêt du service.")
\ No newline at end of file
+    if xbee_service:
+        xbee_service.stop()
+    if batcher:
+        batcher.stop()
+    if health:
+        health.stop()
+    spool.stop()
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+    log.info("Arrêt du service.")
+    log_listener.stop()
\ No newline at end of file
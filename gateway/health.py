@@ -0,0 +1,118 @@
+"""
+Rapport de sante periodique de la gateway (topic health, voir shared/topics.py)
+
+Toutes les GATEWAY_HEALTH_INTERVAL_S secondes, un message JSON retenu:
+    {"v": 1, "gw": id, "site": site, "status": "online", "ts": ..., "interval": 10,
+     "uptime_s": ..., "xbee": {...}, "mqtt": {...}, "spool": {...},
+     "nodes": {"<adresse 64 bits>": {"room", "frames", "rejected", "fps", "age_s"}}}
+    - xbee: connexion, compteurs de XBeeService (trames, invalides, perdues), file
+    - mqtt: connexion au broker, latence mise en spool -> PUBACK sur l'intervalle
+    - spool: messages en attente, en vol, retard de rejeu
+    - nodes: par module emetteur (boitier d'une salle), debit sur l'intervalle,
+      trames invalides et anciennete de la derniere trame (age_s: relative a ts,
+      le backend n'a pas besoin d'une horloge synchronisee)
+
+Le testament MQTT (will()) publie {"status": "offline"} sur le meme topic si la
+gateway disparait sans se deconnecter; stop() le publie a l'arret normal, et
+chaque connexion au broker publie aussitot un rapport (qui remplace le
+testament retenu). Le rapport n'est pas mis en spool: apres une coupure, seul
+l'etat courant compte.
+"""
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger('HEALTH')
+
+
+class HealthReporter:
+    def __init__(self, publish, topic, gateway_id, site, interval=10.0, xbee=None, spool=None):
+        """publish(topic, payload, qos, retain): mqtt_client.publish; xbee: XBeeService; spool: Spool"""
+        self.publish = publish
+        self.topic = topic
+        self.gateway_id = gateway_id
+        self.site = site
+        self.interval = interval
+        self.xbee = xbee
+        self.spool = spool
+        self.started_at = time.time()
+        self._previous = {}         # adresse -> trames au rapport precedent
+        self._previous_at = self.started_at
+        self._publish_ms = []       # latences PUBACK depuis le rapport precedent
+        self._lock = threading.Lock()
+        self._report_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='health-reporter', daemon=True)
+        self.counters = {'reports': 0, 'errors': 0}
+
+    def will(self, status='offline'):
+        """Payload du testament MQTT (mqtt_client.will_set avant la connexion)"""
+        return json.dumps({'v': 1, 'gw': self.gateway_id, 'site': self.site, 'status': status})
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(2)
+        self.publish(self.topic, self.will(), 1, True)
+
+    def observe_publish(self, seconds):
+        """Latence mise en spool -> PUBACK d'un message (Spool on_ack)"""
+        with self._lock:
+            self._publish_ms.append(seconds * 1000)
+
+    def report(self):
+        """Construit le rapport courant (dict)"""
+        now = time.time()
+        with self._lock:
+            publish_ms, self._publish_ms = self._publish_ms, []
+        elapsed = max(now - self._previous_at, 1e-3)
+        data = {'v': 1, 'gw': self.gateway_id, 'site': self.site, 'status': 'online', 'ts': round(now, 3),
+                'interval': self.interval, 'uptime_s': round(now - self.started_at)}
+        data['mqtt'] = {'acked': len(publish_ms),
+                        'publish_avg_ms': round(sum(publish_ms) / len(publish_ms), 1) if publish_ms else None,
+                        'publish_max_ms': round(max(publish_ms), 1) if publish_ms else None}
+        if self.spool:
+            spool = self.spool.stats()
+            data['mqtt']['connected'] = spool['connected']
+            data['spool'] = {k: spool[k] for k in ('pending', 'inflight', 'replay_lag_s', 'size_bytes')}
+        nodes = {}
+        data['xbee'] = {'connected': False}
+        if self.xbee:
+            xbee = self.xbee.stats()
+            data['xbee'] = {'connected': self.xbee.is_connected,
+                            **{k: xbee[k] for k in ('received', 'parsed', 'rejected', 'dropped', 'errors',
+                                                    'queue_depth')},
+                            'latency_avg_ms': round(xbee['latency_avg_ms'], 1),
+                            'latency_max_ms': round(xbee['latency_max_ms'], 1)}
+            current = self.xbee.nodes()
+            for address, node in current.items():
+                frames = node['frames'] - self._previous.get(address, 0)
+                nodes[address] = {'room': node['room'], 'frames': node['frames'], 'rejected': node['rejected'],
+                                  'fps': round(frames / elapsed, 3), 'age_s': round(now - node['last_seen'], 1)}
+            self._previous = {address: node['frames'] for address, node in current.items()}
+        data['nodes'] = nodes
+        self._previous_at = now
+        return data
+
+    def publish_report(self):
+        """Publie le rapport courant (thread du rapporteur, ou a la connexion au broker)"""
+        try:
+            with self._report_lock:
+                payload = json.dumps(self.report(), separators=(',', ':'))
+            self.publish(self.topic, payload, 0, True)
+            self.counters['reports'] += 1
+        except Exception as e:
+            self.counters['errors'] += 1
+            log.error("Rapport de sante: %s", e)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.publish_report()
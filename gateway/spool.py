@@ -0,0 +1,168 @@
+"""
+Tampon disque (store-and-forward) entre la gateway et le broker MQTT
+
+Chaque message est d'abord ecrit dans une base SQLite (append-only), puis
+publie par un thread d'envoi:
+    - dans l'ordre des ids, avec au plus GATEWAY_SPOOL_INFLIGHT messages non
+      acquittes; le retard accumule hors connexion (messages deja en spool a
+      la connexion) est rejoue a debit borne (GATEWAY_REPLAY_RATE msg/s), le
+      trafic courant part sans attente
+    - uniquement quand le client est connecte; apres une coupure, paho renvoie
+      lui-meme ses messages en vol, le spool reprend a la suite
+    - supprime du spool au PUBACK; apres un redemarrage de la gateway tout ce
+      qui n'a pas ete acquitte est rejoue (au moins une fois)
+
+Metriques (stats()): messages en attente, taille du fichier, retard de
+rejeu (age du plus ancien message non acquitte).
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger('SPOOL')
+DEFAULT_SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool.db')
+
+
+class Spool:
+    def __init__(self, client, path=None, replay_rate=100, max_inflight=20, chunk_size=100, on_ack=None):
+        """client: paho mqtt.Client; appeler on_connect/on_disconnect/on_publish depuis ses callbacks.
+        on_ack(secondes): appele pour chaque message acquitte avec son delai depuis la mise en spool"""
+        self.client = client
+        self.on_ack = on_ack
+        self.path = path or DEFAULT_SPOOL_PATH
+        self.interval = 1 / replay_rate if replay_rate > 0 else 0
+        self.max_inflight = max_inflight
+        self.chunk_size = chunk_size
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # Un evenement ecrit doit survivre a une coupure de courant
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                topic TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                qos INTEGER NOT NULL,
+                retain INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._connected = False
+        self._cursor = 0          # dernier id remis a paho dans ce processus
+        self._replay_until = 0    # dernier id du retard a rejouer a debit borne
+        self._reconnected = False
+        self._inflight = {}       # mid -> (id, created_at)
+        self._acked_mids = deque()
+        self._thread = threading.Thread(target=self._run, name='spool', daemon=True)
+        self.counters = {'appended': 0, 'published': 0, 'acked': 0}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        with self._lock:
+            self.conn.close()
+
+    def append(self, topic, payload, qos=1, retain=False):
+        """Ecrit le message sur disque avant toute tentative d'envoi"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self._lock:
+            cur = self.conn.execute(
+                'INSERT INTO spool (topic, payload, qos, retain, created_at) VALUES (?, ?, ?, ?, ?)',
+                (topic, payload, qos, int(retain), time.time()))
+            self.counters['appended'] += 1
+        self._wakeup.set()
+        return cur.lastrowid
+
+    # --- Callbacks paho (thread reseau: pas de verrou pris ici) ---
+    def on_connect(self):
+        self._reconnected = True
+        self._connected = True
+        self._wakeup.set()
+
+    def on_disconnect(self):
+        self._connected = False
+
+    def on_publish(self, mid):
+        self._acked_mids.append(mid)
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            pending, oldest = self.conn.execute('SELECT COUNT(*), MIN(created_at) FROM spool').fetchone()
+            pages = self.conn.execute('PRAGMA page_count').fetchone()[0]
+            page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+            return dict(self.counters, pending=pending, inflight=len(self._inflight),
+                        connected=self._connected, size_bytes=pages * page_size,
+                        replay_lag_s=round(time.time() - oldest, 3) if oldest else 0.0)
+
+    def _acknowledge(self):
+        """Supprime du spool les messages acquittes (PUBACK recu)"""
+        ids, now = [], time.time()
+        while self._acked_mids:
+            entry = self._inflight.pop(self._acked_mids.popleft(), None)
+            if entry is not None:
+                ids.append(entry[0])
+                if self.on_ack:
+                    self.on_ack(now - entry[1])
+        if not ids:
+            return
+        with self._lock:
+            self.conn.execute(f"DELETE FROM spool WHERE id IN ({','.join('?' * len(ids))})", ids)
+            self.counters['acked'] += len(ids)
+            if not self._inflight and self.conn.execute('SELECT 1 FROM spool LIMIT 1').fetchone() is None:
+                # Spool vide: pages rendues une par pas de la pragma, que execute() n'execute qu'une
+                # fois (pas de colonne resultat); executescript() la deroule jusqu'au bout. Le
+                # checkpoint reporte la troncature dans le fichier de la base
+                self.conn.executescript('PRAGMA incremental_vacuum; PRAGMA wal_checkpoint(TRUNCATE);')
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(0.5)
+            self._wakeup.clear()
+            try:
+                self._acknowledge()
+                self._forward()
+            except Exception as e:
+                log.error("Erreur: %s", e)
+                time.sleep(1)
+
+    def _forward(self):
+        if self._reconnected and self._connected:
+            # Retard a rejouer: tout ce qui est en spool au moment de la connexion
+            self._reconnected = False
+            with self._lock:
+                self._replay_until = self.conn.execute('SELECT MAX(id) FROM spool').fetchone()[0] or 0
+        while self._connected and not self._stop.is_set() and len(self._inflight) < self.max_inflight:
+            limit = min(self.chunk_size, self.max_inflight - len(self._inflight))
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT id, topic, payload, qos, retain, created_at FROM spool WHERE id > ? ORDER BY id LIMIT ?',
+                    (self._cursor, limit)).fetchall()
+            if not rows:
+                return
+            for msg_id, topic, payload, qos, retain, created_at in rows:
+                if not self._connected:
+                    return
+                info = self.client.publish(topic, payload, qos=qos, retain=bool(retain))
+                self._cursor = msg_id
+                self.counters['published'] += 1
+                if qos == 0:
+                    # Pas de PUBACK en QoS 0: remis a paho = acquitte
+                    self._acked_mids.append(info.mid)
+                self._inflight[info.mid] = (msg_id, created_at)
+                if self.interval and msg_id <= self._replay_until:
+                    time.sleep(self.interval)
+            self._acknowledge()
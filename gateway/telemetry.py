@@ -0,0 +1,40 @@
+"""
+Journalisation structuree et metriques Prometheus de la gateway
+
+Les appels logging deposent l'enregistrement dans une file bornee (perdu et
+compte si pleine) videe par un thread d'ecriture: le thread de lecture XBee
+et les workers n'ecrivent jamais sur stdout eux-memes. LOG_FORMAT=json pour
+une ligne JSON par evenement.
+
+Metriques servies sur http://<gateway>:GATEWAY_METRICS_PORT/metrics.
+Latences par etape (histogramme keybox_gateway_stage_latency_seconds):
+    xbee_queue    reception XBee -> traitement par un worker
+    mqtt_publish  mise en spool -> PUBACK du broker
+"""
+import logging
+import os
+import sys
+
+from prometheus_client import Counter, Histogram, start_http_server
+
+# Journalisation et collecteurs communs avec le backend (shared/observability.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+import observability  # noqa: E402
+from observability import StatsCollector, register  # noqa: E402,F401
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_LATENCY = Histogram('keybox_gateway_stage_latency_seconds', "Latence par etape d'une trame",
+                          ['stage'], buckets=LATENCY_BUCKETS)
+LOG_DROPPED = Counter('keybox_gateway_log_records_dropped', 'Enregistrements de log perdus (file pleine)')
+
+
+def setup_logging(level='INFO', fmt='text'):
+    """Configure le logger racine; retourne le listener (stop() a l'arret pour vider la file)"""
+    return observability.setup_logging(level, fmt, on_drop=LOG_DROPPED.inc)
+
+
+def serve(port):
+    if port:
+        start_http_server(port)
+        logging.getLogger('GATEWAY').info("Metriques sur http://0.0.0.0:%d/metrics", port)
@@ -1,67 +1,178 @@
-import json
+import itertools
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
 from digi.xbee.devices import XBeeDevice
 from digi.xbee.exception import XBeeException
 
+# Decodeur d'evenements commun avec le backend (shared/events.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+import events  # noqa: E402
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest')
+log = logging.getLogger('XBEE')
+_STOP = object()
+
+
+def parse_frame(sender, data_raw):
+    """Transforme une trame texte (JSON ou "ROOM:STATE") en Event valide
+
+    Leve events.DecodeError si la trame est invalide.
+    """
+    return events.from_text(data_raw, sender)
+
+
+def event_id_prefix(gateway_id):
+    """Prefixe des identifiants d'evenements, unique par gateway et par demarrage"""
+    return f"{gateway_id}-{int(time.time() * 1000):x}"
+
+
 class XBeeService:
-    def __init__(self, port, baud_rate, callback_function):
+    def __init__(self, port, baud_rate, callback_function, workers=2, queue_size=1000,
+                 overflow='drop_oldest', device=None, event_prefix=None):
+        """
+        Le thread de lecture digi-xbee ne fait que deposer la trame brute dans
+        une file bornee; le decodage et le callback tournent dans `workers`
+        threads. Les trames d'un meme module (adresse 64 bits) vont toujours au
+        meme worker: leur ordre est conserve.
+
+        overflow: 'drop_oldest' (la trame la plus ancienne de la file est
+        perdue) ou 'drop_newest' (la trame recue est refusee)
+
+        event_prefix: chaque trame recoit un identifiant "<prefixe>-<numero>"
+        (champ eid) dans l'ordre de reception; le backend s'en sert pour
+        ignorer les retransmissions (QoS 1, rejeu du spool, messages retenus)
+
+        Compteurs par module emetteur (nodes(), adresse 64 bits): trames,
+        trames invalides, derniere reception et salle annoncee; publies par
+        le rapport de sante de la gateway (health.py).
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Politique inconnue: {overflow}")
         # Utilisation de l'objet natif de la bibliothèque digi-xbee
-        self.device = XBeeDevice(port, baud_rate)
+        self.device = device or XBeeDevice(port, baud_rate)
         self.callback = callback_function
         self.is_connected = False
+        self.overflow = overflow
+        self.event_prefix = event_prefix
+        self._seq = itertools.count(1)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._threads = [threading.Thread(target=self._worker, args=(q,), name=f'xbee-worker-{i}', daemon=True)
+                         for i, q in enumerate(self._queues)]
+        self._lock = threading.Lock()
+        self.counters = {'received': 0, 'parsed': 0, 'rejected': 0, 'dropped': 0, 'errors': 0,
+                         'latency_total_ms': 0.0, 'latency_max_ms': 0.0}
+        self._nodes = {}            # adresse 64 bits -> compteurs du module
 
     def start(self):
+        for thread in self._threads:
+            thread.start()
         try:
             self.device.open()
-            print(f"[XBEE] Connecte sur {self.device.serial_port}")
+            log.info("Connecte sur %s", self.device.serial_port)
 
             # Definition du callback de reception
             self.device.add_data_received_callback(self._on_data_received)
             self.is_connected = True
         except XBeeException as e:
             self.is_connected = False
-            print(f"[XBEE] Erreur de connexion: {e}")
+            log.error("Erreur de connexion: %s", e)
             raise e
 
     def _on_data_received(self, xbee_message):
+        """Thread de lecture digi-xbee: aucun decodage ni I/O ici"""
         try:
             # Recuperation de l'adresse MAC du module emetteur (Salle)
-            sender = xbee_message.remote_device.get_64bit_addr()
-
-            # Decodage du message recu
-            data_raw = xbee_message.data.decode('utf-8').strip()
-            print(f"[XBEE] Donnees brutes recues de {sender}: {data_raw}")
+            sender = str(xbee_message.remote_device.get_64bit_addr())
+            item = (sender, xbee_message.data, time.time(), next(self._seq))
+            q = self._queues[zlib.crc32(sender.encode()) % len(self._queues)]
+            with self._lock:
+                self.counters['received'] += 1
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                if self.overflow == 'drop_oldest':
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    q.put_nowait(item)
+                with self._lock:
+                    self.counters['dropped'] += 1
+        except Exception as e:
+            with self._lock:
+                self.counters['errors'] += 1
+            log.error("Erreur de reception: %s", e)
 
-            # --- LOGIQUE DE PARSING ---
-            # Si ton Arduino envoie "SALLE1:PRESENTE", on le transforme en dictionnaire
-            payload = None
+    def _worker(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            sender, data, received_at, seq = item
+            latency_ms = (time.time() - received_at) * 1000
             try:
-                # On essaie d'abord de parser le message comme du JSON
-                payload = json.loads(data_raw)
-                payload['xbee_id'] = str(sender)
-            except json.JSONDecodeError:
-                # Si le parsing JSON echoue, on traite le format "ROOM:STATE"
-                print("[XBEE] Ce n'est pas du JSON, on essaie le format simple.")
-                if ":" in data_raw:
-                    parts = data_raw.split(":")
-                    if len(parts) >= 2:
-                        payload = {
-                            "room": parts[0],
-                            "state": parts[1],
-                            "xbee_id": str(sender)
-                        }
-
-            # Si aucune methode n'a fonctionne, on envoie les donnees brutes
-            if payload is None:
-                payload = {"raw": data_raw, "xbee_id": str(sender)}
-
-            print(f"[XBEE] Donnees parsees: {payload}")
-            # Envoi au serveur Flask via SocketIO
-            self.callback(payload)
+                # Decodage du message recu; rx_ts permet de mesurer la latence jusqu'au backend
+                data_raw = data.decode('utf-8', errors='replace').strip()
+                eid = f"{self.event_prefix}-{seq}" if self.event_prefix else None
+                room = None
+                try:
+                    event = parse_frame(sender, data_raw)
+                    event.rx_ts = round(received_at, 3)
+                    event.eid = eid
+                    payload = event.to_dict()
+                    room = event.room
+                    counter = 'parsed'
+                except events.DecodeError as e:
+                    # Trame relayee brute: le backend la range dans sa table dead_letters
+                    log.warning("Trame invalide de %s (%s): %s", sender, e.reason, e)
+                    payload = {'raw': data_raw, 'xbee_id': sender, 'rx_ts': round(received_at, 3)}
+                    if eid:
+                        payload['eid'] = eid
+                    counter = 'rejected'
+                log.debug("Donnees recues de %s: %s", sender, data_raw)
+                with self._lock:
+                    self.counters[counter] += 1
+                    self.counters['latency_total_ms'] += latency_ms
+                    self.counters['latency_max_ms'] = max(self.counters['latency_max_ms'], latency_ms)
+                    node = self._nodes.get(sender)
+                    if node is None:
+                        node = self._nodes[sender] = {'frames': 0, 'rejected': 0, 'last_seen': 0.0, 'room': None}
+                    node['frames'] += 1
+                    node['last_seen'] = max(node['last_seen'], received_at)
+                    if room is None:
+                        node['rejected'] += 1
+                    else:
+                        node['room'] = room
+                self.callback(payload)
+            except Exception as e:
+                with self._lock:
+                    self.counters['errors'] += 1
+                log.error("Erreur de traitement: %s", e)
 
-        except Exception as e:
-            print(f"[XBEE] Erreur de traitement: {e}")
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = sum(q.qsize() for q in self._queues)
+        handled = stats['parsed'] + stats['rejected']
+        stats['latency_avg_ms'] = stats['latency_total_ms'] / handled if handled else 0.0
+        return stats
+
+    def nodes(self):
+        """Copie des compteurs par module emetteur (adresse 64 bits)"""
+        with self._lock:
+            return {address: dict(node) for address, node in self._nodes.items()}
 
-    def stop(self):
+    def stop(self, timeout=2.0):
         if self.device is not None and self.device.is_open():
             self.device.close()
-            print("[XBEE] Connexion fermee.")
\ No newline at end of file
+            log.info("Connexion fermee.")
+        for q in self._queues:
+            # Laisse les workers vider leur file avant de s'arreter
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
@@ -0,0 +1,225 @@
+"""
+Decodage et validation des evenements des boitiers (commun gateway / backend)
+
+Formats acceptes:
+    - JSON du firmware: {"room": "206", "key": "<uid>|N/A|MULTI:uid1,uid2", "state": "IN"}
+      plus les champs ajoutes par la gateway (xbee_id, rx_ts, eid)
+    - texte "ROOM:STATE" (ou "ROOM:STATE:KEY") des anciens firmwares
+
+Un evenement decode est un objet Event (__slots__): la validation est faite une
+fois, a l'entree, et le reste du traitement lit des attributs types au lieu de
+refaire get/startswith/split sur un dict. Un payload invalide leve DecodeError
+(reason: json, format, room, state, key, field) au lieu d'etre ignore.
+
+Chemin rapide: la forme canonique (serializeJson du firmware, ou json.dumps de
+Event.to_dict par la gateway) est reconnue et validee par une seule expression
+reguliere precompilee; tout autre payload passe par json puis from_dict.
+
+Site: chaque evenement appartient a un site (batiment, une gateway par site),
+fixe par le topic MQTT (voir topics.py) et non par le payload. La salle est
+identifiee en base par sa cle de salle room_key(site, salle): "206" pour le
+site par defaut (donnees existantes inchangees), "<site>/206" ailleurs; '/'
+etant interdit dans une salle et un site, la cle est sans ambiguite.
+
+Ce module n'importe que la bibliotheque standard: la gateway et le backend
+l'ajoutent a sys.path (repertoire shared/ du projet).
+"""
+import json
+import re
+
+STATES = frozenset(('IN', 'OUT', 'SWAP', 'ALERT'))
+DEFAULT_SITE = 'default'
+SITE_MAX_LEN = 32
+NO_KEY = 'N/A'
+MULTI_PREFIX = 'MULTI:'
+ROOM_MAX_LEN = 64
+KEY_MAX_LEN = 512
+# Caracteres interdits dans une salle: elle sert de niveau de topic MQTT
+ROOM_FORBIDDEN = frozenset('/+#\x00')
+# Champs connus; les autres sont conserves tels quels (extra)
+FIELDS = frozenset(('room', 'state', 'key', 'eid', 'rx_ts', 'xbee_id'))
+
+_json_decode = json.JSONDecoder().decode
+
+# Forme canonique: room, key, state puis eid, rx_ts, xbee_id optionnels, chaines sans echappement
+_TEXT = r'[^"\\\x00-\x1f]'
+_CANONICAL = re.compile(
+    r'\{"room":\s?"([^"\\/+#\x00-\x1f]{1,%d})",\s?"key":\s?"(%s{0,%d})",\s?"state":\s?"(IN|OUT|SWAP|ALERT)"'
+    r'(?:,\s?"eid":\s?"(%s*)")?(?:,\s?"rx_ts":\s?(-?\d+(?:\.\d+)?))?(?:,\s?"xbee_id":\s?"(%s*)")?\}'
+    % (ROOM_MAX_LEN, _TEXT, KEY_MAX_LEN, _TEXT, _TEXT))
+_SITE = re.compile(r'[A-Za-z0-9_.-]{1,%d}' % SITE_MAX_LEN)
+
+
+class DecodeError(ValueError):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Event:
+    """Evenement d'un boitier, valide; les champs de verification sont remplis par le backend"""
+
+    __slots__ = ('room', 'state', 'key', 'uids', 'eid', 'rx_ts', 'xbee_id', 'extra', 'site',
+                 'key_valid', 'key_name', 'message', 'version')
+
+    def __init__(self, room, state, key=NO_KEY, uids=None, eid=None, rx_ts=None, xbee_id=None, extra=None):
+        self.room = room
+        self.state = state
+        self.key = key
+        self.uids = uids            # tuple des UID d'une alerte MULTI, sinon None
+        self.eid = eid
+        self.rx_ts = rx_ts
+        self.xbee_id = xbee_id
+        self.extra = extra
+        self.site = DEFAULT_SITE    # fixe par le backend d'apres le topic
+        self.key_valid = False
+        self.key_name = None
+        self.message = None
+        self.version = None
+
+    @property
+    def room_key(self):
+        """Identifiant de la salle en base et dans les caches (voir room_key())"""
+        return room_key(self.site, self.room)
+
+    @property
+    def is_swap(self):
+        return self.state == 'SWAP'
+
+    @property
+    def is_multi(self):
+        return self.uids is not None
+
+    def to_dict(self):
+        """Payload publie sur MQTT (memes champs, et meme ordre, que le JSON du firmware)"""
+        data = {'room': self.room, 'key': self.key, 'state': self.state}
+        if self.eid is not None:
+            data['eid'] = self.eid
+        if self.rx_ts is not None:
+            data['rx_ts'] = self.rx_ts
+        if self.xbee_id is not None:
+            data['xbee_id'] = self.xbee_id
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __repr__(self):
+        return f"Event({self.room!r}, {self.state!r}, {self.key!r}, eid={self.eid!r})"
+
+
+def room_key(site, room):
+    """Cle de salle: "206" sur le site par defaut, "<site>/206" sinon"""
+    return room if site == DEFAULT_SITE else f"{site}/{room}"
+
+
+def split_room_key(key):
+    """Inverse de room_key: (site, salle)"""
+    site, sep, room = key.partition('/')
+    return (site, room) if sep else (DEFAULT_SITE, key)
+
+
+def check_site(site):
+    """Valide un nom de site (niveau de topic MQTT, prefixe des cles de salle); retourne le site"""
+    if type(site) is not str or not _SITE.fullmatch(site):
+        raise DecodeError('site', f"site invalide: {site!r}")
+    return site
+
+
+def from_dict(data):
+    """Valide un dict (JSON du firmware, trame d'un lot) et retourne un Event"""
+    if type(data) is not dict:
+        raise DecodeError('format', f"objet JSON attendu, {type(data).__name__} recu")
+    room = data.get('room')
+    if type(room) is not str:
+        if room is None and 'raw' in data:
+            # Trame deja rejetee par la gateway, relayee brute
+            raise DecodeError('format', f"trame illisible: {str(data['raw'])[:80]!r}")
+        room = _room_from(room)
+    if not room or len(room) > ROOM_MAX_LEN or not ROOM_FORBIDDEN.isdisjoint(room):
+        raise DecodeError('room', f"salle invalide: {room!r}")
+    state = data.get('state')
+    if state not in STATES:
+        raise DecodeError('state', f"etat inconnu: {state!r}")
+    key = data.get('key')
+    if key is None or key == '':
+        key = NO_KEY
+    elif type(key) is not str or len(key) > KEY_MAX_LEN:
+        raise DecodeError('key', f"cle invalide: {key!r}")
+
+    uids = _alert_uids(key) if state == 'ALERT' else None
+    eid, rx_ts, xbee_id = data.get('eid'), data.get('rx_ts'), data.get('xbee_id')
+    if eid is not None and type(eid) is not str:
+        raise DecodeError('field', f"eid invalide: {eid!r}")
+    if rx_ts is not None and type(rx_ts) not in (int, float):
+        raise DecodeError('field', f"rx_ts invalide: {rx_ts!r}")
+    if xbee_id is not None and type(xbee_id) is not str:
+        raise DecodeError('field', f"xbee_id invalide: {xbee_id!r}")
+
+    extra = None
+    if not FIELDS.issuperset(data):
+        extra = {k: v for k, v in data.items() if k not in FIELDS}
+    return Event(room, state, key, uids, eid, rx_ts, xbee_id, extra)
+
+
+def _alert_uids(key):
+    """ALERT: toujours la liste des badges detectes ensemble ("MULTI:uid1,uid2")"""
+    if not key.startswith(MULTI_PREFIX):
+        raise DecodeError('key', f"ALERT sans liste {MULTI_PREFIX}: {key!r}")
+    uids = tuple(uid for uid in key[len(MULTI_PREFIX):].split(',') if uid)
+    if not uids:
+        raise DecodeError('key', "ALERT sans badge")
+    return uids
+
+
+def _from_match(match, xbee_id=None):
+    """Event depuis la forme canonique (deja validee par _CANONICAL)"""
+    room, key, state, eid, rx_ts, sent_by = match.groups()
+    if not key:
+        key = NO_KEY
+    return Event(room, state, key, _alert_uids(key) if state == 'ALERT' else None, eid,
+                 float(rx_ts) if rx_ts else None, sent_by if xbee_id is None else xbee_id)
+
+
+def _room_from(value):
+    """Salle numerique ({"room": 206}) acceptee et convertie en texte"""
+    if type(value) is int:
+        return str(value)
+    raise DecodeError('room', f"salle invalide: {value!r}")
+
+
+def from_text(text, xbee_id=None):
+    """Trame texte d'un boitier: JSON si elle commence par '{', sinon "ROOM:STATE[:KEY]" """
+    text = text.strip()
+    if text[:1] == '{':
+        match = _CANONICAL.fullmatch(text)
+        if match:
+            return _from_match(match, xbee_id)
+        try:
+            data = _json_decode(text)
+        except ValueError as e:
+            raise DecodeError('json', f"JSON invalide: {e}") from None
+        if xbee_id is not None and type(data) is dict:
+            data['xbee_id'] = xbee_id
+        return from_dict(data)
+    parts = text.split(':', 2)
+    if len(parts) < 2:
+        raise DecodeError('format', "ni JSON ni ROOM:STATE")
+    data = {'room': parts[0].strip(), 'state': parts[1].strip()}
+    if len(parts) == 3:
+        data['key'] = parts[2].strip()
+    if xbee_id is not None:
+        data['xbee_id'] = xbee_id
+    return from_dict(data)
+
+
+def from_payload(payload):
+    """Message MQTT (bytes) publie par la gateway"""
+    try:
+        text = payload.decode('utf-8')
+        match = _CANONICAL.fullmatch(text)
+        if match:
+            return _from_match(match)
+        data = _json_decode(text)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise DecodeError('json', f"JSON invalide: {e}") from None
+    return from_dict(data)
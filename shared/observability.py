@@ -0,0 +1,96 @@
+"""
+Journalisation non bloquante et collecteurs Prometheus (commun gateway / backend)
+
+Les appels logging ne font que deposer l'enregistrement dans une file bornee
+(jamais bloquant: enregistrement perdu et compte par on_drop si pleine); un
+thread d'ecriture le formate sur stdout, en texte ("... [MQTT] message") ou en
+JSON une ligne par evenement (LOG_FORMAT=json, champs additionnels via
+extra={'fields': {...}}).
+
+Le backend en mode eventlet passe ses modules natifs (queue, threading): le
+thread d'ecriture est alors un vrai thread, les ecritures stdout ne bloquent
+pas le hub. Chaque cote garde ses propres metriques (telemetry.py).
+
+Ce module n'importe que la bibliotheque standard et prometheus_client.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+LOG_QUEUE_SIZE = 10000
+TEXT_FORMAT = '%(asctime)s %(levelname)-7s [%(name)s] %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue, full=queue.Full, on_drop=None):
+        super().__init__(log_queue)
+        self.full = full
+        self.on_drop = on_drop
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except self.full:
+            if self.on_drop:
+                self.on_drop()
+
+
+class ThreadQueueListener(logging.handlers.QueueListener):
+    """QueueListener dont le thread d'ecriture vient du module threading donne"""
+    def __init__(self, log_queue, *handlers, threading_module=threading):
+        super().__init__(log_queue, *handlers)
+        self.threading_module = threading_module
+
+    def start(self):
+        self._thread = self.threading_module.Thread(target=self._monitor, name='log-writer', daemon=True)
+        self._thread.start()
+
+
+def setup_logging(level='INFO', fmt='text', on_drop=None, queue_module=queue, threading_module=threading):
+    """Configure le logger racine; retourne le listener (stop() a l'arret pour vider la file)"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue_module.Queue(LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.handlers[:] = [DroppingQueueHandler(log_queue, queue_module.Full, on_drop)]
+    root.setLevel(level.upper())
+    listener = ThreadQueueListener(log_queue, handler, threading_module=threading_module)
+    listener.start()
+    return listener
+
+
+class StatsCollector:
+    """Expose un dict de compteurs (ex. WriteBehindQueue.stats(), Spool.stats()) comme metriques Prometheus"""
+    def __init__(self, prefix, stats, counters=(), gauges=()):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = counters
+        self.gauges = gauges
+
+    def collect(self):
+        values = self.stats()
+        for name in self.counters:
+            yield CounterMetricFamily(f'{self.prefix}_{name}', name, value=values.get(name) or 0)
+        for name in self.gauges:
+            yield GaugeMetricFamily(f'{self.prefix}_{name}', name, value=float(values.get(name) or 0))
+
+
+def register(collector):
+    REGISTRY.register(collector)
+    return collector
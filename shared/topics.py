@@ -0,0 +1,89 @@
+"""
+Topics MQTT des evenements, par site (commun gateway / backend)
+
+    site par defaut (topics historiques, gateways et backends existants):
+        ecole/salles/<salle>/status          evenement (QoS 1, retained)
+        ecole/salles/<salle>/state           dernier etat retenu (mode groupe)
+        ecole/gateway/batch/<encodage>       lots de trames (mode groupe)
+        ecole/gateway/health/<gateway>       rapport de sante (retained, testament MQTT)
+    autres sites:
+        ecole/sites/<site>/salles/<salle>/status
+        ecole/sites/<site>/salles/<salle>/state
+        ecole/sites/<site>/batch/<encodage>
+        ecole/sites/<site>/health/<gateway>
+
+Le site d'un evenement est celui de son topic: deux batiments peuvent avoir une
+salle "206" sans collision (voir events.room_key).
+"""
+from events import DEFAULT_SITE, DecodeError, check_site
+
+LEGACY_STATUS = 'ecole/salles/{room}/status'
+LEGACY_STATE = 'ecole/salles/{room}/state'
+LEGACY_BATCH = 'ecole/gateway/batch/{encoding}'
+SITE_STATUS = 'ecole/sites/{site}/salles/{room}/status'
+SITE_STATE = 'ecole/sites/{site}/salles/{room}/state'
+SITE_BATCH = 'ecole/sites/{site}/batch/{encoding}'
+LEGACY_HEALTH = 'ecole/gateway/health/{gateway}'
+SITE_HEALTH = 'ecole/sites/{site}/health/{gateway}'
+
+
+def _is_default(site):
+    return site in (None, '', DEFAULT_SITE)
+
+
+def status_topic(site, room):
+    return LEGACY_STATUS.format(room=room) if _is_default(site) else SITE_STATUS.format(site=site, room=room)
+
+
+def state_topic(site, room):
+    return LEGACY_STATE.format(room=room) if _is_default(site) else SITE_STATE.format(site=site, room=room)
+
+
+def batch_topic(site, encoding):
+    return LEGACY_BATCH.format(encoding=encoding) if _is_default(site) else SITE_BATCH.format(site=site, encoding=encoding)
+
+
+def health_topic(site, gateway):
+    return LEGACY_HEALTH.format(gateway=gateway) if _is_default(site) else SITE_HEALTH.format(site=site, gateway=gateway)
+
+
+def health_subscriptions(sites=None):
+    """Filtres des rapports de sante (non partages: chaque worker du backend les recoit tous)"""
+    if not sites:
+        return [LEGACY_HEALTH.format(gateway='+'), SITE_HEALTH.format(site='+', gateway='+')]
+    return [health_topic(site, '+') for site in sites]
+
+
+def subscriptions(sites=None):
+    """Filtres d'abonnement du backend: tous les sites, ou seulement `sites`"""
+    if not sites:
+        return [LEGACY_STATUS.format(room='+'), LEGACY_BATCH.format(encoding='+'),
+                SITE_STATUS.format(site='+', room='+'), SITE_BATCH.format(site='+', encoding='+')]
+    filters = []
+    for site in sites:
+        if _is_default(site):
+            filters += [LEGACY_STATUS.format(room='+'), LEGACY_BATCH.format(encoding='+')]
+        else:
+            filters += [SITE_STATUS.format(site=site, room='+'), SITE_BATCH.format(site=site, encoding='+')]
+    return filters
+
+
+def parse(topic):
+    """(nature, site) d'un topic: nature 'status' | 'batch' | 'health', ou (None, None) (site invalide compris)"""
+    parts = topic.split('/')
+    if parts[0] != 'ecole':
+        return None, None
+    if len(parts) == 4 and parts[1] == 'salles' and parts[3] == 'status':
+        return 'status', DEFAULT_SITE
+    if len(parts) == 4 and parts[1] == 'gateway' and parts[2] in ('batch', 'health'):
+        return parts[2], DEFAULT_SITE
+    if len(parts) >= 5 and parts[1] == 'sites':
+        try:
+            check_site(parts[2])
+        except DecodeError:
+            return None, None
+        if len(parts) == 6 and parts[3] == 'salles' and parts[5] == 'status':
+            return 'status', parts[2]
+        if len(parts) == 5 and parts[3] in ('batch', 'health'):
+            return parts[3], parts[2]
+    return None, None